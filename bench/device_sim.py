@@ -0,0 +1,410 @@
+# encoding: utf-8
+"""
+Fake network devices on local SSH and telnet ports, to load the workers
+
+Every address of 127.0.0.0/8 is a device (hostname sim-x-y-z for
+127.x.y.z), so thousands of them are simulated by one process without
+any interface setup. Each profile gets an SSH port and a telnet port
+(--ssh-port and --telnet-port plus its index in PROFILES):
+
+    ios      Username/Password, enable, terminal length 0
+    asa      as ios, sim-x-y-z/act/pri# prompts
+    iosxr    straight into RP/0/RSP0/CPU0:sim-x-y-z#
+    brocade  sim-x-y-z:FID128:admin>, no enable, no pager
+    huawei   <sim-x-y-z>, screen-length 0 temporary (H3C alike)
+    f5       root@sim-x-y-z(Active)(tmos)#, tmsh pager commands
+
+Devices echo input like the real ones (pexpect waits for the echo),
+page long outputs with --More-- until the pager is disabled, and answer
+commands after --latency seconds: the canned version of the profile,
+a '^' marked error for commands starting with 'invalid', or --size
+bytes of generated lines for anything else.
+
+Faults, drawn per session or per command with --seed:
+    --slow-banner seconds for --slow-banner-rate of the logins
+    --wrong-password-rate of the logins rejected
+    --drop-rate of the commands closing the session
+
+    python bench/device_sim.py --size=100000 --latency=0.05
+    # cisco worker task: {"ip": "127.0.1.5", "port": 2200, "method": "ssh",
+    #                     "channel": "cisco", "password": "cisco", ...}
+
+SSH needs asyncssh, telnet works without it.
+"""
+
+import asyncio
+import logging
+import random
+import resource
+
+from tornado import options
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+PROFILES = (  # name, settings; order gives the ports
+    ('ios', dict(
+        user='{host}>', enable='{host}#',
+        pager=('terminal length 0',),
+        error="% Invalid input detected at '^' marker.",
+        version=('show version', 'Cisco IOS Software, C3900 Software '
+                                 '(C3900-UNIVERSALK9-M), Version 15.4(3)M2'))),
+    ('asa', dict(
+        user='{host}/act/pri>', enable='{host}/act/pri#',
+        pager=('terminal pager 0', 'terminal length 0'),
+        error="ERROR: % Invalid input detected at '^' marker.",
+        version=('show version', 'Cisco Adaptive Security Appliance '
+                                 'Software Version 9.8(4)'))),
+    ('iosxr', dict(
+        user=None, enable='RP/0/RSP0/CPU0:{host}#',
+        pager=('terminal length 0',),
+        error="% Invalid input detected at '^' marker.",
+        version=('show version', 'Cisco IOS XR Software, Version 6.1.4'))),
+    ('brocade', dict(
+        user='{host}:FID128:admin>', enable=None,
+        pager=(),
+        error="rbash: invalid: command not found at '^' marker",
+        version=('version', 'Fabric OS:  v8.2.1c'))),
+    ('huawei', dict(
+        user='<{host}>', enable=None,
+        pager=('screen-length 0 temporary',),
+        error="Error: Unrecognized command found at '^' position.",
+        version=('display version', 'Huawei Versatile Routing Platform '
+                                    'Software, VRP (R) software, '
+                                    'Version 8.180'))),
+    ('f5', dict(
+        user=None, enable='root@{host}(Active)(tmos)#',
+        pager=('tmsh modify cli preference pager disabled',
+               'modify cli preference pager disabled', 'terminal length 0'),
+        error='Syntax Error: "invalid" unknown property',
+        version=('show sys version', 'Sys::Version\n  Product  BIG-IP\n'
+                                     '  Version  13.1.1'))),
+)
+
+PAGE_LINES = 24
+MORE = b' --More-- '
+QUIT = ('exit', 'quit', 'logout')
+IAC, SB, SE, WILL, ECHO, SGA = 255, 250, 240, 251, 1, 3
+
+
+def hostname(ip):
+    return 'sim-%s' % '-'.join(ip.split('.')[1:])
+
+
+def generated(size, cache={}):
+    """size bytes of interface lines, none looking like a prompt"""
+    text = cache.get(size)
+    if text is None:
+        lines, n, i = [], 0, 0
+        while n < size:
+            line = ('GigabitEthernet0/%d is up, line protocol is up, '
+                    '%d packets input, %d bytes' % (i, i * 7919, i * 1031))
+            lines.append(line)
+            n += len(line) + 1
+            i += 1
+        text = cache[size] = '\n'.join(lines)[:size]
+    return text
+
+
+class Simulator(object):
+    """Settings and fault draws shared by all sessions"""
+
+    def __init__(self, opts):
+        self.password = opts.password
+        self.enable_password = opts.enable_password
+        self.size = opts.size
+        self.latency = opts.latency
+        self.login_delay = opts.login_delay
+        self.slow_banner = opts.slow_banner
+        self.slow_banner_rate = opts.slow_banner_rate
+        self.wrong_password_rate = opts.wrong_password_rate
+        self.drop_rate = opts.drop_rate
+        self.random = random.Random(opts.seed)
+        self.sessions = 0
+
+    def draw(self, rate):
+        return rate and self.random.random() < rate
+
+    def check_password(self, password):
+        return password == self.password and \
+            not self.draw(self.wrong_password_rate)
+
+
+class TelnetReader(object):
+    """Input of a telnet client without its option negotiation"""
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.state = None  # None, IAC, option command, SB
+
+    async def read(self, n):
+        data = await self.reader.read(n)
+        out = bytearray()
+        for b in data:
+            state = self.state
+            if state is None:
+                if b == IAC:
+                    self.state = IAC
+                else:
+                    out.append(b)
+            elif state == IAC:
+                if b == IAC:
+                    out.append(b)
+                    self.state = None
+                elif b == SB:
+                    self.state = SB
+                elif b >= WILL:  # WILL/WONT/DO/DONT option
+                    self.state = b
+                else:
+                    self.state = None
+            elif state == SB:
+                if b == SE:
+                    self.state = None
+            else:  # option byte of WILL/WONT/DO/DONT
+                self.state = None
+        if data and not out:
+            return await self.read(n)
+        return bytes(out)
+
+
+class Session(object):
+    """One CLI session, after the transport got the user in"""
+
+    def __init__(self, sim, profile, ip, reader, write, close):
+        self.sim = sim
+        self.name, self.profile = profile
+        self.host = hostname(ip)
+        self.reader = reader
+        self.write = write
+        self.close = close
+        self.buffer = b''
+        self.after_cr = False
+        self.pager = bool(self.profile['pager'])
+        self.enabled = self.profile['user'] is None
+
+    @property
+    def prompt(self):
+        p = self.profile['enable' if self.enabled else 'user']
+        return p.format(host=self.host)
+
+    def send(self, text):
+        self.write(text.replace('\n', '\r\n').encode())
+
+    async def readchar(self):
+        while not self.buffer:
+            data = await self.reader.read(4096)
+            if not data:
+                raise EOFError()
+            self.buffer = data
+        c, self.buffer = self.buffer[:1], self.buffer[1:]
+        return c
+
+    async def readline(self, echo=True):
+        line = bytearray()
+        while True:
+            c = await self.readchar()
+            if self.after_cr:
+                self.after_cr = False
+                if c in (b'\n', b'\0'):  # CR LF or CR NUL
+                    continue
+            if c in (b'\r', b'\n'):
+                self.after_cr = c == b'\r'
+                self.write(b'\r\n')
+                return line.decode('utf-8', 'replace')
+            if c in (b'\x08', b'\x7f'):
+                if line:
+                    del line[-1]
+                    if echo:
+                        self.write(b'\x08 \x08')
+                continue
+            line += c
+            if echo:
+                self.write(c)
+
+    async def login(self):
+        """Username and password, for telnet"""
+        for _ in range(3):
+            self.send('\nUser Access Verification\n\nUsername: ')
+            await self.readline()
+            self.send('Password: ')
+            password = await self.readline(echo=False)
+            if self.sim.check_password(password):
+                return True
+            self.send('% Login invalid\n')
+        return False
+
+    async def enable(self):
+        for _ in range(3):
+            self.send('Password: ')
+            if await self.readline(echo=False) == self.sim.enable_password:
+                self.enabled = True
+                return
+        self.send('% Bad secrets\n')
+
+    async def output(self, text):
+        lines = text.split('\n')
+        while self.pager and len(lines) >= PAGE_LINES:
+            page, lines = lines[:PAGE_LINES - 1], lines[PAGE_LINES - 1:]
+            self.send('\n'.join(page) + '\n')
+            self.write(MORE)
+            c = await self.readchar()
+            self.write(b'\r' + b' ' * len(MORE) + b'\r')
+            if c in (b'q', b'Q'):
+                return
+        self.send('\n'.join(lines) + '\n')
+
+    async def command(self, line):
+        """False once the session is over"""
+        cmd = ' '.join(line.split())
+        profile = self.profile
+        if not cmd or cmd == 'end':
+            return True
+        if cmd in QUIT:
+            return False
+        if cmd == 'enable' and profile['enable'] and not self.enabled:
+            await self.enable()
+            return True
+        if cmd in profile['pager']:
+            self.pager = False
+            return True
+        if self.sim.latency:
+            await asyncio.sleep(self.sim.latency)
+        if self.sim.draw(self.sim.drop_rate):
+            return False
+        if cmd.startswith('invalid'):
+            self.send('%s\n%s\n' % (' ' * len(self.prompt) + '^',
+                                    profile['error']))
+        elif cmd == profile['version'][0]:
+            await self.output(profile['version'][1])
+        else:
+            await self.output(generated(self.sim.size))
+        return True
+
+    async def run(self, telnet=False):
+        sim = self.sim
+        sim.sessions += 1
+        try:
+            delay = sim.login_delay
+            if sim.draw(sim.slow_banner_rate):
+                delay += sim.slow_banner
+            if delay:
+                await asyncio.sleep(delay)
+            if telnet and not await self.login():
+                return
+            self.send('\n')
+            while True:
+                self.send(self.prompt)
+                if not await self.command(await self.readline()):
+                    return
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            sim.sessions -= 1
+            self.close()
+
+
+def telnet_server(sim, profile):
+    async def handle(reader, writer):
+        # the device echoes, the client sends characters as typed
+        writer.write(bytes((IAC, WILL, ECHO, IAC, WILL, SGA)))
+        ip = writer.get_extra_info('sockname')[0]
+        await Session(sim, profile, ip, TelnetReader(reader), writer.write,
+                      writer.close).run(telnet=True)
+    return handle
+
+
+if asyncssh:
+    class SSHServer(asyncssh.SSHServer):
+
+        def __init__(self, sim):
+            self.sim = sim
+
+        def begin_auth(self, username):
+            return True
+
+        def password_auth_supported(self):
+            return True
+
+        def validate_password(self, username, password):
+            return self.sim.check_password(password)
+
+
+def ssh_process(sim, profile):
+    async def handle(process):
+        ip = process.get_extra_info('sockname')[0]
+        await Session(sim, profile, ip, process.stdin, process.stdout.write,
+                      process.exit).run()
+    return handle
+
+
+async def start(sim, opts):
+    names = opts.profiles.split(',') if opts.profiles else None
+    key = asyncssh.generate_private_key('ssh-ed25519') if asyncssh else None
+    for i, profile in enumerate(PROFILES):
+        name = profile[0]
+        if names and name not in names:
+            continue
+        port = opts.telnet_port + i
+        await asyncio.start_server(telnet_server(sim, profile), opts.host,
+                                   port, backlog=1024)
+        ports = 'telnet %d' % port
+        if asyncssh:
+            port = opts.ssh_port + i
+            await asyncssh.create_server(
+                lambda: SSHServer(sim), opts.host, port,
+                server_host_keys=[key], process_factory=ssh_process(
+                    sim, profile),
+                encoding=None, line_editor=False, backlog=1024)
+            ports += ', ssh %d' % port
+        print('%-8s %s' % (name, ports))
+
+
+def main():
+    options.define("host", default='', type=str,
+                   help="listen address, all of 127.0.0.0/8 by default")
+    options.define("ssh_port", default=2200, type=int,
+                   help="SSH port of the first profile")
+    options.define("telnet_port", default=2300, type=int,
+                   help="telnet port of the first profile")
+    options.define("profiles", default='', type=str,
+                   help="comma separated, all by default: %s" % ','.join(
+                       p[0] for p in PROFILES))
+    options.define("password", default='cisco', type=str)
+    options.define("enable_password", default='cisco', type=str)
+    options.define("size", default=2000, type=int,
+                   help="bytes of output of a command")
+    options.define("latency", default=0.0, type=float,
+                   help="seconds before the output of a command")
+    options.define("login_delay", default=0.0, type=float,
+                   help="seconds before the first prompt")
+    options.define("slow_banner", default=0.0, type=float,
+                   help="seconds added to the login delay of slow banners")
+    options.define("slow_banner_rate", default=0.0, type=float)
+    options.define("wrong_password_rate", default=0.0, type=float)
+    options.define("drop_rate", default=0.0, type=float,
+                   help="share of commands dropping the session")
+    options.define("seed", default=None, type=int)
+    options.parse_command_line()
+    opts = options.options
+
+    # a session is a socket here and a pty and ssh process on the worker
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if asyncssh:
+        asyncssh.set_log_level(logging.WARNING)  # a line per connection
+    sim = Simulator(opts)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(start(sim, opts))
+    print('Devices at 127.0.0.0/8, Ctrl+C to exit')
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+# encoding: utf-8
+"""
+End to end load test of the servers, replacing perf.py and test.py
+
+Starts a server (server_callback, or server_thread in thread or async
+mode) and a worker of the test channel: test_worker, or echo_worker,
+replying at once with `size` bytes per command. Every combination of
+concurrency and reply size is then run by an async HTTP client, and
+reported as throughput, p50/p95/p99 latency, server CPU and peak RSS
+(from /proc) and the peak broker queue depth (from /metrics).
+
+Results go to a JSON file, tagged with the git commit, to compare the
+server modes and commits with --baseline:
+
+    python bench/load.py --servers=callback,thread,async \\
+        --concurrency=1,10,100 --size=100,100000 --requests=2000
+    python bench/load.py --baseline=bench/results/<older>.json
+
+--i runs the worker with the asyncio runtime, with --delay seconds per
+task standing for a device:
+
+    python bench/load.py --servers=callback --delay=0.1 --i=1000 \
+        --concurrency=1000 --size=100
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from tornado import gen, ioloop, options
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {  # name -> server command line arguments
+    'callback': ['server_callback.py'],
+    'thread': ['server_thread.py', '-m=thread'],
+    'async': ['server_thread.py', '-m=async'],
+}
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+SAMPLE_INTERVAL = 0.5  # seconds
+LABELS = ('server', 'worker', 'operate', 'concurrency', 'size')
+
+
+def gauge(metrics, name, channel):
+    """Value of a gauge of the backend serving channel, None if missing"""
+    m = re.search(r'^%s\{channels="[^"]*\b%s\b[^"]*"\} (\d+)' % (
+        name, channel), metrics, re.M)
+    return int(m.group(1)) if m else None
+
+
+def cpu_seconds(pid):
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+
+
+def rss_mb(pid):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+def percentile(values, p):
+    """values sorted"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def ms(seconds):
+    return round(seconds * 1e3, 2) if seconds is not None else None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+class Server(object):
+    """A server and its worker process, stopped on exit of the with block"""
+
+    def __init__(self, name, worker, threads, port, channel='test',
+                 in_flight=0):
+        self.name = name
+        self.worker = worker
+        self.threads = threads
+        self.in_flight = in_flight  # tasks of the asyncio worker runtime
+        self.port = port
+        self.channel = channel
+        self.server = self.workers = None
+
+    def __enter__(self):
+        devnull = open(os.devnull, 'w')
+        self.server = subprocess.Popen(
+            [sys.executable] + SERVERS[self.name] + ['-p=%d' % self.port],
+            cwd=ROOT, stdout=devnull, stderr=devnull)
+        time.sleep(1)  # port daemon up
+        self.workers = subprocess.Popen(
+            [sys.executable, '%s_worker.py' % self.worker,
+             '-t=%d' % self.threads, '-i=%d' % self.in_flight],
+            cwd=os.path.join(ROOT, 'workers'), stdout=devnull, stderr=devnull)
+        return self
+
+    def __exit__(self, *exc):
+        for p in (self.workers, self.server):
+            if p and p.poll() is None:
+                p.terminate()
+                p.wait()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.port, path)
+
+
+@gen.coroutine
+def scrape(server):
+    response = yield AsyncHTTPClient().fetch(server.url('/metrics'),
+                                             raise_error=False)
+    raise gen.Return(response.body.decode() if response.code == 200 else '')
+
+
+@gen.coroutine
+def wait_ready(server, timeout=30):
+    """Until the worker threads joined the server"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        threads = gauge((yield scrape(server)), 'cc_worker_threads',
+                        server.channel)
+        if threads and threads >= (server.in_flight or server.threads):
+            return
+        yield gen.sleep(SAMPLE_INTERVAL)
+    raise RuntimeError('%s: no worker after %d s' % (server.name, timeout))
+
+
+@gen.coroutine
+def run(server, concurrency, total, request, count=None):
+    """
+    One load run, total requests from concurrency clients. request(i)
+    gives the path and JSON body of request i, count(reply) the items
+    in a successful reply if they are to be counted.
+    """
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    pid = server.server.pid
+    latencies = []
+    errors = [0]
+    items = [0]
+    samples = dict(rss=[], queue=[])
+    sent = [0]
+
+    @gen.coroutine
+    def user(n):
+        while sent[0] < total:
+            path, body = request(sent[0])
+            sent[0] += 1
+            start = time.time()
+            response = yield client.fetch(HTTPRequest(
+                server.url(path), method='POST', body=json.dumps(body),
+                request_timeout=300), raise_error=False)
+            latencies.append(time.time() - start)
+            reply = json.loads(response.body) if response.code == 200 else {}
+            if reply.get('status') != 'success':
+                errors[0] += 1
+            elif count:
+                items[0] += count(reply)
+
+    @gen.coroutine
+    def sampler():
+        while sent[0] < total or len(latencies) < total:
+            samples['rss'].append(rss_mb(pid))
+            depth = gauge((yield scrape(server)), 'cc_queue_depth',
+                          server.channel)
+            if depth is not None:
+                samples['queue'].append(depth)
+            yield gen.sleep(SAMPLE_INTERVAL)
+
+    cpu, start = cpu_seconds(pid), time.time()
+    sampling = sampler()
+    yield [user(n) for n in range(concurrency)]
+    elapsed, cpu = time.time() - start, cpu_seconds(pid) - cpu
+    yield sampling
+    client.close()
+    latencies.sort()
+    result = dict(
+        server=server.name,
+        worker=server.worker,
+        concurrency=concurrency,
+        requests=total,
+        errors=errors[0],
+        throughput=round(total / elapsed, 1),
+        p50_ms=ms(percentile(latencies, 50)),
+        p95_ms=ms(percentile(latencies, 95)),
+        p99_ms=ms(percentile(latencies, 99)),
+        server_cpu_s=round(cpu, 2),
+        server_cpu_ms_per_request=round(cpu * 1e3 / total, 3),
+        server_rss_peak_mb=round(max(samples['rss'] or [0]), 1),
+        queue_depth_peak=max(samples['queue'] or [0]))
+    if count:
+        result['items_per_second'] = round(items[0] / elapsed, 1)
+    raise gen.Return(result)
+
+
+def cli_request(size, delay=0):
+    """Requests to the test channel, each one for another device"""
+    def request(i):
+        return '/api/v1/sync/cli', dict(
+            ip='10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            hostname='R%08d' % i,
+            channel='test',
+            password='bench',
+            commands=['show version'],
+            size=size,
+            delay=delay)
+    return request
+
+
+def key(result):
+    return tuple(result.get(label) for label in LABELS)
+
+
+def compare(results, baseline):
+    """Change of throughput and p99 against a former result file"""
+    with open(baseline) as f:
+        old = dict((key(r), r) for r in json.load(f)['results'])
+    for r in results:
+        o = old.get(key(r))
+        if not o:
+            continue
+        print('%s  throughput %+6.1f%%  p99 %+6.1f%%' % (
+            ' '.join('%s=%s' % (label, r[label]) for label in LABELS
+                     if label in r),
+            100.0 * (r['throughput'] / o['throughput'] - 1),
+            100.0 * (r['p99_ms'] / o['p99_ms'] - 1)))
+
+
+def save(name, results, out, baseline, **settings):
+    """Write results with the commit and settings, compare to baseline"""
+    out = out or os.path.join(
+        ROOT, 'bench', 'results', '%s-%s-%s.json' % (
+            name, git_commit() or 'unknown', time.strftime('%Y%m%d-%H%M%S')))
+    if not os.path.isdir(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+    with open(out, 'w') as f:
+        json.dump(dict(commit=git_commit(),
+                       time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                       python=sys.version.split()[0],
+                       results=results, **settings), f, indent=2)
+    print('Results written to %s' % out)
+    if baseline:
+        compare(results, baseline)
+
+
+@gen.coroutine
+def bench():
+    opts = options.options
+    results = []
+    for name in opts.servers.split(','):
+        with Server(name, opts.worker, opts.t, opts.p,
+                    in_flight=opts.i) as server:
+            yield wait_ready(server)
+            for concurrency in opts.concurrency:
+                for size in opts.size:
+                    result = yield run(server, concurrency, opts.requests,
+                                       cli_request(size, opts.delay))
+                    result['size'] = size
+                    print(json.dumps(result))
+                    results.append(result)
+    raise gen.Return(results)
+
+
+def main():
+    options.define("servers", default='callback,thread,async', type=str,
+                   help="servers to run: %s" % ','.join(sorted(SERVERS)))
+    options.define("worker", default='echo', type=str,
+                   help="echo (zero latency) or test (seconds per task)")
+    options.define("t", default=10, help="worker threads", type=int)
+    options.define("i", default=0, type=int,
+                   help="tasks in flight per worker process, asyncio "
+                        "runtime; 0 for the -t threads")
+    options.define("p", default=8089, help="server port", type=int)
+    options.define("concurrency", default=[1, 10, 100], type=int,
+                   multiple=True, help="concurrent clients, comma separated")
+    options.define("size", default=[100, 100000], type=int, multiple=True,
+                   help="reply bytes per command (echo worker)")
+    options.define("delay", default=0.0, type=float,
+                   help="seconds per task (echo worker), a device")
+    options.define("requests", default=1000, type=int, help="per run")
+    options.define("out", default='', type=str,
+                   help="result file, by default "
+                        "bench/results/load-<commit>-<time>.json")
+    options.define("baseline", default='', type=str,
+                   help="result file to compare with")
+    options.parse_command_line()
+    opts = options.options
+
+    results = ioloop.IOLoop.current().run_sync(bench)
+    save('load', results, opts.out, opts.baseline, threads=opts.t,
+         in_flight=opts.i, delay=opts.delay)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# encoding: utf-8
+"""
+Reading a large command output up to the prompt: expect() a line at a
+time, as CiscoCLI.execute did, against modules/prompt_reader.py
+
+Every output is replayed through a pty by `cat`, followed by a prompt,
+and read both ways. Outputs must come out the same; the wall time and
+the CPU time of this process (the worker side) are reported:
+
+    python bench/prompt_read.py --lines=200000 --runs=3
+    python bench/prompt_read.py --files=show_ip_bgp.txt,show_run_all.txt
+
+Recorded outputs are text files, e.g. the output of a command of a
+/api/v1/sync/cli reply. Without --files, a `show ip bgp` and a
+`show running-config all` of --lines lines are made up.
+"""
+
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+import pexpect
+from tornado import options
+
+from load import ROOT, save
+
+sys.path.insert(0, os.path.join(ROOT, 'workers'))
+from modules.prompt_reader import prompt_regex, read_until_prompt  # noqa
+
+PROMPT = 'R1#'
+PATTERNS = ['.*\r\n', pexpect.TIMEOUT, pexpect.EOF, re.escape(PROMPT),
+            r'\)#', r'fex-\d+#', r'\[[yn]\]', '[pP]assword:', r'\[confirm\]',
+            r'\]\?']  # those of CiscoCLI for a Cisco device
+
+
+def show_ip_bgp(lines):
+    out = ['BGP table version is 93817, local router ID is 10.0.0.1',
+           '   Network          Next Hop            Metric LocPrf Weight Path']
+    for i in range(lines):
+        out.append('*> %d.%d.%d.0/24%s192.0.2.%d%s0    100      0 '
+                   '65%03d 65%03d 3356 %d i' % (
+                       1 + i // 65536 % 223, i // 256 % 256, i % 256,
+                       ' ' * 6, i % 254 + 1, ' ' * 12, i % 1000,
+                       i * 7 % 1000, i % 64000))
+    return '\n'.join(out) + '\n'
+
+
+def show_run_all(lines):
+    out = ['Building configuration...', '', 'Current configuration']
+    i = 0
+    while len(out) < lines:
+        out.extend(['interface GigabitEthernet%d/%d' % (i // 48, i % 48),
+                    ' description uplink %d' % i,
+                    ' ip address 10.%d.%d.1 255.255.255.0' % (
+                        i // 256 % 256, i % 256),
+                    ' no ip redirects',
+                    ' ip ospf cost 10',
+                    ' load-interval 30',
+                    ' carrier-delay 2',
+                    ' speed auto',
+                    ' duplex auto',
+                    '!'])
+        i += 1
+    return '\n'.join(out) + '\n'
+
+
+def replay(path):
+    """A pty printing the output then the prompt, as a device does"""
+    return pexpect.spawn('/bin/sh', ['-c', 'cat "$0"; printf "%s" "$1"; '
+                                     'exec sleep 600', path, PROMPT],
+                         maxread=8192, searchwindowsize=4096,
+                         env={"TERM": "dumb"})
+
+
+def per_line(child, timeout):
+    res = []
+    while True:
+        c = child.expect(PATTERNS, timeout=timeout)
+        res.append(child.before.decode('utf-8'))
+        try:
+            res.append(str(child.after.decode('utf-8')))
+        except:
+            break
+        if c > 0:
+            break
+    return ''.join(res)
+
+
+def chunked(child, timeout, prompt_re=prompt_regex(PATTERNS[3:])):
+    data, _ = read_until_prompt(child, prompt_re, timeout)
+    return data.decode('utf-8')
+
+
+def measure(read, path, timeout):
+    child = replay(path)
+    started, cpu = time.time(), time.process_time()
+    output = read(child, timeout)
+    result = time.time() - started, time.process_time() - cpu
+    child.close(force=True)
+    return output, result
+
+
+def bench(outputs, runs, timeout):
+    results = []
+    for name, path in outputs:
+        size = os.path.getsize(path)
+        best = {}
+        outputs = {}
+        for _ in range(runs):
+            for how, read in (('per_line', per_line), ('chunked', chunked)):
+                output, (wall, cpu) = measure(read, path, timeout)
+                outputs[how] = output
+                wall0, cpu0 = best.get(how, (wall, cpu))
+                best[how] = min(wall, wall0), min(cpu, cpu0)
+        if outputs['per_line'] != outputs['chunked']:
+            print('%s: outputs differ' % name)
+        result = dict(output=name, bytes=size,
+                      lines=outputs['chunked'].count('\n'),
+                      same=outputs['per_line'] == outputs['chunked'])
+        for how, (wall, cpu) in best.items():
+            result['%s_s' % how] = round(wall, 3)
+            result['%s_cpu_s' % how] = round(cpu, 3)
+        result['speedup'] = round(result['per_line_s'] /
+                                  max(result['chunked_s'], 1e-6), 1)
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+def main():
+    options.define("files", default=[], type=str, multiple=True,
+                   help="recorded outputs, comma separated")
+    options.define("lines", default=200000, type=int,
+                   help="lines of the outputs made up without --files")
+    options.define("runs", default=3, type=int, help="best of")
+    options.define("timeout", default=30, type=int)
+    options.define("out", default='', type=str,
+                   help="result file, by default "
+                        "bench/results/prompt-<commit>-<time>.json")
+    options.parse_command_line()
+    opts = options.options
+
+    tmp = None
+    if opts.files:
+        outputs = [(os.path.basename(f), f) for f in opts.files]
+    else:
+        tmp = tempfile.mkdtemp()
+        outputs = []
+        for name, make in (('show_ip_bgp', show_ip_bgp),
+                           ('show_run_all', show_run_all)):
+            path = os.path.join(tmp, name + '.txt')
+            with open(path, 'w') as f:
+                f.write(make(opts.lines))
+            outputs.append((name, path))
+    try:
+        results = bench(outputs, opts.runs, opts.timeout)
+    finally:
+        if tmp:
+            for _, path in outputs:
+                os.remove(path)
+            os.rmdir(tmp)
+    save('prompt', results, opts.out, '', lines=opts.lines, runs=opts.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+# encoding: utf-8
+"""
+SNMP v2c agent stand-in with large synthetic tables, for the snmp worker
+
+Answers GET, GETNEXT and GETBULK for --devices addresses from --first
+on (127.1.0.1 and up by default, all on the loopback), each with its own
+UDP socket, so replies come from the address asked. Every device serves
+the same MIB, only sysName (sim-x-y-z for 127.x.y.z) differs:
+
+    system        1.3.6.1.2.1.1        sysDescr ... sysName
+    ifTable       1.3.6.1.2.1.2.2.1    --rows interfaces, 10 columns
+    ifXTable      1.3.6.1.2.1.31.1.1.1 ifName, ifHCIn/OutOctets
+    ipNetToMedia  1.3.6.1.2.1.4.22.1   --arp-rows ARP entries
+
+Requests with another community than --community are ignored, like a
+real agent does. --delay seconds are added to every reply and --loss of
+the requests are dropped.
+
+    python bench/snmp_agent.py --devices=1000 --rows=10000 --port=1161
+"""
+
+import asyncio
+import bisect
+import ipaddress
+import random
+import resource
+import time
+
+from pyasn1.codec.ber import decoder, encoder
+from pysnmp.proto import api, rfc1902, rfc1905
+from tornado import options
+
+P_MOD = api.protoModules[api.protoVersion2c]
+
+SYSTEM = (1, 3, 6, 1, 2, 1, 1)
+IF_ENTRY = (1, 3, 6, 1, 2, 1, 2, 2, 1)
+IFX_ENTRY = (1, 3, 6, 1, 2, 1, 31, 1, 1, 1)
+ARP_ENTRY = (1, 3, 6, 1, 2, 1, 4, 22, 1)
+SYS_NAME = SYSTEM + (5, 0)
+SYS_UPTIME = SYSTEM + (3, 0)
+
+MAX_BINDS = 1000  # of a GETBULK reply, keeps it in one datagram
+
+
+def build_mib(rows, arp_rows):
+    """Sorted OIDs and their (type, value), the same for every device"""
+    mib = {
+        SYSTEM + (1, 0): (rfc1902.OctetString, 'Cisco IOS Software, '
+                          'Simulated Agent, Version 15.4(3)M2'),
+        SYSTEM + (2, 0): (rfc1902.ObjectIdentifier,
+                          (1, 3, 6, 1, 4, 1, 9, 1, 1045)),
+        SYS_UPTIME: (rfc1902.TimeTicks, 0),
+        SYSTEM + (4, 0): (rfc1902.OctetString, 'noc@example.com'),
+        SYS_NAME: (rfc1902.OctetString, ''),
+        SYSTEM + (6, 0): (rfc1902.OctetString, 'lab'),
+    }
+    for i in range(1, rows + 1):
+        name = 'GigabitEthernet%d/%d' % (i // 48, i % 48)
+        mac = bytes((0, 0x1b, 0x54, i >> 16 & 255, i >> 8 & 255, i & 255))
+        for column, value in (
+                (1, (rfc1902.Integer32, i)),
+                (2, (rfc1902.OctetString, name)),
+                (3, (rfc1902.Integer32, 6)),  # ethernetCsmacd
+                (4, (rfc1902.Integer32, 1500)),
+                (5, (rfc1902.Gauge32, 1000000000)),
+                (6, (rfc1902.OctetString, mac)),
+                (7, (rfc1902.Integer32, 1)),
+                (8, (rfc1902.Integer32, 1 if i % 10 else 2)),
+                (10, (rfc1902.Counter32, i * 7919 % 4294967296)),
+                (16, (rfc1902.Counter32, i * 1031 % 4294967296))):
+            mib[IF_ENTRY + (column, i)] = value
+        for column, value in (
+                (1, (rfc1902.OctetString, 'Gi%d/%d' % (i // 48, i % 48))),
+                (6, (rfc1902.Counter64, i * 7919 << 20)),
+                (10, (rfc1902.Counter64, i * 1031 << 20))):
+            mib[IFX_ENTRY + (column, i)] = value
+    for i in range(arp_rows):
+        if_index = i % max(rows, 1) + 1
+        ip = (10, i >> 16 & 255, i >> 8 & 255, i & 255)
+        mac = bytes((0, 0x50, 0x56, i >> 16 & 255, i >> 8 & 255, i & 255))
+        for column, value in (
+                (1, (rfc1902.Integer32, if_index)),
+                (2, (rfc1902.OctetString, mac)),
+                (3, (rfc1902.IpAddress, '%d.%d.%d.%d' % ip)),
+                (4, (rfc1902.Integer32, 3))):  # dynamic
+            mib[ARP_ENTRY + (column, if_index) + ip] = value
+    oids = sorted(mib)
+    return oids, [mib[oid] for oid in oids]
+
+
+def tlv(tag, body):
+    """BER tag, length and body"""
+    n = len(body)
+    if n < 128:
+        return bytes((tag, n)) + body
+    length = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return bytes((tag, 0x80 | len(length))) + length + body
+
+
+def encode_bind(oid, value):
+    return tlv(0x30, encoder.encode(rfc1902.ObjectName(oid)) +
+               encoder.encode(value))
+
+
+class Agent(object):
+    """
+    The MIB and the faults, shared by all devices
+
+    Requests are decoded by pysnmp, replies are put together from var
+    binds encoded once, pyasn1 being too slow to build thousands of
+    them per second.
+    """
+
+    def __init__(self, opts):
+        self.oids, self.values = build_mib(opts.rows, opts.arp_rows)
+        self.encoded = {}  # index in oids -> var bind, static ones
+        self.community = opts.community.encode()
+        self.delay = opts.delay
+        self.loss = opts.loss
+        self.started = time.time()
+        self.random = random.Random(opts.seed)
+        self.requests = 0
+
+    def bind(self, i, name):
+        """Encoded var bind of the OID at index i"""
+        oid = self.oids[i]
+        if oid == SYS_NAME:
+            return encode_bind(oid, rfc1902.OctetString(name))
+        if oid == SYS_UPTIME:
+            return encode_bind(oid, rfc1902.TimeTicks(
+                int((time.time() - self.started) * 100)))
+        encoded = self.encoded.get(i)
+        if encoded is None:
+            kind, value = self.values[i]
+            encoded = self.encoded[i] = encode_bind(oid, kind(value))
+        return encoded
+
+    def get(self, oid, name):
+        i = bisect.bisect_left(self.oids, oid)
+        if i < len(self.oids) and self.oids[i] == oid:
+            return oid, self.bind(i, name)
+        return oid, encode_bind(oid, rfc1905.noSuchInstance)
+
+    def next(self, oid, name):
+        """Next OID and its var bind, None as var bind past the end"""
+        i = bisect.bisect_right(self.oids, oid)
+        if i < len(self.oids):
+            return self.oids[i], self.bind(i, name)
+        return oid, None
+
+    def reply(self, data, name):
+        """Encoded response to a request, None to stay silent"""
+        try:
+            message, _ = decoder.decode(data, asn1Spec=P_MOD.Message())
+        except Exception:
+            return None
+        community = bytes(P_MOD.apiMessage.getCommunity(message))
+        if community != self.community:
+            return None
+        request = P_MOD.apiMessage.getPDU(message)
+        oids = [tuple(oid) for oid, _ in P_MOD.apiPDU.getVarBinds(request)]
+        if request.isSameTypeWith(P_MOD.GetRequestPDU()):
+            binds = [self.get(oid, name) for oid in oids]
+        elif request.isSameTypeWith(P_MOD.GetNextRequestPDU()):
+            binds = [self.next(oid, name) for oid in oids]
+        elif request.isSameTypeWith(P_MOD.GetBulkRequestPDU()):
+            binds = self.bulk(
+                oids, int(P_MOD.apiBulkPDU.getNonRepeaters(request)),
+                int(P_MOD.apiBulkPDU.getMaxRepetitions(request)), name)
+        else:
+            return None
+        binds = b''.join(
+            bind or encode_bind(oid, rfc1905.endOfMibView)
+            for oid, bind in binds)
+        request_id = int(P_MOD.apiPDU.getRequestID(request))
+        pdu = tlv(0xa2, encoder.encode(rfc1902.Integer32(request_id)) +
+                  b'\x02\x01\x00\x02\x01\x00' +  # no error, index 0
+                  tlv(0x30, binds))
+        return tlv(0x30, b'\x02\x01\x01' +  # version 2c
+                   encoder.encode(rfc1902.OctetString(community)) + pdu)
+
+    def bulk(self, oids, non_repeaters, max_repetitions, name):
+        binds = [self.next(oid, name) for oid in oids[:non_repeaters]]
+        last = oids[non_repeaters:]
+        for _ in range(max_repetitions):
+            if not last or len(binds) + len(last) > MAX_BINDS:
+                break
+            row = [self.next(oid, name) for oid in last]
+            binds.extend(row)
+            if all(bind is None for _, bind in row):
+                break
+            last = [oid for oid, _ in row]
+        return binds
+
+
+class Device(asyncio.DatagramProtocol):
+
+    def __init__(self, agent, ip):
+        self.agent = agent
+        self.name = 'sim-%s' % '-'.join(ip.split('.')[1:])
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        agent = self.agent
+        agent.requests += 1
+        if agent.loss and agent.random.random() < agent.loss:
+            return
+        reply = agent.reply(data, self.name)
+        if reply is None:
+            return
+        if agent.delay:
+            asyncio.get_event_loop().call_later(
+                agent.delay, self.transport.sendto, reply, addr)
+        else:
+            self.transport.sendto(reply, addr)
+
+
+def main():
+    options.define("first", default='127.1.0.1', type=str,
+                   help="address of the first device")
+    options.define("devices", default=100, type=int)
+    options.define("port", default=1161, type=int)
+    options.define("community", default='public', type=str)
+    options.define("rows", default=10000, type=int,
+                   help="interfaces of ifTable and ifXTable")
+    options.define("arp_rows", default=10000, type=int,
+                   help="entries of ipNetToMediaTable")
+    options.define("delay", default=0.0, type=float,
+                   help="seconds before every reply")
+    options.define("loss", default=0.0, type=float,
+                   help="share of requests dropped")
+    options.define("seed", default=None, type=int)
+    options.parse_command_line()
+    opts = options.options
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    agent = Agent(opts)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    first = ipaddress.ip_address(opts.first)
+    for n in range(opts.devices):
+        ip = str(first + n)
+        loop.run_until_complete(loop.create_datagram_endpoint(
+            lambda ip=ip: Device(agent, ip), local_addr=(ip, opts.port)))
+    print('%d devices from %s, port %d, %d OIDs each' % (
+        opts.devices, first, opts.port, len(agent.oids)))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
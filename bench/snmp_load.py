@@ -0,0 +1,137 @@
+# encoding: utf-8
+"""
+SNMP polling capacity through HTTP, the server, the broker and the worker
+
+Starts bench/snmp_agent.py, a server and the snmp worker, then runs
+get, walk and bulk_walk requests spread over the simulated devices, each
+with the concurrency levels asked. Reported as in bench/load.py, plus
+var binds (get) or table rows (walks) per second and the devices one
+poll of this kind covers per --interval:
+
+    python bench/snmp_load.py --devices=1000 --rows=1000 \\
+        --operate=get,bulk_walk --concurrency=10,50 --interval=300
+"""
+
+import ipaddress
+import json
+import os
+import subprocess
+import sys
+
+from tornado import gen, ioloop, options
+
+from load import ROOT, Server, run, save, wait_ready
+
+OIDS = dict(  # operate -> default OIDs
+    get=['1.3.6.1.2.1.1.1.0', '1.3.6.1.2.1.1.3.0', '1.3.6.1.2.1.1.5.0'],
+    walk=['1.3.6.1.2.1.2.2.1.2'],  # ifDescr
+    bulk_walk=['1.3.6.1.2.1.2.2.1.10'],  # ifInOctets
+)
+
+
+class Agent(object):
+    """bench/snmp_agent.py, until the with block is left"""
+
+    def __init__(self, opts):
+        self.args = ['--%s=%s' % (name, getattr(opts, name)) for name in (
+            'first', 'devices', 'community', 'rows', 'delay', 'loss')]
+        self.args += ['--arp_rows=%d' % opts.rows,
+                      '--port=%d' % opts.agent_port]
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'bench', 'snmp_agent.py')] +
+            self.args, stdout=subprocess.PIPE)
+        print(self.process.stdout.readline().decode().strip())  # listening
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+
+
+def snmp_request(opts, operate):
+    first = ipaddress.ip_address(opts.first)
+    commands = dict(operate=operate,
+                    oids=OIDS[operate],
+                    port=opts.agent_port,
+                    timeout=opts.timeout,
+                    retries=opts.retries,
+                    max_repetitions=opts.max_repetitions)
+
+    def request(i):
+        return '/api/v1/sync/snmp', dict(ip=str(first + i % opts.devices),
+                                         community=opts.community,
+                                         commands=commands)
+    return request
+
+
+def count(reply):
+    return len(reply.get('output', ()))
+
+
+@gen.coroutine
+def bench():
+    opts = options.options
+    results = []
+    with Agent(opts):
+        for name in opts.servers.split(','):
+            with Server(name, 'snmp', opts.t, opts.p, 'snmp') as server:
+                yield wait_ready(server)
+                # every worker thread loads the MIBs of its SNMP engine once
+                yield run(server, opts.t, opts.t * 3,
+                          snmp_request(opts, 'get'))
+                for operate in opts.operate:
+                    for concurrency in opts.concurrency:
+                        result = yield run(server, concurrency, opts.requests,
+                                           snmp_request(opts, operate), count)
+                        result['operate'] = operate
+                        result['devices_per_interval'] = int(
+                            result['throughput'] * opts.interval)
+                        print(json.dumps(result))
+                        results.append(result)
+    raise gen.Return(results)
+
+
+def main():
+    options.define("servers", default='callback', type=str,
+                   help="callback, thread and/or async")
+    options.define("t", default=10, help="snmp worker threads", type=int)
+    options.define("p", default=8089, help="server port", type=int)
+    options.define("operate", default=['get', 'walk', 'bulk_walk'], type=str,
+                   multiple=True, help="SNMP operations, comma separated")
+    options.define("concurrency", default=[10, 50], type=int, multiple=True)
+    options.define("requests", default=500, type=int, help="per run")
+    options.define("interval", default=300, type=int,
+                   help="polling interval, seconds, for the device count")
+    options.define("first", default='127.1.0.1', type=str,
+                   help="address of the first simulated device")
+    options.define("devices", default=100, type=int)
+    options.define("agent_port", default=1161, type=int)
+    options.define("community", default='public', type=str)
+    options.define("rows", default=1000, type=int,
+                   help="rows of ifTable and the ARP table of the agent")
+    options.define("delay", default=0.0, type=float,
+                   help="seconds before every agent reply")
+    options.define("loss", default=0.0, type=float,
+                   help="share of requests the agent drops")
+    options.define("timeout", default=5, type=int, help="SNMP timeout")
+    options.define("retries", default=1, type=int)
+    options.define("max_repetitions", default=25, type=int)
+    options.define("out", default='', type=str,
+                   help="result file, by default "
+                        "bench/results/snmp-<commit>-<time>.json")
+    options.define("baseline", default='', type=str,
+                   help="result file to compare with")
+    options.parse_command_line()
+    opts = options.options
+
+    results = ioloop.IOLoop.current().run_sync(bench)
+    save('snmp', results, opts.out, opts.baseline, threads=opts.t,
+         devices=opts.devices, rows=opts.rows, delay=opts.delay,
+         loss=opts.loss)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# encoding: utf-8
+"""
+Cost of relaying worker replies through the broker, copying vs zero-copy
+
+A worker -> broker -> client chain over tcp, shaped like server_thread:
+the broker routes between two ROUTER sockets and the client turns the
+reply into an HTTP body. Each mode runs in its own process, which
+reports CPU seconds and peak RSS per GB relayed.
+
+    copy: recv_multipart/send_multipart, recv_string, str -> bytes
+    zero: copy=False frames all the way, a memoryview as the body
+
+    python bench/zero_copy.py --size=10 --total=2
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+from threading import Thread
+
+import zmq
+from tornado import options
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+
+def worker(ctx, endpoint, size):
+    s = ctx.socket(zmq.DEALER)
+    s.setsockopt(zmq.IDENTITY, b'w')
+    s.connect(endpoint)
+    payload = b'A' * size
+    while True:
+        envelope = s.recv_multipart()[:-1]
+        s.send_multipart(envelope + [payload], copy=False)
+
+
+def broker(ctx, frontend, backend, copy):
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(backend, zmq.POLLIN)
+    while True:
+        socks = dict(poller.poll())
+        if frontend in socks:
+            frames = frontend.recv_multipart(copy=copy)
+            backend.send_multipart([b'w'] + frames, copy=copy)
+        if backend in socks:
+            frames = backend.recv_multipart(copy=copy)
+            frontend.send_multipart(frames[1:], copy=copy)
+
+
+def run(mode, size, total):
+    copy = mode == 'copy'
+    ctx = zmq.Context()
+    frontend = ctx.socket(zmq.ROUTER)
+    backend = ctx.socket(zmq.ROUTER)
+    f_port = frontend.bind_to_random_port('tcp://127.0.0.1')
+    b_port = backend.bind_to_random_port('tcp://127.0.0.1')
+    for target, args in ((worker, ('tcp://127.0.0.1:%d' % b_port, size)),
+                         (broker, (frontend, backend, copy))):
+        t = Thread(target=target, args=(ctx,) + args)
+        t.daemon = True
+        t.start()
+    client = ctx.socket(zmq.DEALER)
+    client.connect('tcp://127.0.0.1:%d' % f_port)
+
+    def relay():
+        client.send_multipart([b'', b'{}'])
+        if copy:
+            _, body = client.recv_multipart()
+            body = body.decode().encode()  # recv_string, then write(str)
+        else:
+            _, body = client.recv_multipart(copy=False)
+            body = memoryview(body)
+        return len(body)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    relay()  # connected and warmed up
+    cpu, start = time.process_time(), time.time()
+    relayed = 0
+    while relayed < total:
+        relayed += relay()
+    cpu, elapsed = time.process_time() - cpu, time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    gb = relayed / float(GB)
+    return dict(mode=mode,
+                gb=round(gb, 3),
+                cpu_s_per_gb=round(cpu / gb, 3),
+                seconds_per_gb=round(elapsed / gb, 3),
+                peak_rss_growth_mb=round(peak / 1024.0, 1))  # KB on Linux
+
+
+def main():
+    options.define("size", default=10, help="reply size, MB", type=int)
+    options.define("total", default=2, help="data relayed, GB", type=float)
+    options.define("mode", default='', help="copy or zero (internal)",
+                   type=str)
+    options.parse_command_line()
+    size = options.options.size * MB
+    total = int(options.options.total * GB)
+    if options.options.mode:
+        print(json.dumps(run(options.options.mode, size, total)))
+        return
+    results = {}
+    for mode in ('copy', 'zero'):
+        out = subprocess.check_output(
+            [sys.executable, __file__, '--mode=%s' % mode,
+             '--size=%d' % options.options.size,
+             '--total=%s' % options.options.total])
+        results[mode] = json.loads(out.decode().strip().splitlines()[-1])
+        print(json.dumps(results[mode]))
+    copy, zero = results['copy'], results['zero']
+    print('Saved per GB relayed: %.3f CPU seconds (%.0f%%), '
+          '%.1f MB peak RSS' % (
+              copy['cpu_s_per_gb'] - zero['cpu_s_per_gb'],
+              100 * (1 - zero['cpu_s_per_gb'] / copy['cpu_s_per_gb']),
+              copy['peak_rss_growth_mb'] - zero['peak_rss_growth_mb']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import hashlib
+import logging
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+
+__author__ = 'zhutong'
+
+FORWARDED_HEADER = 'X-CC-Forwarded'
+
+
+class Cluster(object):
+    """
+    HTTP nodes of a multi-node command center
+
+    Every node is given the same node list. Devices are partitioned
+    across the live nodes by rendezvous hashing, so every request for a
+    device ends up on one node (its session limit and cache hold), and
+    losing a node only moves the devices it owned. Task ids start with
+    the index of the node holding the task.
+    """
+
+    def __init__(self, nodes, me):
+        self.nodes = nodes  # 'host:port' of every node
+        self.me = me
+        self.index = nodes.index(me)
+        self.down = set()
+
+    def owner(self, device):
+        best, best_score = self.me, None
+        for node in self.nodes:
+            if node in self.down:
+                continue
+            score = hashlib.md5(('%s/%s' % (node, device)).encode()).digest()
+            if best_score is None or score > best_score:
+                best, best_score = node, score
+        return best
+
+    def task_id(self, uuid_hex):
+        return '%02x%s' % (self.index, uuid_hex[2:])
+
+    def node_of(self, task_id):
+        try:
+            return self.nodes[int(task_id[:2], 16)]
+        except (ValueError, IndexError):
+            return self.me
+
+    @staticmethod
+    def url(node, path):
+        return 'http://%s%s' % (node, path)
+
+    @gen.coroutine
+    def check(self):
+        """Mark peers down or up by pinging them"""
+        client = AsyncHTTPClient()
+        for node in self.nodes:
+            if node == self.me:
+                continue
+            try:
+                yield client.fetch(self.url(node, '/api/v1/cluster'),
+                                   request_timeout=2)
+                if node in self.down:
+                    logging.info('Cluster node %s up', node)
+                    self.down.discard(node)
+            except Exception as e:
+                if node not in self.down:
+                    logging.warning('Cluster node %s down: %s', node, e)
+                    self.down.add(node)
+
+    @property
+    def status(self):
+        return dict(me=self.me,
+                    nodes=dict((n, n not in self.down) for n in self.nodes))
@@ -0,0 +1,28 @@
+import zlib
+
+__author__ = 'zhutong'
+
+# Workers gzip replies bigger than the size the server offers in the task
+# ('compress' field). A JSON reply never starts with the gzip magic bytes.
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+# Replies are bytes or zmq.Frame, see frames.py
+
+
+def is_gzip(payload):
+    return memoryview(payload)[:2] == GZIP_MAGIC
+
+
+def head(payload, size):
+    """First size bytes of a reply, compressed or not"""
+    if not is_gzip(payload):
+        return bytes(memoryview(payload)[:size])
+    return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(payload, size)
+
+
+def inflate(payload):
+    """Reply as plain bytes"""
+    if not is_gzip(payload):
+        return bytes(payload)
+    return zlib.decompress(payload, 16 + zlib.MAX_WBITS)
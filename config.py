@@ -2,10 +2,54 @@ PORT_DAEMON_SOCKET_PORT = 16000  # Change this should modify worker_base.py manu
 CLIENT_SOCKET_PORT = PORT_DAEMON_SOCKET_PORT + 1
 WORKER_START_SOCKET_PORT = PORT_DAEMON_SOCKET_PORT + 10
 
+# Worker processes heartbeat every HEARTBEAT_INTERVAL seconds, keep in sync
+# with worker_base.py, and are dropped after HEARTBEAT_LIVENESS misses
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_LIVENESS = 3
+
+# Workers gzip task replies from this size on, passed through to clients
+# accepting gzip, 0 to disable
+COMPRESS_MIN_BYTES = 64 * 1024
+
+# Wire formats of worker replies, preferred first: orjson is JSON on the
+# wire, msgpack (if installed) is converted to JSON by the server
+WIRE_FORMATS = ('orjson', 'msgpack', 'json')
+
+# Cluster mode: requests relayed to other nodes at the same time
+CLUSTER_MAX_RELAYS = 1000
+
 # Used for threading pool mode only
 MAX_WORKERS = 400
 PULLER_TIMEOUT = 2 * 3600 * 1000  # 2 hours
 
+# Used for callback mode only
+TASK_TIMEOUT = 2 * 3600  # seconds, default deadline of a task
+
+# Results of /api/v1/async/ tasks
+RESULT_TTL = 3600  # seconds
+RESULT_STORE_MAX_BYTES = 512 * 1024 * 1024
+RESULT_SPILL_DIR = ''  # spill results pushed out by size here if set
+RESULT_MAX_WAIT = 300  # seconds a poll with ?wait= may be held
+
+# Output cache for requests given a max_age
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Max concurrent sessions to one device, 0 for no limit. Counts running
+# tasks: each worker process may also keep one idle session per device
+# for reuse (workers/modules/session_pool.py), on top of this limit
+MAX_SESSIONS_PER_DEVICE = 2
+MAX_SESSIONS_PER_CHANNEL = dict(  # overrides for devices of a channel
+    test=0,
+    snmp=0,
+    f5=1,
+)
+
+# Priority classes of requests, highest first
+PRIORITY_CLASSES = ('interactive', 'normal', 'bulk')
+DEFAULT_PRIORITY = 'normal'
+PRIORITY_WEIGHTS = dict(interactive=8, normal=4, bulk=1)  # None for strict
+INTERACTIVE_RESERVED_SHARE = 0.1  # of each channel's workers
+
 DEVICE_LIST_URL = "http://127.0.0.1:9116/apps/device_center/api/get_device_list"
 
 worker_channel = '''
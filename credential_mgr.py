@@ -36,6 +36,7 @@ class CredentialManager(Thread):
     device_dict = {}
     device_list = []
     renew_interval = 3600
+    synced_at = 0  # time of the last successful pull
 
     def query(self, q):
         if not q:
@@ -202,6 +203,7 @@ class CredentialManager(Thread):
                         self.delete_all()
                         self.create_m(data.get('devices', []))
                         self.save()
+                        self.synced_at = time.time()
                 time.sleep(self.renew_interval)
             except Exception as e:
                 self.__load()
@@ -0,0 +1,331 @@
+import json
+import logging
+import time
+from collections import deque
+
+import zmq
+
+__author__ = 'zhutong'
+
+# Worker -> server commands, keep in sync with workers/modules/worker_base.py
+W_HEARTBEAT = b'HEARTBEAT'  # [HEARTBEAT, json]: process state, see on_worker
+W_REPLY = b'REPLY'  # [REPLY, envelope..., payload]: task done, one credit back
+W_PART = b'PART'  # [PART, envelope..., payload]: partial output of a task
+
+WORKER_LOST = json.dumps(dict(status='fail', message='worker lost')).encode()
+
+
+class Dispatcher(object):
+    """
+    Credit based routing for one worker backend (a bound ROUTER socket)
+
+    Worker processes heartbeat the free slots of their worker sockets,
+    which become credits, and every REPLY gives one credit back. A task
+    is only sent to a worker holding a credit, so no task waits behind a
+    busy thread while another one is idle. Tasks are queued here when
+    every worker is busy.
+
+    A process missing its heartbeats for expiry seconds is dropped with
+    its credits. Its running tasks are queued again when submitted as
+    idempotent, otherwise they fail with a 'worker lost' reply. A process
+    about to exit heartbeats as stopping: its credits are dropped at
+    once, it only finishes the tasks it has.
+
+    Tasks are queued per device, any hashable key given by the caller,
+    which also gives its session limit. A device with a limit only gets
+    a worker while it has fewer tasks running than its limit, tasks
+    abandoned past their deadline included: the worker still holds
+    their session. Devices with queued tasks take turns for free
+    workers, so one busy device neither exhausts its own vty lines nor
+    starves the others.
+
+    Every task has a priority class. Free workers go to the highest
+    class with work (strict), or to classes in proportion of their
+    weights (smooth weighted round robin). A share of the workers can be
+    kept for the first class: other classes only start a task while
+    more workers than that share are idle.
+
+    A task is a list of frames: the envelope ending with an empty frame,
+    followed by the payload. Workers echo the envelope in their reply.
+    Envelope frames are bytes, a payload may be a zmq.Frame, which is
+    forwarded without being copied.
+    Queued tasks for which alive(task) is false are dropped unsent.
+
+    stats (metrics.BackendStats) gets the queue wait of every task, the
+    worker counters sent with heartbeats and the tasks lost. on_sent is
+    called with the envelope of every task sent to a worker.
+    """
+
+    def __init__(self, socket, alive=None, classes=('normal',),
+                 default='normal', weights=None, reserved_share=0,
+                 expiry=15, stats=None, on_sent=None):
+        socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.socket = socket
+        self.alive = alive
+        self.classes = classes  # priority classes, highest first
+        self.default = default
+        self.weights = weights  # class -> weight, strict priority if None
+        self.reserved_share = reserved_share
+        self.expiry = expiry  # seconds without heartbeat
+        self.stats = stats
+        self.on_sent = on_sent
+        self.current = dict.fromkeys(classes, 0)  # weighted round robin
+        self.processes = {}  # process id -> heartbeat state
+        self.ready = deque()  # worker ids, one entry per credit
+        self.credits = {}  # worker id -> entries in ready
+        self.stopping = set()  # worker ids of processes about to exit
+        self.queues = {}  # (class, device) -> tasks waiting for a credit
+        self.runnable = dict((c, deque()) for c in classes)  # devices
+        self.scheduled = set()  # (class, device) in runnable
+        self.limits = {}  # device -> max sessions, 0 for no limit
+        self.sessions = {}  # device -> tasks running
+        self.busy = dict.fromkeys(classes, 0)  # class -> tasks running
+        self.running = {}  # envelope -> (key, worker id, task, idempotent)
+        self.abandoned = set()  # envelopes in running past their deadline
+        self.assigned = {}  # worker id -> tasks running
+        self.queued = 0
+
+    @property
+    def threads(self):
+        """Worker threads of live processes"""
+        return sum(p['threads'] for p in self.processes.values())
+
+    def submit(self, task, device=None, limit=0, priority=None,
+               idempotent=False):
+        key = (priority or self.default, device)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+        queue.append((task, idempotent, time.time()))
+        self.queued += 1
+        self.limits[device] = limit
+        self.__schedule(key)
+        self.__pump()
+
+    def on_worker(self, message):
+        """
+        Handle a message from a worker
+
+        Return (envelope + payload, done) for task output, (None, False)
+        otherwise. done is False for the partial output of a task.
+
+        A heartbeat is sent from its own socket of a worker process:
+        {"threads": n, "busy": n, "workers": {worker id: free slots},
+         "metrics": running totals, see metrics.BackendStats,
+         "stopping": true once draining before exit}
+        """
+        worker_id, command = message[0], message[1]
+        if command == W_REPLY:
+            self.__finish(tuple(message[2:-1]))
+            if worker_id not in self.stopping:
+                self.__add_credit(worker_id)
+            self.__pump()
+            return message[2:], True
+        elif command == W_PART:
+            return message[2:], False
+        elif command == W_HEARTBEAT:
+            self.__heartbeat(worker_id, json.loads(bytes(message[2])))
+            self.__pump()
+        else:
+            logging.warning('Unknown worker command: %s', command)
+        return None, False
+
+    def abandon(self, envelope):
+        """
+        A running task past its deadline: its client is gone, but the
+        worker is still logged in to the device. The task keeps its
+        device session until the worker replies or its process is swept.
+        """
+        envelope = tuple(envelope)
+        if envelope in self.running:
+            self.abandoned.add(envelope)
+
+    def sweep(self, now=None):
+        """
+        Drop processes missing heartbeats, return failed replies
+        (envelope + payload) for their running tasks not idempotent
+        """
+        now = now or time.time()
+        replies = []
+        for process_id, p in list(self.processes.items()):
+            if p['expire'] > now:
+                continue
+            if p.get('stopping'):
+                logging.info('Worker process %s left', process_id)
+            else:
+                logging.warning('Worker process %s lost', process_id)
+            del self.processes[process_id]
+            if self.stats:
+                self.stats.forget(process_id)
+            lost = set(p['workers'])
+            for worker_id in lost:
+                self.credits.pop(worker_id, None)
+            self.stopping -= lost
+            self.ready = deque(w for w in self.ready if w not in lost)
+            for envelope, (key, worker_id, task, idempotent) in list(
+                    self.running.items()):
+                if worker_id not in lost:
+                    continue
+                if envelope in self.abandoned:  # no client to answer
+                    pass
+                elif idempotent:  # queued first, so the device keeps its limit
+                    logging.info('Requeue task %s', envelope)
+                    self.queues.setdefault(key, deque()).appendleft(
+                        (task, idempotent, now))
+                    self.queued += 1
+                else:
+                    replies.append(list(envelope) + [WORKER_LOST])
+                    if self.stats:
+                        self.stats.lost += 1
+                self.__finish(envelope)
+        self.__pump()  # requeued tasks to the credits of other workers
+        return replies
+
+    def __heartbeat(self, process_id, state):
+        p = self.processes.get(process_id)
+        if p is None:
+            logging.info('Worker process %s joined, %d threads',
+                         process_id, state['threads'])
+            p = self.processes[process_id] = dict(workers=set())
+        p['expire'] = time.time() + self.expiry
+        p['threads'] = state['threads']
+        p['busy'] = state['busy']
+        if self.stats:
+            self.stats.update(process_id, state.get('metrics'))
+        if state.get('stopping'):
+            if not p.get('stopping'):
+                logging.info('Worker process %s stopping', process_id)
+                p['stopping'] = True
+            p['threads'] = 0  # no capacity any more
+            workers = set(w.encode() for w in state['workers'])
+            p['workers'].update(workers)
+            self.stopping.update(workers)
+            for worker_id in workers:
+                self.credits.pop(worker_id, None)
+            self.ready = deque(w for w in self.ready if w not in workers)
+            return
+        for worker_id, free in state['workers'].items():
+            worker_id = worker_id.encode()
+            p['workers'].add(worker_id)
+            # a credit given back or a task sent may still be on the way
+            known = self.credits.get(worker_id, 0) + \
+                self.assigned.get(worker_id, 0)
+            for _ in range(free - known):
+                self.__add_credit(worker_id)
+
+    def __add_credit(self, worker_id):
+        self.ready.append(worker_id)
+        self.credits[worker_id] = self.credits.get(worker_id, 0) + 1
+
+    def __finish(self, envelope):
+        if envelope not in self.running:
+            return
+        key, worker_id, _, _ = self.running.pop(envelope)
+        self.abandoned.discard(envelope)
+        priority, device = key
+        self.busy[priority] -= 1
+        n = self.assigned[worker_id] - 1
+        if n:
+            self.assigned[worker_id] = n
+        else:
+            del self.assigned[worker_id]
+        n = self.sessions[device] - 1
+        if n:
+            self.sessions[device] = n
+        else:
+            del self.sessions[device]
+            self.__forget(device)
+        for c in self.classes:
+            self.__schedule((c, device))
+
+    def __forget(self, device):
+        if device in self.sessions:
+            return
+        for c in self.classes:
+            if (c, device) in self.queues:
+                return
+        del self.limits[device]
+
+    def __schedule(self, key):
+        if key in self.scheduled or not self.queues.get(key):
+            return
+        priority, device = key
+        limit = self.limits[device]
+        if limit and self.sessions.get(device, 0) >= limit:
+            return
+        self.runnable[priority].append(device)
+        self.scheduled.add(key)
+
+    def __next_class(self):
+        classes = [c for c in self.classes if self.runnable[c]]
+        if not classes:
+            return None
+        if self.reserved_share:
+            capacity = len(self.ready) + len(self.running)
+            top = self.classes[0]
+            reserved = int(capacity * self.reserved_share) - self.busy[top]
+            if len(self.ready) <= reserved:
+                classes = [c for c in classes if c == top]
+                if not classes:
+                    return None
+        if not self.weights:
+            return classes[0]
+        current = self.current
+        for c in classes:
+            current[c] += self.weights[c]
+        best = max(classes, key=lambda c: current[c])
+        current[best] -= sum(self.weights[c] for c in classes)
+        return best
+
+    def __pump(self):
+        while self.ready:
+            priority = self.__next_class()
+            if priority is None:
+                return
+            device = self.runnable[priority].popleft()
+            key = (priority, device)
+            self.scheduled.discard(key)
+            queue = self.queues[key]
+            task, idempotent, queued_at = queue.popleft()
+            self.queued -= 1
+            if not self.alive or self.alive(task):
+                worker_id = self.__send(task)
+                if worker_id is None:  # no live worker left
+                    queue.appendleft((task, idempotent, queued_at))
+                    self.queued += 1
+                    self.__schedule(key)
+                    return
+                if self.stats:
+                    self.stats.phases['queue_wait'].observe(
+                        time.time() - queued_at)
+                envelope = tuple(task[:-1])
+                if self.on_sent:
+                    self.on_sent(envelope)
+                self.running[envelope] = (key, worker_id, task, idempotent)
+                self.assigned[worker_id] = self.assigned.get(worker_id, 0) + 1
+                self.sessions[device] = self.sessions.get(device, 0) + 1
+                self.busy[priority] += 1
+            if queue:
+                self.__schedule(key)
+            else:
+                del self.queues[key]
+                self.__forget(device)
+
+    def __send(self, task):
+        while self.ready:
+            worker_id = self.ready.popleft()
+            n = self.credits.get(worker_id, 1) - 1
+            if n > 0:
+                self.credits[worker_id] = n
+            else:
+                self.credits.pop(worker_id, None)
+            try:
+                self.socket.send_multipart([worker_id] + task)
+                return worker_id
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                logging.warning('Worker %s gone, drop its credits', worker_id)
+                self.ready = deque(w for w in self.ready if w != worker_id)
+                self.credits.pop(worker_id, None)
+        return None
@@ -0,0 +1,23 @@
+__author__ = 'zhutong'
+
+
+def split(frames):
+    """
+    Frames received with copy=False: the small routing frames as bytes,
+    the payload (last frame) kept as a zmq.Frame, so a reply of many MB
+    is never copied on its way from the worker to the HTTP client.
+    """
+    return [f.bytes for f in frames[:-1]] + frames[-1:]
+
+
+def write_body(handler, payload):
+    """
+    Send a payload (bytes or zmq.Frame) as the whole response body
+
+    RequestHandler.write() only takes bytes, so the buffer goes straight
+    to the HTTP connection after the headers. The caller still finishes
+    the request.
+    """
+    handler.set_header('Content-Length', len(payload))
+    handler.flush()
+    handler.request.connection.write(memoryview(payload))
@@ -0,0 +1,153 @@
+import time
+from bisect import bisect_left
+
+__author__ = 'zhutong'
+
+# Upper bounds in seconds, keep in sync with worker_base.py of the workers
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+
+PHASES = ('queue_wait', 'login', 'execute', 'relay')
+
+
+class Histogram(object):
+    """Fixed buckets, observe() is a bisect and two additions"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def add(self, counts, total):
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.sum += total
+
+    def lines(self, name, labels):
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        n = 0
+        for bound, count in zip(bounds, self.counts):
+            n += count
+            yield '%s_bucket{%s,le="%s"} %d' % (name, labels, bound, n)
+        yield '%s_sum{%s} %s' % (name, labels, repr(self.sum))
+        yield '%s_count{%s} %d' % (name, labels, n)
+
+
+class BackendStats(object):
+    """
+    Counters of one worker backend, updated by its Dispatcher
+
+    Login and execution times and error codes are counted by the worker
+    processes and sent in their heartbeats as running totals. Only the
+    increase since the last heartbeat is added here, so nothing is lost
+    when a process goes away.
+    """
+
+    def __init__(self, channels):
+        self.labels = 'channels="%s"' % ','.join(channels)
+        self.phases = dict((p, Histogram()) for p in PHASES)
+        self.errors = {}  # error code -> tasks failed
+        self.lost = 0
+        self.last = {}  # process id -> totals of its last heartbeat
+
+    def update(self, process_id, totals):
+        if not totals:
+            return
+        last = self.last.get(process_id, {})
+        for phase in ('login', 'execute'):
+            new = totals.get(phase)
+            if not new:
+                continue
+            old = last.get(phase) or dict(counts=[0] * len(new['counts']),
+                                          sum=0.0)
+            self.phases[phase].add(
+                [n - o for n, o in zip(new['counts'], old['counts'])],
+                new['sum'] - old['sum'])
+        old_errors = last.get('errors', {})
+        for code, n in totals.get('errors', {}).items():
+            self.errors[code] = self.errors.get(code, 0) + \
+                n - old_errors.get(code, 0)
+        self.last[process_id] = totals
+
+    def forget(self, process_id):
+        self.last.pop(process_id, None)
+
+
+def render(dispatchers, counters, gauges):
+    """
+    Prometheus text format of the backends (Dispatchers with stats) and
+    of server wide counters and gauges, given as name -> (help, value)
+    """
+    return render_backends(dispatchers) + render_values(counters, gauges)
+
+
+def family(out, name, kind, help_text):
+    out.append('# HELP %s %s' % (name, help_text))
+    out.append('# TYPE %s %s' % (name, kind))
+
+
+def render_backends(dispatchers):
+    """The backends part of render(), in the thread owning them"""
+    out = []
+
+    series = (
+        ('cc_queue_depth', 'Tasks waiting for a worker',
+         lambda d: d.queued),
+        ('cc_tasks_in_flight', 'Tasks sent to a worker, not replied yet',
+         lambda d: len(d.running)),
+        ('cc_worker_threads', 'Worker threads of live processes',
+         lambda d: d.threads),
+        ('cc_worker_threads_busy', 'Worker threads running a task',
+         lambda d: sum(p['busy'] for p in d.processes.values())),
+    )
+    for name, help_text, value in series:
+        family(out, name, 'gauge', help_text)
+        for d in dispatchers:
+            out.append('%s{%s} %d' % (name, d.stats.labels, value(d)))
+
+    family(out, 'cc_task_phase_seconds', 'histogram',
+           'Task latency by phase: queue_wait and relay on the server, '
+           'login and execute on the workers')
+    for d in dispatchers:
+        for phase in PHASES:
+            labels = '%s,phase="%s"' % (d.stats.labels, phase)
+            out.extend(d.stats.phases[phase].lines('cc_task_phase_seconds',
+                                                   labels))
+
+    family(out, 'cc_task_errors_total', 'counter',
+           'Failed tasks by error code, LoginException codes included')
+    for d in dispatchers:
+        for code, n in sorted(d.stats.errors.items()):
+            out.append('cc_task_errors_total{%s,code="%s"} %d' % (
+                d.stats.labels, code, n))
+
+    family(out, 'cc_tasks_lost_total', 'counter',
+           'Tasks whose worker process stopped heartbeating')
+    for d in dispatchers:
+        out.append('cc_tasks_lost_total{%s} %d' % (d.stats.labels,
+                                                   d.stats.lost))
+
+    return '\n'.join(out) + '\n'
+
+
+def render_values(counters, gauges):
+    """The counters and gauges part of render()"""
+    out = []
+    for kind, metrics in (('counter', counters), ('gauge', gauges)):
+        for name, (help_text, value) in sorted(metrics.items()):
+            family(out, name, kind, help_text)
+            out.append('%s %s' % (name, repr(float(value))))
+    return '\n'.join(out) + '\n' if out else ''
+
+
+def credential_gauges(credential):
+    synced_at = credential.synced_at
+    return dict(
+        cc_credential_devices=('Devices in the credential store',
+                               len(credential.device_list)),
+        cc_credential_sync_age_seconds=(
+            'Seconds since the last credential sync, -1 if never',
+            time.time() - synced_at if synced_at else -1))
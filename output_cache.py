@@ -0,0 +1,106 @@
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+
+from compression import head
+
+__author__ = 'zhutong'
+
+
+CREDENTIAL_FIELDS = ('password', 'enable_password', 'community')
+SUCCESS = re.compile(br'\{\s*"status":\s*"success"')
+
+
+def is_success(payload):
+    # workers put status first, no need to parse a big reply
+    return SUCCESS.match(head(payload, 64)) is not None
+
+
+def credentials(device_info):
+    """Digest of the secrets of a request, not kept in clear"""
+    secrets = [device_info.get(k) or '' for k in CREDENTIAL_FIELDS]
+    return hashlib.sha256(json.dumps(secrets).encode()).hexdigest()
+
+
+class OutputCache(object):
+    """
+    LRU cache of task replies for read-only requests
+
+    Keyed by (ip, channel, username, credentials hash, hostname,
+    normalized commands) and bounded by total size: a reply is only
+    served to a request which would have logged in the same way and
+    passed the same hostname check. Each request gives its own max age.
+    inflight maps a key to the task currently collecting it, so
+    identical requests can wait for that task instead of logging in to
+    the device again.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # key -> (stored_at, payload)
+        self.inflight = {}  # key -> task_id
+        self.keys = {}  # task_id -> key
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(device_info, ch):
+        commands = device_info['commands']
+        if isinstance(commands, dict):  # snmp
+            commands = json.dumps(commands, sort_keys=True)
+        else:
+            commands = '\n'.join(re.sub(r'\s+', ' ', c.strip())
+                                 for c in commands)
+        return (device_info['ip'], ch,
+                device_info.get('username', ''), credentials(device_info),
+                device_info.get('hostname', ''), commands)
+
+    def get(self, key, max_age):
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[0] > max_age:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def track(self, key, task_id):
+        self.inflight[key] = task_id
+        self.keys[task_id] = key
+
+    def done(self, task_id, payload=None):
+        """Task of a tracked key finished, cache its reply if succeeded"""
+        key = self.keys.pop(task_id, None)
+        if key is None:
+            return
+        if self.inflight.get(key) == task_id:
+            del self.inflight[key]
+        if payload is not None and is_success(payload):
+            self.put(key, payload)
+
+    def put(self, key, payload):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[1])
+        self.entries[key] = (time.time(), payload)
+        self.size += len(payload)
+        while self.size > self.max_bytes and self.entries:
+            _, (_, old_payload) = self.entries.popitem(last=False)
+            self.size -= len(old_payload)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    @property
+    def stats(self):
+        return dict(entries=len(self.entries),
+                    bytes=self.size,
+                    inflight=len(self.inflight),
+                    hits=self.hits,
+                    misses=self.misses,
+                    coalesced=self.coalesced)
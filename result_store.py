@@ -0,0 +1,85 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+__author__ = 'zhutong'
+
+
+class ResultStore(object):
+    """
+    Results of async tasks, bounded by total size and evicted by TTL
+
+    Results are kept in insertion order, so the oldest ones are evicted
+    first when the store is full, and expired ones are always at the
+    front. With a spill_dir, results pushed out by size are moved to
+    local disk and served from there until they expire.
+    """
+
+    def __init__(self, max_bytes, ttl, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.size = 0
+        self.memory = OrderedDict()  # task_id -> (expire, payload)
+        self.disk = OrderedDict()  # task_id -> expire
+        if spill_dir and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def put(self, task_id, payload):
+        self.memory[task_id] = (time.time() + self.ttl, payload)
+        self.size += len(payload)
+        while self.size > self.max_bytes and len(self.memory) > 1:
+            old_id, (expire, old_payload) = self.memory.popitem(last=False)
+            self.size -= len(old_payload)
+            if self.spill_dir:
+                self.__spill(old_id, expire, old_payload)
+
+    def get(self, task_id):
+        item = self.memory.get(task_id)
+        if item is not None:
+            return item[1]
+        if task_id in self.disk:
+            try:
+                with open(self.__path(task_id), 'rb') as f:
+                    return f.read()
+            except IOError as e:
+                logging.error('Read spilled result %s failed: %s',
+                              task_id, e)
+
+    def sweep(self):
+        """Drop expired results, return how many were dropped"""
+        now = time.time()
+        n = 0
+        while self.memory:
+            task_id, (expire, payload) = next(iter(self.memory.items()))
+            if expire > now:
+                break
+            del self.memory[task_id]
+            self.size -= len(payload)
+            n += 1
+        while self.disk:
+            task_id, expire = next(iter(self.disk.items()))
+            if expire > now:
+                break
+            del self.disk[task_id]
+            try:
+                os.remove(self.__path(task_id))
+            except OSError:
+                pass
+            n += 1
+        return n
+
+    def __len__(self):
+        return len(self.memory) + len(self.disk)
+
+    def __path(self, task_id):
+        return os.path.join(self.spill_dir, task_id + '.json')
+
+    def __spill(self, task_id, expire, payload):
+        try:
+            with open(self.__path(task_id), 'wb') as f:
+                f.write(payload)
+            self.disk[task_id] = expire
+        except IOError as e:
+            logging.error('Spill result %s failed: %s', task_id, e)
@@ -1,23 +1,48 @@
+import ipaddress
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from threading import Thread
 from uuid import uuid4
 
 import zmq
-from tornado import options, web
+from tornado import gen, options, web
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient
 from tornado.log import enable_pretty_logging
+from tornado.ioloop import PeriodicCallback
 from zmq.eventloop import ioloop
 from zmq.eventloop.zmqstream import ZMQStream
 
 from config import *
+from cluster import Cluster, FORWARDED_HEADER
+from compression import inflate, is_gzip
 from credential_mgr import CredentialManager
+from dispatcher import Dispatcher
+from frames import split, write_body
+from metrics import BackendStats, credential_gauges, render
+from output_cache import OutputCache
+from result_store import ResultStore
+from timer_wheel import TimerWheel
+from tracing import TaskTrace, TraceStats, now
+import wire
 
 enable_pretty_logging()
 
 ioloop.install()
 
 context = zmq.Context()
-active_workers = set()
+deadlines = TimerWheel()
+cache = OutputCache(CACHE_MAX_BYTES)
+late_replies = 0
+timeouts = 0
+converter = ThreadPoolExecutor(1)  # msgpack replies to JSON, in order
+converting = 0  # messages in converter, the next ones queued behind
+traces = {}  # task_id -> TaskTrace of tasks dispatched with trace=true
+shared = {}  # task_id of a coalesced request -> task_id it waits for
+trace_stats = TraceStats()
 
 def get_channel_dict():
     channel_dict = {}
@@ -33,86 +58,382 @@ def port_query_daemon():
     rep.bind("tcp://*:%d" % PORT_DAEMON_SOCKET_PORT)
     while True:
         message = rep.recv_string()
-        for c in message.split('::'):
-            port = channel_dict.get(c)
-            if port:
-                active_workers.add(c)
-        rep.send_string(str(port))
-        logging.info('Worker %s connect' % message)
+        channel, wire_format = wire.register(message)
+        ports = [channel_dict[c] for c in channel.split('::')
+                 if c in channel_dict]
+        port = ports[0] if ports else None
+        if not wire_format:  # a worker before wire version 1
+            rep.send_string(str(port))
+        elif port:
+            rep.send_string('%s %s' % (port, wire_format))
+        else:
+            rep.send_string('%s %s' % (wire.UNKNOWN_CHANNEL, channel))
+            logging.warning('Worker %s refused, unknown channel', channel)
+            continue
+        logging.info('Worker %s connect, wire format %s',
+                     channel, wire_format or 'json')
 
 
 def install_backends():
     ctx = zmq.Context.instance()
     for p in set(list(channel_dict.values())):
-        backend = ctx.socket(zmq.DEALER)
+        backend = ctx.socket(zmq.ROUTER)
         backend.bind("tcp://*:%d" % p)
+        channels = sorted(c for c in channel_dict if channel_dict[c] == p)
+        dispatcher = Dispatcher(backend, alive=is_waiting,
+                                classes=PRIORITY_CLASSES,
+                                default=DEFAULT_PRIORITY,
+                                weights=PRIORITY_WEIGHTS,
+                                reserved_share=INTERACTIVE_RESERVED_SHARE,
+                                expiry=HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS,
+                                stats=BackendStats(channels),
+                                on_sent=on_task_sent)
         stream = ZMQStream(backend)
-        stream.on_recv(write_client)
-        backends[p] = backend
+        stream.on_recv(on_worker_message(dispatcher), copy=False)
+        backends[p] = dispatcher
+        streams[p] = stream
+
+
+def recheck(p):
+    """
+    Read the worker messages come in while a task was sent outside the
+    stream callbacks: that send may have taken the edge of the zmq fd,
+    the stream would not hear of them. A process with one socket for
+    many tasks (worker_base.AsyncRuntime) replies in bursts.
+    """
+    ioloop.IOLoop.current().add_callback(streams[p].flush, zmq.POLLIN)
+
+
+def on_worker_message(dispatcher):
+    """
+    Task output of a worker to its client. msgpack is converted to JSON
+    in the converter thread, not to hold the IOLoop on a large reply;
+    while a message is there, the next ones are passed through it too,
+    so partial output of a task never comes after its reply.
+    """
+    relay = dispatcher.stats.phases['relay']
+
+    def deliver(reply, done):
+        if done:
+            start = time.time()
+            write_client(reply)
+            relay.observe(time.time() - start)
+        else:
+            write_output(reply)
+
+    def converted(future, done):
+        global converting
+        converting -= 1
+        deliver(future.result(), done)
+
+    def on_recv(frames):
+        global converting
+        reply, done = dispatcher.on_worker(split(frames))
+        if not reply:
+            return
+        payload = reply[-1]
+        if converting or len(payload) and wire.is_msgpack(payload):
+            converting += 1
+            loop = ioloop.IOLoop.current()
+            loop.add_future(loop.run_in_executor(converter, to_json, reply),
+                            lambda f: converted(f, done))
+        else:
+            deliver(reply, done)
+    return on_recv
+
+
+def to_json(reply):
+    reply[-1] = wire.to_json(reply[-1])
+    return reply
+
+
+def on_task_sent(envelope):
+    if traces:
+        trace = traces.get(envelope[0].decode())
+        if trace is not None:
+            trace.sent = now()
+
+
+def is_waiting(task):
+    return task[0].decode() in clients
+
+
+def expire_tasks():
+    global timeouts
+    results.sweep()
+    for dispatcher in backends.values():
+        for reply in dispatcher.sweep():
+            write_client(reply)
+    for p in streams:
+        recheck(p)
+    for task_id in deadlines.tick():
+        cache.done(task_id)
+        traces.pop(task_id, None)
+        for dispatcher in backends.values():
+            dispatcher.abandon((task_id.encode(), b''))
+        c = clients.pop(task_id, None)
+        if c is None:
+            continue
+        logging.warning("Task timeouted: %s", task_id)
+        timeouts += 1
+        try:
+            c.on_timeout(task_id)
+        except Exception as e:
+            logging.error("Task %s error: %s", task_id, str(e))
+
+
+def write_output(message):
+    task_id, _, payload = message
+    task_id = task_id.decode()
+    payload = bytes(payload)
+    c = clients.get(task_id)
+    if c is None:
+        return
+    try:
+        c.on_output(task_id, payload)
+    except Exception as e:
+        logging.error("Task %s error: %s", task_id, str(e))
 
 
 def write_client(message):
+    global late_replies
     task_id, _, payload = message
+    task_id = task_id.decode()
+    trace = traces.pop(task_id, None)
+    if trace is not None:
+        payload, spans = trace.merge(payload)
+        trace_stats.add(trace.ip, spans)
+    deadlines.cancel(task_id)
+    cache.done(task_id, payload)
+    c = clients.pop(task_id, None)
+    if c is None:
+        late_replies += 1
+        logging.warning("Task %s has no waiting client, dropped (%d late)",
+                        task_id, late_replies)
+        return
     try:
-        c = clients.get(task_id)
-        c.write(payload)
-        c.finish()
+        c.on_reply(task_id, payload)
         logging.info("Task finished: %s", task_id)
     except Exception as e:
         logging.error("Task %s error: %s", task_id, str(e))
     finally:
-        del clients[task_id]
         logging.info('Opened tasks: %s', len(clients))
 
 
+def verify_data(category, params):
+    # verify commands field
+    commands = params.get('commands')
+    if not commands:
+        raise Exception('No valid commands')
+
+    # verify ip
+    ip = params.get('ip')
+    hostname = params.get('hostname')
+    if not (ip or hostname):
+        raise Exception('No valid ip or hostname')
+    # get credential from local based on ip or hostname
+    device = ip or hostname
+    device_info_res = credential.get(device)
+    # device found in local
+    if device_info_res and device_info_res['status'] == 'ok':
+        device_info = device_info_res['device_info']
+        device_info.update(params)  # update device_info with given params
+    else:  # device not found in local
+        device_info = params  # just use given params
+    # print(device_info)
+    if 'ip' not in device_info:
+        raise Exception('ip address not found for %s' % hostname)
+
+    # just using common info for device without credential
+    if category == 'cli':
+        if not device_info.get('password'):
+            common = credential.common
+            device_info['username'] = common['username']
+            device_info['password'] = common['password']
+            device_info['enable_password'] = common['enable_password']
+        ch = params.get('channel',
+                        device_info.get('vendor', 'cisco')).lower()
+    elif category == 'snmp':
+        if not device_info.get('community'):
+            common = credential.common
+            device_info['community'] = common['community']
+        ch = 'snmp'
+
+    # verify channel
+    if ch not in channel_dict:
+        raise Exception('not supported device type: %s' % ch)
+    if not backends[channel_dict[ch]].threads:
+        raise Exception('no live worker for device type: %s' % ch)
+
+    # verify priority
+    priority = device_info.setdefault('priority', DEFAULT_PRIORITY)
+    if priority not in PRIORITY_CLASSES:
+        raise Exception('not supported priority: %s' % priority)
+
+    # verify deadline, before the task is registered anywhere
+    if 'deadline' in device_info:
+        try:
+            deadline = float(device_info['deadline'])
+        except (TypeError, ValueError):
+            deadline = None
+        if deadline is None or not 0 < deadline < float('inf'):
+            raise Exception('not valid deadline: %s' % device_info['deadline'])
+        device_info['deadline'] = deadline
+
+    return device_info, ch
+
+
+def as_bool(v):
+    if isinstance(v, str):
+        return v.lower() in ('1', 'true', 'yes', 'on')
+    return bool(v)
+
+
+def is_ip(s):
+    try:
+        ipaddress.ip_address(s)
+        return True
+    except ValueError:
+        return False
+
+
+def accepts_gzip(handler):
+    return 'gzip' in handler.request.headers.get('Accept-Encoding', '')
+
+
+def write_payload(handler, payload):
+    """Write a task reply, a compressed one as is if the client takes it"""
+    if is_gzip(payload):
+        if accepts_gzip(handler):
+            handler.set_header('Content-Encoding', 'gzip')
+        else:
+            handler.write(inflate(payload))
+            return
+    write_body(handler, payload)
+
+
+def owner_node(handler, device):
+    """Cluster node owning the device if not this one, else None"""
+    if cluster is None or handler.request.headers.get(FORWARDED_HEADER):
+        return None
+    node = cluster.owner(device)
+    return None if node == cluster.me else node
+
+
+def forward(node, method, uri, body=None, on_chunk=None,
+            timeout=TASK_TIMEOUT):
+    """Relay a request to another cluster node, return the response future"""
+    headers = {FORWARDED_HEADER: cluster.me}
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
+        body = json.dumps(body)
+    return AsyncHTTPClient().fetch(
+        cluster.url(node, uri), method=method, body=body, headers=headers,
+        streaming_callback=on_chunk, request_timeout=timeout,
+        raise_error=False)
+
+
+def dispatch(device_info, ch, handler):
+    task_id = uuid4().hex
+    if cluster is not None:
+        task_id = cluster.task_id(task_id)
+    device_info['task_id'] = task_id
+    device_info['stream'] = as_bool(device_info.get('stream'))
+    device_info['trace'] = as_bool(device_info.get('trace'))
+    max_age = float(device_info.pop('max_age', 0) or 0)
+    if max_age > 0 and not device_info['stream'] and \
+            not device_info['trace']:
+        key = cache.key(device_info, ch)
+        payload = cache.get(key, max_age)
+        if payload is not None:
+            ioloop.IOLoop.current().add_callback(
+                handler.on_reply, task_id, payload)
+            return task_id
+        leader = cache.inflight.get(key)
+        if leader in clients:
+            c = clients[leader]
+            if not isinstance(c, Fanout):
+                c = clients[leader] = Fanout(leader, c)
+            c.add(task_id, handler)
+            shared[task_id] = leader
+            cache.coalesced += 1
+            return task_id
+        cache.track(key, task_id)
+    if device_info['trace']:
+        device_info.pop('compress', None)  # the reply gets the server spans
+        traces[task_id] = TaskTrace(device_info['ip'])
+    p = channel_dict[ch]
+    clients[task_id] = handler
+    deadlines.add(task_id, float(device_info.get('deadline', TASK_TIMEOUT)))
+    backends[p].submit(
+        [task_id.encode(), b'', json.dumps(device_info).encode()],
+        (ch, device_info['ip']),  # channels of a backend have own limits
+        MAX_SESSIONS_PER_CHANNEL.get(ch, MAX_SESSIONS_PER_DEVICE),
+        device_info['priority'],
+        as_bool(device_info.get('idempotent')))
+    recheck(p)
+    return task_id
+
+
+def release(task_id, handler):
+    """
+    A client gone before its reply. The task it waited for is dropped
+    if nobody else waits for it: unsent if queued, abandoned if running.
+    """
+    leader = shared.pop(task_id, task_id)
+    c = clients.get(leader)
+    if isinstance(c, Fanout):
+        c.remove(task_id, handler)
+        if c.clients:
+            return
+    elif c is not handler:
+        return
+    del clients[leader]
+    deadlines.cancel(leader)
+    cache.done(leader)
+    traces.pop(leader, None)
+    for dispatcher in backends.values():
+        dispatcher.abandon((leader.encode(), b''))
+
+
+class Fanout(object):
+    """Client of a task shared by identical requests"""
+
+    def __init__(self, task_id, handler):
+        self.clients = [(task_id, handler)]
+
+    def add(self, task_id, handler):
+        self.clients.append((task_id, handler))
+
+    def remove(self, task_id, handler):
+        self.clients.remove((task_id, handler))
+
+    def on_output(self, task_id, payload):
+        self.__each('on_output', payload)
+
+    def on_reply(self, task_id, payload):
+        self.__each('on_reply', payload)
+
+    def on_timeout(self, task_id):
+        for task_id, c in self.clients:
+            shared.pop(task_id, None)
+            try:
+                c.on_timeout(task_id)
+            except Exception as e:
+                logging.error("Task %s error: %s", task_id, str(e))
+
+    def __each(self, method, payload):
+        for task_id, c in self.clients:
+            if method == 'on_reply':
+                shared.pop(task_id, None)
+            try:
+                getattr(c, method)(task_id, payload)
+            except Exception as e:
+                logging.error("Task %s error: %s", task_id, str(e))
+
+
 class CommandHandler(web.RequestHandler):
 
-    def __verify_data(self, category, params):
-        # verify commands field
-        commands = params.get('commands')
-        if not commands:
-            raise Exception('No valid commands')
-
-        # verify ip
-        ip = params.get('ip')
-        hostname = params.get('hostname')
-        if not (ip or hostname):
-            raise Exception('No valid ip or hostname')
-        # get credential from local based on ip or hostname
-        device = ip or hostname
-        device_info_res = credential.get(device)
-        # device found in local
-        if device_info_res and device_info_res['status'] == 'ok':
-            device_info = device_info_res['device_info']
-            device_info.update(params)  # update device_info with given params
-        else:  # device not found in local
-            device_info = params  # just use given params
-        # print(device_info)
-        if 'ip' not in device_info:
-            raise Exception('ip address not found for %s' % hostname)
-
-        # just using common info for device without credential
-        if category == 'cli':
-            if not device_info.get('password'):
-                common = credential.common
-                device_info['username'] = common['username']
-                device_info['password'] = common['password']
-                device_info['enable_password'] = common['enable_password']
-            ch = params.get('channel',
-                            device_info.get('vendor', 'cisco')).lower()
-        elif category == 'snmp':
-            if not device_info.get('community'):
-                common = credential.common
-                device_info['community'] = common['community']
-            ch = 'snmp'
-
-        # verify channel
-        if ch not in active_workers:
-            raise Exception('not supported device type: %s' % ch)
-
-        return device_info, ch
-
-    # @web.asynchronous
     def get(self, category):
         params = {}
         for k, v in self.request.arguments.items():
@@ -126,33 +447,356 @@ class CommandHandler(web.RequestHandler):
                 params['channel'] = v[0].decode()
             else:
                 params[k] = v[0].decode()
-        self.process(category, params)
+        return self.process(category, params)
 
-    # @web.asynchronous
     def post(self, category):
         params = json.loads(self.request.body)
-        self.process(category, params)
+        return self.process(category, params)
 
     @web.asynchronous
     def process(self, category, params):
         try:
-            device_info, ch = self.__verify_data(category, params)
-            task_id = uuid4().hex
-            device_info['task_id'] = task_id
+            original = dict(params)
+            device_info, ch = verify_data(category, params)
+            node = owner_node(self, device_info['ip'])
+            if node:
+                self.relay(node, category, original)
+                return
+            self.stream = as_bool(device_info.get('stream'))
+            if accepts_gzip(self) and not self.stream:
+                device_info['compress'] = COMPRESS_MIN_BYTES
+            task_id = dispatch(device_info, ch, self)
+            if self.stream:
+                self.set_header('Content-Type', 'application/x-ndjson')
             x_real_ip = self.request.headers.get("X-Real-IP")
             remote_ip = x_real_ip or self.request.remote_ip
             logging.info("Request from %s, task: %s", remote_ip, task_id)
-
-            p = channel_dict[ch]
-            backends[p].send_multipart(
-                [task_id.encode(), b'', json.dumps(device_info).encode()])
-
-            clients[task_id] = self
         except Exception as e:
             reply = dict(status='error', message=str(e))
             self.write(reply)
             self.finish()
 
+    @gen.coroutine
+    def relay(self, node, category, params):
+        """Pass the request to the node owning the device"""
+        relayed = []
+
+        def on_chunk(chunk):
+            relayed.append(len(chunk))
+            self.write(chunk)
+            self.flush()
+
+        if as_bool(params.get('stream')):
+            self.set_header('Content-Type', 'application/x-ndjson')
+        timeout = float(params.get('deadline', TASK_TIMEOUT)) + 10
+        response = yield forward(node, 'POST', self.request.path, params,
+                                 on_chunk, timeout)
+        if response.code == 599 and not relayed:
+            logging.warning('Relay to %s failed: %s', node, response.error)
+            cluster.down.add(node)
+            yield gen.maybe_future(self.process(category, params))
+        elif not self._finished:
+            self.finish()
+
+    def on_output(self, task_id, payload):
+        # streaming: one JSON line per command, then the final reply
+        self.write(payload)
+        self.write(b'\n')
+        self.flush()
+
+    def on_reply(self, task_id, payload):
+        if self.stream:
+            self.write(bytes(payload))
+            self.write(b'\n')
+        else:
+            write_payload(self, payload)
+        self.finish()
+
+    def on_timeout(self, task_id):
+        self.write(dict(status='fail', message='timeout'))
+        self.finish()
+
+
+class BatchHandler(web.RequestHandler):
+    """
+    Fan out one request to many devices, stream results as NDJSON
+
+    Body: {"devices": ["R1", {"ip": "10.0.0.1"}, ...] or "query": "tag&core",
+           "commands": [...], <other params shared by all devices>}
+    """
+
+    @web.asynchronous
+    def post(self, category):
+        try:
+            params = json.loads(self.request.body)
+            devices = params.pop('devices', None)
+            q = params.pop('query', None)
+            if devices is None:
+                if q is None:
+                    raise Exception('No valid devices or query')
+                res = credential.query(q.lower())
+                if res['status'] != 'ok':
+                    raise Exception(res['message'])
+                devices = [dict(ip=d['ip'], hostname=d.get('hostname', ''))
+                           for d in res['devices']]
+        except Exception as e:
+            self.write(dict(status='error', message=str(e)))
+            self.finish()
+            return
+
+        x_real_ip = self.request.headers.get("X-Real-IP")
+        remote_ip = x_real_ip or self.request.remote_ip
+        logging.info("Batch request from %s, %d devices",
+                     remote_ip, len(devices))
+        self.set_header('Content-Type', 'application/x-ndjson')
+        self.pending = set()
+        self.forwards = 0
+        self.dispatch_devices(category, params, devices)
+        self.finish_if_done()
+
+    def dispatch_devices(self, category, params, devices):
+        remote = {}  # node -> devices it owns
+        for d in devices:
+            device_params = dict(params)
+            if isinstance(d, dict):
+                device_params.update(d)
+            elif is_ip(d):
+                device_params['ip'] = d
+            else:
+                device_params['hostname'] = d
+            try:
+                device_info, ch = verify_data(category, device_params)
+                node = owner_node(self, device_info['ip'])
+                if node:
+                    remote.setdefault(node, []).append(d)
+                else:
+                    self.pending.add(dispatch(device_info, ch, self))
+            except Exception as e:
+                self.write_line(json.dumps(dict(
+                    status='error',
+                    ip=device_params.get('ip', ''),
+                    hostname=device_params.get('hostname', ''),
+                    message=str(e))).encode())
+        for node, node_devices in remote.items():
+            self.forwards += 1
+            self.relay(node, category, params, node_devices)
+
+    @gen.coroutine
+    def relay(self, node, category, params, devices):
+        """Pass the devices owned by another node to it, relay its lines"""
+        rest = [b'']
+        relayed = []
+
+        def on_chunk(chunk):
+            relayed.append(len(chunk))
+            lines, _, rest[0] = (rest[0] + chunk).rpartition(b'\n')
+            if lines and not self._finished:
+                self.write_line(lines)
+                self.flush()
+
+        timeout = float(params.get('deadline', TASK_TIMEOUT)) + 10
+        response = yield forward(node, 'POST', self.request.path,
+                                 dict(params, devices=devices),
+                                 on_chunk, timeout)
+        self.forwards -= 1
+        if response.code == 599 and not relayed:
+            logging.warning('Relay to %s failed: %s', node, response.error)
+            cluster.down.add(node)
+            self.dispatch_devices(category, params, devices)
+        self.finish_if_done()
+
+    def finish_if_done(self):
+        if self._finished:
+            return
+        if self.pending or self.forwards:
+            self.flush()
+        else:
+            self.finish()
+
+    def write_line(self, payload):
+        self.write(payload)
+        self.write(b'\n')
+
+    def on_output(self, task_id, payload):
+        self.write_line(payload)
+        self.flush()
+
+    def on_reply(self, task_id, payload):
+        self.pending.discard(task_id)
+        self.write_line(inflate(payload))  # a cached or shared reply
+        self.finish_if_done()
+
+    def on_timeout(self, task_id):
+        self.on_reply(task_id, json.dumps(dict(
+            status='fail', task_id=task_id, message='timeout')).encode())
+
+    def on_connection_close(self):
+        for task_id in self.pending:
+            release(task_id, self)
+        self.pending = set()
+
+
+class AsyncJob(object):
+    """
+    Stand-in client of a task dispatched from /api/v1/async/
+
+    Holds no connection: the result goes to the result store, wakes up
+    long-polling readers and is POSTed to the callback URL if given.
+    """
+
+    def __init__(self, callback_url=None):
+        self.callback_url = callback_url
+        self.future = Future()
+
+    def on_output(self, task_id, payload):
+        pass
+
+    def on_reply(self, task_id, payload):
+        jobs.pop(task_id, None)
+        results.put(task_id, payload)
+        self.future.set_result(payload)
+        if self.callback_url:
+            AsyncHTTPClient().fetch(
+                self.callback_url, method='POST', body=inflate(payload),
+                headers={'Content-Type': 'application/json'},
+                raise_error=False).add_done_callback(
+                    lambda f: self.on_callback(task_id, f))
+
+    def on_timeout(self, task_id):
+        self.on_reply(task_id, json.dumps(dict(
+            status='fail', task_id=task_id, message='timeout')).encode())
+
+    def on_callback(self, task_id, future):
+        response = future.result()
+        if response.error:
+            logging.error("Task %s callback to %s failed: %s",
+                          task_id, self.callback_url, response.error)
+
+
+class AsyncCommandHandler(CommandHandler):
+
+    def process(self, category, params):
+        try:
+            original = dict(params)
+            callback_url = params.pop('callback', None)
+            params['stream'] = False
+            device_info, ch = verify_data(category, params)
+            node = owner_node(self, device_info['ip'])
+            if node:
+                return self.relay(node, category, original)
+            device_info['compress'] = COMPRESS_MIN_BYTES  # kept compressed
+            job = AsyncJob(callback_url)
+            task_id = dispatch(device_info, ch, job)
+            jobs[task_id] = job
+            x_real_ip = self.request.headers.get("X-Real-IP")
+            remote_ip = x_real_ip or self.request.remote_ip
+            logging.info("Async request from %s, task: %s",
+                         remote_ip, task_id)
+            self.write(dict(status='ok', task_id=task_id))
+        except Exception as e:
+            self.write(dict(status='error', message=str(e)))
+
+
+class ResultHandler(web.RequestHandler):
+    """
+    Poll, or long-poll with ?wait=<seconds>, the result of a task. wait
+    is clamped to RESULT_MAX_WAIT.
+    """
+
+    @gen.coroutine
+    def get(self, task_id):
+        self.set_header("Content-Type", "application/json")
+        try:
+            wait = float(self.get_argument('wait', 0))
+            if not wait >= 0:  # nan too
+                raise ValueError
+        except ValueError:
+            self.write(dict(status='error', task_id=task_id,
+                            message='not valid wait: %s' %
+                                    self.get_argument('wait')))
+            return
+        wait = min(wait, RESULT_MAX_WAIT)
+        payload = results.get(task_id)
+        if payload is None:
+            job = jobs.get(task_id)
+            if job is None and cluster is not None and \
+                    not self.request.headers.get(FORWARDED_HEADER) and \
+                    cluster.node_of(task_id) != cluster.me:
+                # the task was started on another node
+                response = yield forward(cluster.node_of(task_id), 'GET',
+                                         self.request.uri, timeout=wait + 10)
+                self.write(response.body or dict(
+                    status='error', task_id=task_id,
+                    message=str(response.error)))
+                return
+            if job is None:
+                self.write(dict(status='error', task_id=task_id,
+                                message='Task not found'))
+                return
+            if wait > 0:
+                try:
+                    payload = yield gen.with_timeout(
+                        timedelta(seconds=wait), job.future)
+                except gen.TimeoutError:
+                    pass
+        if payload is None:
+            self.write(dict(status='pending', task_id=task_id))
+        else:
+            write_payload(self, payload)
+
+
+class MetricsHandler(web.RequestHandler):
+    """Prometheus text format, computed at scrape time"""
+
+    def get(self):
+        counters = dict(
+            cc_task_timeouts_total=('Tasks past their deadline', timeouts),
+            cc_late_replies_total=('Replies after the deadline',
+                                   late_replies),
+            cc_cache_hits_total=('Output cache hits', cache.hits),
+            cc_cache_coalesced_total=('Requests sharing a running task',
+                                      cache.coalesced))
+        gauges = dict(
+            cc_clients_waiting=('Tasks with a waiting client', len(clients)),
+            cc_async_results=('Results in the async result store',
+                              len(results)),
+            **credential_gauges(credential))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(render(list(backends.values()), counters, gauges))
+        self.write('\n'.join(trace_stats.lines()) + '\n')
+
+
+class TraceApiHandler(web.RequestHandler):
+    """Spans of the tasks traced so far, by name, with slowest devices"""
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(trace_stats.summary)
+
+    def delete(self):
+        self.set_header("Content-Type", "application/json")
+        trace_stats.clear()
+        self.write(dict(status='ok'))
+
+
+class ClusterApiHandler(web.RequestHandler):
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(cluster.status if cluster else dict(me='', nodes={}))
+
+
+class CacheApiHandler(web.RequestHandler):
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(cache.stats)
+
+    def delete(self):
+        self.set_header("Content-Type", "application/json")
+        cache.clear()
+        self.write(dict(status='ok'))
+
 
 class CredentialApiHandler(web.RequestHandler):
 
@@ -241,9 +885,21 @@ class DeviceApiHandler(web.RequestHandler):
 
 if __name__ == "__main__":
     options.define("p", default=8080, help="Web server port", type=int)
+    options.define("nodes", default='', type=str,
+                   help="Cluster mode: host:port of every node, "
+                        "comma separated, same order on all nodes")
+    options.define("node", default='', type=str,
+                   help="Cluster mode: host:port of this node in --nodes")
     options.parse_command_line()
     port = options.options.p
 
+    cluster = None
+    if options.options.nodes:
+        nodes = options.options.nodes.split(',')
+        cluster = Cluster(nodes, options.options.node or nodes[0])
+        AsyncHTTPClient.configure(None, max_clients=CLUSTER_MAX_RELAYS)
+        PeriodicCallback(cluster.check, HEARTBEAT_INTERVAL * 1000).start()
+
     credential = CredentialManager()
     credential.daemon = True
     credential.start()
@@ -256,13 +912,25 @@ if __name__ == "__main__":
     port_daemon.start()
 
     clients = {}
+    jobs = {}
     backends = {}
+    streams = {}  # port -> ZMQStream of its backend
+    results = ResultStore(RESULT_STORE_MAX_BYTES, RESULT_TTL,
+                          RESULT_SPILL_DIR or None)
     install_backends()
+    PeriodicCallback(expire_tasks, 1000).start()
 
     print('Command Center server started on %s' % port)
     print('Press "Ctrl+C" to exit.\n')
     application = web.Application([
         (r"/api/v1/sync/(cli|snmp|netconf|api)", CommandHandler),
+        (r"/api/v1/batch/(cli|snmp)", BatchHandler),
+        (r"/api/v1/async/result/(\w+)", ResultHandler),
+        (r"/api/v1/async/(cli|snmp|netconf|api)", AsyncCommandHandler),
+        (r'/api/v1/cache/?', CacheApiHandler),
+        (r'/api/v1/cluster/?', ClusterApiHandler),
+        (r'/api/v1/trace/?', TraceApiHandler),
+        (r'/metrics', MetricsHandler),
         (r'/api/v1/credential_common/?', CredentialCommonApiHandler),
         (r'/api/v1/credential/?(.*)', CredentialApiHandler),
         (r'/api/v1/device/?(.*)', DeviceApiHandler),
@@ -1,22 +1,31 @@
 import json
 import logging
+import time
 from uuid import uuid4
 from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
 import zmq
 from tornado import gen, ioloop, web, options
-from tornado.concurrent import run_on_executor
+from tornado.concurrent import Future, run_on_executor
 from tornado.log import enable_pretty_logging
+from zmq.eventloop.zmqstream import ZMQStream
 
 from credential_mgr import CredentialManager
+from dispatcher import Dispatcher
+from frames import split, write_body
+from metrics import (BackendStats, credential_gauges, render_backends,
+                     render_values)
+from tracing import TaskTrace, TraceStats, now
 from config import *
+import wire
 
 enable_pretty_logging()
 
 
 context = zmq.Context()
 poller = zmq.Poller()
+timeouts = 0
 
 
 def get_channel_dict():
@@ -33,12 +42,43 @@ def port_daemon():
     rep.bind("tcp://*:%d" % PORT_DAEMON_SOCKET_PORT)
     while True:
         message = rep.recv_string()
-        port = channel_dict.get(message)
-        rep.send_string(str(port))
-        logging.info('Worker %s connect' % message)
+        channel, wire_format = wire.register(message)
+        ports = [channel_dict[c] for c in channel.split('::')
+                 if c in channel_dict]
+        port = ports[0] if ports else None
+        if not wire_format:  # a worker before wire version 1
+            rep.send_string(str(port))
+        elif port:
+            rep.send_string('%s %s' % (port, wire_format))
+        else:
+            rep.send_string('%s %s' % (wire.UNKNOWN_CHANNEL, channel))
+            logging.warning('Worker %s refused, unknown channel', channel)
+            continue
+        logging.info('Worker %s connect, wire format %s',
+                     channel, wire_format or 'json')
+
+
+def as_bool(v):
+    if isinstance(v, str):
+        return v.lower() in ('1', 'true', 'yes', 'on')
+    return bool(v)
+
+
+def route(device_info):
+    """Frames the broker needs besides the channel"""
+    return [device_info['ip'].encode(),
+            device_info['priority'].encode(),
+            b'1' if device_info['idempotent'] else b'0',
+            b'1' if device_info['trace'] else b'0']
 
 
 class Broker(Thread):
+    """
+    Owns the Dispatchers, which are not thread safe: handlers only read
+    what it publishes, threads (port -> worker threads) after every
+    heartbeat and sweep, and metrics (text) and trace_summary every
+    second. Each one is replaced as a whole, never updated in place.
+    """
 
     def __init__(self):
         Thread.__init__(self)
@@ -48,26 +88,134 @@ class Broker(Thread):
 
         poller.register(frontend, zmq.POLLIN)
         for p in set(list(channel_dict.values())):
-            backend = ctx.socket(zmq.DEALER)
+            backend = ctx.socket(zmq.ROUTER)
             backend.bind("tcp://*:%d" % p)
             poller.register(backend, zmq.POLLIN)
-            backends[p] = backend
+            channels = sorted(c for c in channel_dict if channel_dict[c] == p)
+            backends[p] = Dispatcher(
+                backend,
+                classes=PRIORITY_CLASSES,
+                default=DEFAULT_PRIORITY,
+                weights=PRIORITY_WEIGHTS,
+                reserved_share=INTERACTIVE_RESERVED_SHARE,
+                expiry=HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS,
+                stats=BackendStats(channels),
+                on_sent=self.on_sent)
         self.frontend = frontend
+        self.traces = {}  # envelope -> TaskTrace of tasks with trace=true
+        self.trace_stats = TraceStats()
+        self.publish()
+
+    def publish(self, threads_only=False):
+        self.threads = dict((p, d.threads) for p, d in backends.items())
+        if threads_only:
+            return
+        self.metrics = render_backends(list(backends.values())) + \
+            '\n'.join(self.trace_stats.lines()) + '\n'
+        self.trace_summary = self.trace_stats.summary
+
+    def on_sent(self, envelope):
+        if self.traces:
+            trace = self.traces.get(envelope)
+            if trace is not None:
+                trace.sent = now()
 
     def run(self):
         frontend = self.frontend
+        swept_at = time.time()
         while True:
-            socks = dict(poller.poll())
+            socks = dict(poller.poll(1000))
             if socks.get(frontend) == zmq.POLLIN:
-                message = frontend.recv_multipart()
-                ch = message[2]
-                message.remove(ch)
-                p = channel_dict[ch.decode()]
-                backends[p].send_multipart(message)
-            for backend in backends.values():
+                # REQ client:    [client, '', route..., payload]
+                # DEALER client: [client, task_id, '', route..., payload]
+                # route: ch, ip, priority, idempotent, trace
+                message = split(frontend.recv_multipart(copy=False))
+                i = message.index(b'') + 1
+                ch, ip, priority, idempotent, trace = [
+                    f.decode() for f in message[i:i + 5]]
+                del message[i:i + 5]
+                if trace == '1':
+                    self.traces[tuple(message[:i])] = TaskTrace(ip)
+                limit = MAX_SESSIONS_PER_CHANNEL.get(ch,
+                                                     MAX_SESSIONS_PER_DEVICE)
+                backends[channel_dict[ch]].submit(message, (ch, ip), limit,
+                                                  priority,
+                                                  idempotent == '1')
+            for dispatcher in backends.values():
+                backend = dispatcher.socket
                 if socks.get(backend) == zmq.POLLIN:
-                    message = backend.recv_multipart()
-                    frontend.send_multipart(message)
+                    reply, done = dispatcher.on_worker(
+                        split(backend.recv_multipart(copy=False)))
+                    if done:  # converted here, off the IOLoop
+                        start = time.time()
+                        reply[-1] = wire.to_json(reply[-1])
+                        self.merge_trace(reply)
+                        frontend.send_multipart(reply, copy=False)
+                        dispatcher.stats.phases['relay'].observe(
+                            time.time() - start)
+                    elif reply is None:  # heartbeat
+                        self.publish(threads_only=True)
+            if time.time() - swept_at >= 1:
+                swept_at = time.time()
+                for dispatcher in backends.values():
+                    for reply in dispatcher.sweep(swept_at):
+                        self.merge_trace(reply)
+                        frontend.send_multipart(reply)
+                for envelope in list(self.traces):  # timed out
+                    if now() - self.traces[envelope].dispatched > \
+                            PULLER_TIMEOUT * 1e6:
+                        del self.traces[envelope]
+                self.publish()
+
+    def merge_trace(self, reply):
+        trace = self.traces.pop(tuple(reply[:-1]), None)
+        if trace is not None:
+            reply[-1], spans = trace.merge(reply[-1])
+            self.trace_stats.add(trace.ip, spans)
+
+
+class AsyncClient(object):
+    """
+    One DEALER socket on the IOLoop shared by all requests
+
+    Replies are matched back to the waiting request by task id, so the
+    number of tasks in flight is not bound to executor threads.
+    """
+
+    def __init__(self):
+        s = context.socket(zmq.DEALER)
+        s.connect('tcp://127.0.0.1:%d' % CLIENT_SOCKET_PORT)
+        self.stream = ZMQStream(s)
+        self.stream.on_recv(self.on_reply, copy=False)
+        self.futures = {}
+
+    def request(self, ch, task_id, device_info):
+        future = Future()
+        self.futures[task_id] = future
+        self.stream.send_multipart(
+            [task_id.encode(), b'', ch.encode()] + route(device_info) +
+            [json.dumps(device_info).encode()])
+        loop = ioloop.IOLoop.current()
+        timer = loop.call_later(PULLER_TIMEOUT / 1000.0,
+                                self.on_timeout, task_id)
+        future.add_done_callback(lambda f: loop.remove_timeout(timer))
+        return future
+
+    def on_reply(self, frames):
+        task_id, _, payload = split(frames)
+        future = self.futures.pop(task_id.decode(), None)
+        if future is None:
+            logging.warning("Task %s has no waiting client", task_id)
+            return
+        future.set_result(payload)
+
+    def on_timeout(self, task_id):
+        global timeouts
+        future = self.futures.pop(task_id, None)
+        if future is not None:
+            logging.warning("Task timeouted: %s", task_id)
+            timeouts += 1
+            future.set_result(dict(status='fail', message='timeout'))
 
 
 class CommandHandler(web.RequestHandler):
@@ -115,6 +263,13 @@ class CommandHandler(web.RequestHandler):
         # verify channel
         if ch not in worker_channels:
             raise Exception('not supported channel: %s' % ch)
+        if not broker.threads.get(channel_dict[ch]):
+            raise Exception('no live worker for channel: %s' % ch)
+
+        # verify priority
+        priority = device_info.setdefault('priority', DEFAULT_PRIORITY)
+        if priority not in PRIORITY_CLASSES:
+            raise Exception('not supported priority: %s' % priority)
 
         return device_info, ch
 
@@ -132,42 +287,96 @@ class CommandHandler(web.RequestHandler):
                 params['channel'] = v[0].decode()
             else:
                 params[k] = v[0].decode()
-        reply = yield self.process(category, params)
-        self.write(reply)
+        reply = yield self.dispatch(category, params)
+        self.write_reply(reply)
 
     @gen.coroutine
     def post(self, category):
         params = json.loads(self.request.body)
-        reply = yield self.process(category, params)
-        self.write(reply)
+        reply = yield self.dispatch(category, params)
+        self.write_reply(reply)
+
+    def write_reply(self, reply):
+        if isinstance(reply, dict):
+            self.write(reply)
+        else:  # worker reply, a zmq.Frame
+            write_body(self, reply)
+
+    def dispatch(self, category, params):
+        if async_client:
+            return self.process_async(category, params)
+        return self.process(category, params)
+
+    def __prepare(self, category, params):
+        device_info, ch = self.__verify_data(category, params)
+        device_info.pop('stream', None)  # only server_callback streams
+        task_id = uuid4().hex
+        device_info['task_id'] = task_id
+        device_info['idempotent'] = as_bool(device_info.get('idempotent'))
+        device_info['trace'] = as_bool(device_info.get('trace'))
+        x_real_ip = self.request.headers.get("X-Real-IP")
+        remote_ip = x_real_ip or self.request.remote_ip
+        logging.info("Request from %s, task: %s", remote_ip, task_id)
+        return device_info, ch, task_id
+
+    @gen.coroutine
+    def process_async(self, category, params):
+        try:
+            device_info, ch, task_id = self.__prepare(category, params)
+        except Exception as e:
+            raise gen.Return(dict(status='error', message=str(e)))
+        message = yield async_client.request(ch, task_id, device_info)
+        logging.info("Task finished: %s", task_id)
+        raise gen.Return(message)
 
     @run_on_executor
     def process(self, category, params):
+        global timeouts
         try:
-            device_info, ch = self.__verify_data(category, params)
-            task_id = uuid4().hex
-            device_info['task_id'] = task_id
-            x_real_ip = self.request.headers.get("X-Real-IP")
-            remote_ip = x_real_ip or self.request.remote_ip
-            logging.info("Request from %s, task: %s", remote_ip, task_id)
+            device_info, ch, task_id = self.__prepare(category, params)
         except Exception as e:
             return dict(status='error', message=str(e))
 
         s = context.socket(zmq.REQ)
         s.connect('tcp://127.0.0.1:%d' % CLIENT_SOCKET_PORT)
-        s.send_multipart([ch.encode(), json.dumps(device_info).encode()])
+        s.send_multipart([ch.encode()] + route(device_info) +
+                         [json.dumps(device_info).encode()])
         s.RCVTIMEO = PULLER_TIMEOUT  # in milliseconds
         try:
-            message = s.recv_string()
+            message = s.recv(copy=False)
             logging.info("Task finished: %s", task_id)
         except zmq.error.Again:
             logging.warning("Task timeouted: %s", task_id)
+            timeouts += 1
             message = dict(status='fail', message='timeout')
         finally:
             s.close()
             return message
 
 
+class MetricsHandler(web.RequestHandler):
+    """Prometheus text format, computed at scrape time"""
+
+    def get(self):
+        counters = dict(
+            cc_task_timeouts_total=('Tasks past their deadline', timeouts))
+        gauges = credential_gauges(credential)
+        if async_client:
+            gauges['cc_clients_waiting'] = ('Tasks with a waiting client',
+                                            len(async_client.futures))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(broker.metrics)
+        self.write(render_values(counters, gauges))
+
+
+class TraceApiHandler(web.RequestHandler):
+    """Spans of the tasks traced so far, by name, with slowest devices"""
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(broker.trace_summary)
+
+
 class CredentialApiHandler(web.RequestHandler):
 
     def check_origin(self, origin):
@@ -255,8 +464,12 @@ class DeviceApiHandler(web.RequestHandler):
 
 if __name__ == "__main__":
     options.define("p", default=8080, help="Web server port", type=int)
+    options.define("m", default='thread', type=str,
+                   help="Request mode: thread (REQ socket per executor "
+                        "thread) or async (shared DEALER socket)")
     options.parse_command_line()
     port = options.options.p
+    mode = options.options.m
 
     credential = CredentialManager()
     credential.daemon = True
@@ -274,10 +487,14 @@ if __name__ == "__main__":
     broker.daemon = True
     broker.start()
 
-    print('Command Center server started at %s' % port)
+    async_client = AsyncClient() if mode == 'async' else None
+
+    print('Command Center server started at %s (%s mode)' % (port, mode))
     print('Press "Ctrl+C" to exit.\n')
     application = web.Application([
         (r"/api/v1/sync/(cli|snmp|netconf|api)", CommandHandler),
+        (r'/api/v1/trace/?', TraceApiHandler),
+        (r'/metrics', MetricsHandler),
         (r'/api/v1/credential_common/?', CredentialCommonApiHandler),
         (r'/api/v1/credential/?(.*)', CredentialApiHandler),
         (r'/api/v1/device/?(.*)', DeviceApiHandler),
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# server modules are flat at the top, workers import modules.* from workers/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'workers')]
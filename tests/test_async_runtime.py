@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import pytest
+import zmq
+
+from modules.worker_base import (W_HEARTBEAT, W_PART, W_REPLY, AsyncRuntime,
+                                 BaseWorker, context)
+
+
+class AsyncWorker(BaseWorker):
+    channel = 'test'
+
+    async def handler(self, task_id, params):
+        output = []
+        for i in range(3):
+            self.collect(output, 'part %d' % i)
+        return dict(status='success', output=output)
+
+
+class SyncWorker(BaseWorker):
+    channel = 'test'
+
+    def handler(self, task_id, params):
+        output = []
+        for i in range(3):
+            self.collect(output, 'part %d' % i)
+        return dict(status='success', output=output)
+
+
+@pytest.mark.parametrize('worker', [AsyncWorker, SyncWorker])
+def test_parts_before_reply(worker):
+    endpoint = 'inproc://parts-%s' % worker.__name__
+    server = context.socket(zmq.ROUTER)
+    server.bind(endpoint)
+    runtime = AsyncRuntime(worker, 'w', [(endpoint, 'json')], 2, 1)
+    runtime.heartbeat()
+    assert server.recv_multipart()[1] == W_HEARTBEAT
+    task = dict(task_id='t1', ip='10.0.0.1', stream=True)
+    server.send_multipart([b'w', b't1', b'', json.dumps(task).encode()])
+
+    async def receive():
+        frames = []
+        while len(frames) < 4:
+            await asyncio.sleep(0.01)
+            while server.poll(0):
+                frames.append(server.recv_multipart())
+        return frames
+
+    try:
+        frames = runtime.loop.run_until_complete(
+            asyncio.wait_for(receive(), 5))
+    finally:
+        server.close(linger=0)
+        runtime.executor.shutdown()
+    assert [f[1] for f in frames] == [W_PART] * 3 + [W_REPLY]
+    parts = [json.loads(f[-1])['output'] for f in frames[:3]]
+    assert parts == [['part 0'], ['part 1'], ['part 2']]
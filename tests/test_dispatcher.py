@@ -0,0 +1,163 @@
+import json
+
+from dispatcher import W_HEARTBEAT, W_REPLY, WORKER_LOST, Dispatcher
+
+
+class Socket(object):
+    """ROUTER socket recording the tasks sent"""
+
+    def __init__(self):
+        self.sent = []
+
+    def setsockopt(self, option, value):
+        pass
+
+    def send_multipart(self, frames):
+        self.sent.append(frames)
+
+
+def heartbeat(d, process, workers):
+    state = dict(threads=sum(workers.values()), busy=0, workers=workers)
+    d.on_worker([process, W_HEARTBEAT, json.dumps(state).encode()])
+
+
+def task(n):
+    return [b'client', b'%d' % n, b'', b'payload']
+
+
+def reply(d, frames):
+    worker_id, envelope = frames[0], frames[1:-1]
+    return d.on_worker([worker_id, W_REPLY] + envelope + [b'{}'])
+
+
+def test_heartbeat_gives_credits():
+    s = Socket()
+    d = Dispatcher(s)
+    heartbeat(d, b'p1', {'w1': 2, 'w2': 1})
+    assert len(d.ready) == 3
+    heartbeat(d, b'p1', {'w1': 2, 'w2': 1})
+    assert len(d.ready) == 3  # known credits are not given again
+
+
+def test_task_waits_for_a_credit():
+    s = Socket()
+    d = Dispatcher(s)
+    d.submit(task(1))
+    d.submit(task(2))
+    assert not s.sent and d.queued == 2
+    heartbeat(d, b'p1', {'w1': 1})
+    assert [f[0] for f in s.sent] == [b'w1']
+    assert d.queued == 1 and not d.ready
+    output, done = reply(d, s.sent[0])
+    assert done and output[:2] == [b'client', b'1']
+    assert len(s.sent) == 2 and s.sent[1][2] == b'2'  # credit given back
+    reply(d, s.sent[1])
+    assert list(d.ready) == [b'w1'] and not d.running and not d.queued
+
+
+def test_heartbeat_counts_tasks_in_flight():
+    s = Socket()
+    d = Dispatcher(s)
+    heartbeat(d, b'p1', {'w1': 2})
+    d.submit(task(1))
+    heartbeat(d, b'p1', {'w1': 2})  # sent before the task came in
+    assert d.credits == {b'w1': 1} and len(d.ready) == 1
+
+
+def test_devices_take_turns():
+    s = Socket()
+    d = Dispatcher(s)
+    for n in range(3):
+        d.submit(task(n), device='a')
+    d.submit(task(10), device='b')
+    d.submit(task(20), device='c')
+    heartbeat(d, b'p1', {'w1': 1})
+    for _ in range(4):
+        reply(d, s.sent[-1])
+    assert [f[2] for f in s.sent] == [b'0', b'10', b'20', b'1', b'2']
+
+
+def test_device_session_limit():
+    s = Socket()
+    d = Dispatcher(s)
+    heartbeat(d, b'p1', {'w1': 4})
+    for n in range(3):
+        d.submit(task(n), device='a', limit=2)
+    assert len(s.sent) == 2 and d.sessions == {'a': 2}
+    d.abandon(s.sent[0][1:-1])  # still holds its session
+    assert len(s.sent) == 2
+    reply(d, s.sent[0])
+    assert len(s.sent) == 3 and not d.abandoned
+
+
+def test_lost_worker():
+    s = Socket()
+    d = Dispatcher(s, expiry=5)
+    heartbeat(d, b'p1', {'w1': 2})
+    d.submit(task(1), idempotent=True)
+    d.submit(task(2))
+    replies = d.sweep(now=d.processes[b'p1']['expire'] + 1)
+    assert replies == [[b'client', b'2', b'', WORKER_LOST]]
+    assert not d.ready and not d.running and d.queued == 1
+    heartbeat(d, b'p2', {'w2': 1})
+    assert s.sent[-1][:3] == [b'w2', b'client', b'1']
+
+
+
+def test_channels_sharing_a_backend_keep_their_limits():
+    s = Socket()
+    d = Dispatcher(s)
+    heartbeat(d, b'p1', {'w1': 4})
+    for n in range(2):
+        d.submit(task(n), device=('f5', '10.0.0.1'), limit=1)
+    d.submit(task(2), device=('test', '10.0.0.1'), limit=0)
+    assert [f[2] for f in s.sent] == [b'0', b'2']
+    assert d.limits[('f5', '10.0.0.1')] == 1
+
+
+CLASSES = ('interactive', 'normal', 'bulk')
+
+
+def sent_classes(s):
+    return [f[2].decode() for f in s.sent]
+
+
+def test_strict_priority():
+    s = Socket()
+    d = Dispatcher(s, classes=CLASSES)
+    for n, priority in enumerate(('bulk', 'normal', 'interactive')):
+        d.submit([b'%d' % n, priority.encode(), b'', b''], device=n,
+                 priority=priority)
+    heartbeat(d, b'p1', {'w1': 1})
+    for _ in range(2):
+        reply(d, s.sent[-1])
+    assert sent_classes(s) == ['interactive', 'normal', 'bulk']
+
+
+def test_weighted_round_robin():
+    s = Socket()
+    d = Dispatcher(s, classes=CLASSES, weights=dict(
+        interactive=4, normal=2, bulk=1))
+    for n in range(7):
+        for priority in CLASSES:
+            d.submit([b'%d' % n, priority.encode(), b'', b''],
+                     device=(priority, n), priority=priority)
+    heartbeat(d, b'p1', {'w1': 7})
+    classes = sent_classes(s)
+    assert [classes.count(c) for c in CLASSES] == [4, 2, 1]
+    assert classes[:3] == ['interactive', 'normal', 'interactive']
+
+
+def test_reserved_share():
+    s = Socket()
+    d = Dispatcher(s, classes=CLASSES, reserved_share=0.5)
+    heartbeat(d, b'p1', {'w1': 4})
+    for n in range(4):
+        d.submit([b'%d' % n, b'bulk', b'', b''], device=n, priority='bulk')
+    assert len(s.sent) == 2  # two of four workers kept for interactive
+    d.submit([b'9', b'interactive', b'', b''], device=9,
+             priority='interactive')
+    assert sent_classes(s)[-1] == 'interactive'
+    reply(d, s.sent[0])
+    assert sent_classes(s)[-1] == 'bulk'
+    assert len(s.sent) == 4 and len(d.ready) == 1  # one kept
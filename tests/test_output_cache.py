@@ -0,0 +1,74 @@
+import time
+
+from output_cache import OutputCache
+
+OK = b'{"status": "success", "output": []}'
+FAIL = b'{"status": "fail", "message": "timeout"}'
+
+
+def device(**kwargs):
+    d = dict(ip='10.0.0.1', username='u', password='p',
+             commands=['show  version ', 'show clock'])
+    d.update(kwargs)
+    return d
+
+
+def test_key():
+    key = OutputCache.key
+    assert key(device(), 'cisco') == \
+        key(device(commands=['show version', 'show   clock']), 'cisco')
+    assert key(device(), 'cisco') != key(device(), 'brocade')
+    assert key(device(), 'cisco') != key(device(password='x'), 'cisco')
+    assert key(device(), 'cisco') != key(device(hostname='R1'), 'cisco')
+    assert 'p' not in key(device(), 'cisco')
+
+
+def test_max_age(monkeypatch):
+    c = OutputCache(1000)
+    c.put('k', OK)
+    assert c.get('k', 10) == OK
+    monkeypatch.setattr(time, 'time', lambda t=time.time(): t + 11)
+    assert c.get('k', 10) is None
+    assert c.get('k', 20) == OK  # each request gives its own max age
+    assert (c.hits, c.misses) == (2, 1)
+
+
+def test_lru_by_size():
+    c = OutputCache(len(OK) * 2)
+    c.put('a', OK)
+    c.put('b', OK)
+    c.get('a', 10)
+    c.put('c', OK)
+    assert c.get('b', 10) is None and c.get('a', 10) and c.get('c', 10)
+    assert c.size == len(OK) * 2
+
+
+def test_coalescing():
+    c = OutputCache(1000)
+    c.track('k', 't1')
+    assert c.inflight == {'k': 't1'}
+    c.done('t1', OK)
+    assert not c.inflight and c.get('k', 10) == OK
+
+
+def test_failed_reply_not_cached():
+    c = OutputCache(1000)
+    c.track('k', 't1')
+    c.done('t1', FAIL)
+    assert not c.inflight and c.get('k', 10) is None
+
+
+def test_timed_out_task_not_cached():
+    c = OutputCache(1000)
+    c.track('k', 't1')
+    c.done('t1')  # expired, its reply comes too late
+    c.done('t1', OK)
+    assert c.get('k', 10) is None
+
+
+def test_newer_task_keeps_the_key():
+    c = OutputCache(1000)
+    c.track('k', 't1')
+    c.track('k', 't2')
+    c.done('t1', OK)
+    assert c.inflight == {'k': 't2'}
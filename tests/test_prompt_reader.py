@@ -0,0 +1,67 @@
+from io import BytesIO
+
+import pexpect
+
+from modules.prompt_reader import PromptReader, prompt_regex, read_until_prompt
+
+PROMPT = prompt_regex([r'Router\#', r'\[confirm\]'])
+
+
+class Child(object):
+    """pexpect child reading given chunks, then EOF or TIMEOUT"""
+    buffer_type = BytesIO
+
+    def __init__(self, chunks, end=pexpect.TIMEOUT, buffer=b''):
+        self.chunks = list(chunks)
+        self.end = end
+        self.buffer = buffer
+
+    def read_nonblocking(self, size, timeout):
+        if not self.chunks:
+            raise self.end('no more output')
+        return self.chunks.pop(0)
+
+
+def test_prompt_split_across_chunks():
+    reader = PromptReader(PROMPT)
+    assert reader.feed(b'line 1\r\nline 2\r\nRou') is None
+    assert reader.feed(b'ter') is None
+    end = reader.feed(b'#')
+    assert reader.buffer[:end] == b'line 1\r\nline 2\r\nRouter#'
+
+
+def test_newline_split_across_chunks():
+    reader = PromptReader(PROMPT)
+    assert reader.feed(b'Rou\r') is None
+    assert reader.feed(b'\nter#') is None
+    assert reader.line_start == 5
+    assert reader.feed(b'\r\nRouter#') == len(reader.buffer)
+
+
+def test_only_the_last_line():
+    reader = PromptReader(PROMPT)
+    assert reader.feed(b'Router# show clock\r\n') is None
+    assert reader.feed(b'12:00:00\r\n') is None
+
+
+def test_read_until_prompt():
+    child = Child([b'show clock\r\n12:00', b':00\r\nRouter#', b'more'])
+    output, end = read_until_prompt(child, PROMPT, 1)
+    assert (bytes(output), end) == (b'show clock\r\n12:00:00\r\nRouter#',
+                                    'prompt')
+    assert child.chunks == [b'more']
+
+
+def test_past_the_prompt_given_back():
+    child = Child([b'out\r\nRouter#next'], buffer=b'show x\r\n')
+    output, end = read_until_prompt(child, PROMPT, 1)
+    assert bytes(output) == b'show x\r\nout\r\nRouter#'
+    assert child.buffer == b'next'
+    assert child._before.getvalue() == b'next'
+
+
+def test_timeout_and_eof():
+    output, end = read_until_prompt(Child([b'out\r\npart']), PROMPT, 1)
+    assert (bytes(output), end) == (b'out\r\npart', 'timeout')
+    output, end = read_until_prompt(Child([b'out'], pexpect.EOF), PROMPT, 1)
+    assert (bytes(output), end) == (b'out', 'eof')
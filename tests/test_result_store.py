@@ -0,0 +1,50 @@
+import os
+import time
+
+from result_store import ResultStore
+
+
+def test_get():
+    s = ResultStore(100, ttl=60)
+    s.put('a', b'x' * 10)
+    assert s.get('a') == b'x' * 10
+    assert s.get('b') is None
+    assert s.size == 10 and len(s) == 1
+
+
+def test_ttl(monkeypatch):
+    s = ResultStore(100, ttl=60)
+    s.put('a', b'x')
+    s.put('b', b'y')
+    assert s.sweep() == 0
+    monkeypatch.setattr(time, 'time', lambda t=time.time(): t + 61)
+    s.put('c', b'z')
+    assert s.sweep() == 2
+    assert s.get('a') is None and s.get('c') == b'z'
+    assert s.size == 1
+
+
+def test_evict_oldest_by_size():
+    s = ResultStore(25, ttl=60)
+    for task_id in 'abc':
+        s.put(task_id, b'x' * 10)
+    assert s.get('a') is None and s.get('b') and s.get('c')
+    assert s.size == 20
+
+
+def test_keep_one_bigger_than_the_store():
+    s = ResultStore(5, ttl=60)
+    s.put('a', b'x' * 10)
+    assert s.get('a') == b'x' * 10
+
+
+def test_spill(tmp_path, monkeypatch):
+    spill_dir = str(tmp_path / 'spill')
+    s = ResultStore(25, ttl=60, spill_dir=spill_dir)
+    for task_id in 'abc':
+        s.put(task_id, task_id.encode() * 10)
+    assert list(s.disk) == ['a'] and len(s) == 3
+    assert s.get('a') == b'a' * 10  # served from disk
+    monkeypatch.setattr(time, 'time', lambda t=time.time(): t + 61)
+    assert s.sweep() == 3
+    assert not os.listdir(spill_dir) and s.get('a') is None
@@ -0,0 +1,41 @@
+from timer_wheel import TimerWheel
+
+
+def test_expire_on_its_tick():
+    w = TimerWheel(slots=8)
+    w.add('a', 2)
+    w.add('b', 3)
+    assert w.tick() == []
+    assert w.tick() == ['a']
+    assert w.tick() == ['b']
+    assert len(w) == 0
+
+
+def test_zero_ticks_expire_on_the_next():
+    w = TimerWheel(slots=8)
+    w.add('a', 0)
+    assert w.tick() == ['a']
+
+
+def test_longer_than_the_wheel():
+    w = TimerWheel(slots=4)
+    w.add('a', 6)  # same slot as a tick 2, one turn later
+    assert [w.tick() for _ in range(6)] == [[], [], [], [], [], ['a']]
+
+
+def test_cancel():
+    w = TimerWheel(slots=8)
+    w.add('a', 1)
+    w.add('b', 1)
+    assert w.cancel('a')
+    assert not w.cancel('a')
+    assert w.tick() == ['b']
+    assert not w.cancel('b')
+
+
+def test_add_again_moves_the_deadline():
+    w = TimerWheel(slots=8)
+    w.add('a', 1)
+    w.cancel('a')
+    w.add('a', 3)
+    assert [w.tick() for _ in range(3)] == [[], [], ['a']]
@@ -0,0 +1,42 @@
+__author__ = 'zhutong'
+
+
+class TimerWheel(object):
+    """
+    Hashed timing wheel for task deadlines
+
+    add() and cancel() are O(1). tick() is called once per resolution
+    and only looks at the keys hashed to the current slot, so the cost
+    does not grow with the number of tasks in flight.
+    """
+
+    def __init__(self, slots=3600):
+        self.slots = [dict() for _ in range(slots)]
+        self.index = {}  # key -> slot
+        self.now = 0  # ticks since start
+
+    def add(self, key, ticks):
+        expire = self.now + max(int(ticks), 1)
+        slot = expire % len(self.slots)
+        self.slots[slot][key] = expire
+        self.index[key] = slot
+
+    def cancel(self, key):
+        slot = self.index.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+            return True
+        return False
+
+    def tick(self):
+        """Advance one tick, return the keys expired"""
+        self.now += 1
+        bucket = self.slots[self.now % len(self.slots)]
+        expired = [k for k, expire in bucket.items() if expire <= self.now]
+        for key in expired:
+            del bucket[key]
+            del self.index[key]
+        return expired
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,93 @@
+import heapq
+import json
+import time
+
+from compression import inflate
+from metrics import Histogram
+
+__author__ = 'zhutong'
+
+try:
+    now = time.monotonic_ns
+except AttributeError:  # Python < 3.7
+    def now():
+        return int(time.time() * 1e9)
+
+SLOWEST = 10  # devices kept per span name
+
+
+def span(name, start, end):
+    return dict(name=name, start_ns=start, duration_ns=end - start)
+
+
+class TaskTrace(object):
+    """
+    Server side of a task dispatched with trace=true
+
+    The reply of a traced task is decoded to add the server spans, all
+    relative to the dispatch: queue (until sent to a worker), worker
+    (until its reply is back) and relay. The worker spans are moved to
+    start when the task was sent, the clocks of both sides being apart.
+    """
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.dispatched = now()
+        self.sent = None
+
+    def merge(self, payload):
+        """Reply with the server spans added, and all its spans"""
+        replied = now() - self.dispatched
+        sent = self.sent - self.dispatched if self.sent else replied
+        result = json.loads(inflate(payload))
+        spans = result.get('trace') or []
+        for s in spans:
+            s['start_ns'] += sent
+        spans[:0] = [span('queue', 0, sent), span('worker', sent, replied)]
+        spans.append(span('relay', replied, now() - self.dispatched))
+        result['trace'] = spans
+        return json.dumps(result).encode(), spans
+
+
+class TraceStats(object):
+    """Spans of all traced tasks by name, with the slowest devices"""
+
+    def __init__(self):
+        self.spans = {}  # name -> (Histogram in seconds, slowest heap)
+
+    def add(self, ip, spans):
+        for s in spans:
+            item = self.spans.get(s['name'])
+            if item is None:
+                item = self.spans[s['name']] = (Histogram(), [])
+            histogram, slowest = item
+            histogram.observe(s['duration_ns'] / 1e9)
+            entry = (s['duration_ns'], ip, s.get('command', ''))
+            if len(slowest) < SLOWEST:
+                heapq.heappush(slowest, entry)
+            elif entry > slowest[0]:
+                heapq.heapreplace(slowest, entry)
+
+    def clear(self):
+        self.spans = {}
+
+    @property
+    def summary(self):
+        summary = {}
+        for name, (histogram, slowest) in list(self.spans.items()):
+            count = sum(histogram.counts)
+            summary[name] = dict(
+                count=count,
+                mean_ms=round(histogram.sum * 1e3 / count, 3),
+                slowest=[dict(ip=ip, command=command, ms=round(ns / 1e6, 3))
+                         for ns, ip, command in sorted(slowest,
+                                                       reverse=True)])
+        return summary
+
+    def lines(self):
+        name = 'cc_trace_span_seconds'
+        yield '# HELP %s Spans of traced tasks by name' % name
+        yield '# TYPE %s histogram' % name
+        for span_name, (histogram, _) in sorted(self.spans.items()):
+            for line in histogram.lines(name, 'span="%s"' % span_name):
+                yield line
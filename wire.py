@@ -0,0 +1,69 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from config import WIRE_FORMATS
+
+__author__ = 'zhutong'
+
+# Worker replies are encoded in the format agreed when the worker got its
+# port from the port daemon: 'json' and 'orjson' are JSON on the wire and
+# pass through as is, 'msgpack' is converted to JSON for the HTTP client.
+# Tasks sent to workers are always JSON. Keep in sync with worker_base.py.
+WIRE_VERSION = 1
+
+# Port daemon reply to a worker of a wire version for a channel it does
+# not serve, followed by the channel. Older workers get 'None'.
+UNKNOWN_CHANNEL = 'ERROR unknown channel'
+
+
+def supported():
+    """Formats this server decodes, preferred first"""
+    return [f for f in WIRE_FORMATS if f != 'msgpack' or msgpack]
+
+
+def register(message):
+    """
+    Parse a worker registration: 'channel' from workers before wire
+    version 1, 'channel version format,format...' from newer ones.
+    Return the channel and the format picked, None for older workers.
+    """
+    channel, _, offer = message.partition(' ')
+    if not offer:
+        return channel, None
+    _, _, formats = offer.partition(' ')
+    offered = formats.split(',')
+    for f in supported():
+        if f in offered:
+            return channel, f
+    return channel, 'json'
+
+
+def is_msgpack(payload):
+    # workers reply a map, JSON starts with '{' and gzip with 0x1f
+    first = memoryview(payload)[0]
+    return 0x80 <= first <= 0x8f or first in (0xde, 0xdf)
+
+
+def text(obj):
+    """Command output sent as raw bytes"""
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', 'replace')
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def to_json(payload):
+    """Worker reply as JSON, a msgpack one decoded and encoded again"""
+    if not len(payload) or not is_msgpack(payload):
+        return payload
+    obj = msgpack.unpackb(payload, raw=False)
+    if orjson:
+        return orjson.dumps(obj, default=text)
+    return json.dumps(obj, default=text).encode()
@@ -1,24 +1,50 @@
 # encoding: utf-8
+"""
+The sessions of the handler are driven by cli_mux in the event loop:
+with -i, one thread runs as many sessions as tasks in flight.
+"""
 
-from time import sleep
+import asyncio
 
 from modules.worker_base import BaseWorker, main, logging
 from modules.cisco_cli_helper import CiscoCLI
+from modules.cli_mux import drive
+from modules.session_pool import (SESSION_CHECK_TIMEOUT, reusable,
+                                  session_key, sessions)
+
+
+async def acquire(key):
+    """sessions.acquire(), the alive() check run in the loop"""
+    while True:
+        cli = sessions.take(key)
+        if cli is None:
+            return None
+        if await drive(cli.alive_steps(SESSION_CHECK_TIMEOUT)):
+            return cli
+        sessions.discard(key, cli)
 
 
 class Worker(BaseWorker):
     channel = 'cisco::brocade'
     name = channel.upper()
 
-    def handler(self, task_id, params):
+    async def handler(self, task_id, params):
         commands = params['commands']
         given_name = params.get('hostname', '')
         wait_seconds = params.get('wait', 0)
         output = []
 
-        cli = CiscoCLI(params, logging)
+        reuse = reusable(params)
+        key = session_key(params)
+        cli = await acquire(key) if reuse else None
+        if cli is None:
+            cli = CiscoCLI(params, logging, self.trace, self.raw_output)
+        else:
+            cli.update(params, self.trace, self.raw_output)
         try:
-            cli.login()
+            if cli.child is None:
+                await drive(cli.login_steps())
+            self.logged_in()
             hostname = cli.hostname
             if given_name and given_name != hostname:
                 message = 'Hostname not match. Given: %s, Got: %s' % (
@@ -28,15 +54,20 @@ class Worker(BaseWorker):
                 status = 'success'
                 message = ''
             for cmd in commands:
-                cmd_out = cli.execute(cmd)
-                output.append(cmd_out)
-                sleep(wait_seconds)
+                result = await drive(cli.execute_steps(cmd))
+                self.collect(output, result)
+                if result['status'] == 'Closed':
+                    raise Exception('Closed')
+                await asyncio.sleep(wait_seconds)
         except Exception as e:
             status = 'fail'
             message = str(e)
             hostname = given_name
         finally:
-            cli.close()
+            if reuse and status == 'success' and cli.at_prompt:
+                sessions.release(key, cli)
+            else:
+                await drive(cli.close_steps())
 
         return dict(status=status,
                     message=message,
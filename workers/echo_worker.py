@@ -0,0 +1,35 @@
+# encoding: utf-8
+"""
+Zero latency stand-in of the test worker, for benchmarks
+
+Serves the test channel, replying at once with the commands given and
+an output of `size` bytes (0 by default) for each one. `delay` seconds
+of sleep can be asked for to model a device. The handler is a coroutine:
+with -i, thousands of such tasks wait at once in one thread.
+"""
+
+import asyncio
+
+from modules.worker_base import BaseWorker, main
+
+
+class Worker(BaseWorker):
+    channel = 'test'
+    name = 'ECHO'
+
+    async def handler(self, task_id, params):
+        delay = float(params.get('delay', 0))
+        if delay:
+            await asyncio.sleep(delay)
+        size = int(params.get('size', 0))
+        output = []
+        for cmd in params.get('commands', []):
+            self.collect(output, cmd + '\n' + 'A' * size)
+        return dict(status='success',
+                    message='',
+                    hostname=params.get('hostname', ''),
+                    output=output)
+
+
+if __name__ == '__main__':
+    main(Worker)
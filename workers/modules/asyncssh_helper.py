@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""
+SSH sessions on asyncssh, in process: no ssh process, pty or thread per
+session, hundreds of them run by one event loop.
+
+AsyncSSH has the login/execute/alive/close of ssh_helper.SSH, with the
+same prompt_list, hostname_pattern, no_pager_list and error_sign, as
+coroutines but close(). Handlers run in an event loop (-i of the
+worker) await them. EngineSSH runs them from worker threads in the
+event loop of the process (engine), its methods block like those of
+SSH.
+"""
+
+import asyncio
+import logging
+import re
+from threading import Lock, Thread
+from time import strftime
+
+import asyncssh
+
+from .trace import NO_TRACE
+
+__author__ = 'zhutong'
+
+asyncssh.set_log_level(logging.WARNING)  # not a line per connection
+
+READ_SIZE = 65536
+OVERLAP = 256  # bytes searched again for a prompt split across reads
+
+
+class AsyncSSH(object):
+
+    def __init__(self, device_info, logger, prompt_list, hostname_pattern,
+                 no_pager_list, error_sign, trace=NO_TRACE, raw=False):
+        self.update(device_info, trace, raw)
+        self.logger = logger
+        self.prompt_list = prompt_list
+        self.hostname_pattern = hostname_pattern
+        self.no_pager_list = no_pager_list
+        self.error_sign = error_sign
+        self.child = None  # the shell process, once logged in
+        self.conn = None
+        self.loop = None  # of the connection
+        self.at_prompt = True  # every command output read up to the prompt
+        self.buffer = bytearray()
+
+    def update(self, device_info, trace=NO_TRACE, raw=False):
+        """Settings of the request, given again when the session is reused"""
+        self.device_info = device_info
+        self.timeout = device_info.get('timeout', 10)
+        self.trace = trace
+        self.raw = raw  # command outputs as bytes
+
+    async def read_until(self, pattern, timeout):
+        """
+        Read until pattern (compiled, bytes) is found, return the bytes
+        before and the match. EOFError with what was read on EOF.
+        """
+        buf = self.buffer
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        start = 0
+        while True:
+            m = pattern.search(buf, start)
+            if m:
+                before, after = bytes(buf[:m.start()]), bytes(m.group())
+                del buf[:m.end()]
+                return before, after
+            start = max(0, len(buf) - OVERLAP)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            data = await asyncio.wait_for(self.child.stdout.read(READ_SIZE),
+                                          remaining)
+            if not data:
+                rest = bytes(buf)
+                del buf[:]
+                raise EOFError(rest)
+            buf += data
+
+    def send(self, line):
+        self.child.stdin.write(line.encode() + b'\n')
+
+    async def login(self):
+        ip = self.device_info['ip']
+        username = self.device_info.get('username')
+        password = self.device_info.get('password')
+        port = int(self.device_info.get('port') or 22)
+        timeout = self.timeout
+        prompt = re.compile(self.prompt_list[0].encode())
+        trace = self.trace
+        trace.begin()
+        try:
+            self.logger.info('asyncssh %s as %s', ip, username)
+            self.loop = asyncio.get_event_loop()
+            try:
+                self.conn = await asyncio.wait_for(asyncssh.connect(
+                    ip, port, username=username, password=password,
+                    known_hosts=None, client_keys=None, agent_path=None,
+                    preferred_auth='password,keyboard-interactive'),
+                    timeout)
+            except asyncssh.PermissionDenied:
+                raise Exception('LoginException.LOGIN_FAILED')
+            except asyncio.TimeoutError:
+                raise Exception('LoginException.LOGIN_TIMEOUT')
+            except (OSError, asyncssh.Error):
+                raise Exception('LoginException.CONNECTION_CLOSED')
+            trace.lap('connect', method='asyncssh')
+            self.child = await self.conn.create_process(
+                term_type='dumb', encoding=None)
+            try:
+                before, _ = await self.read_until(prompt, timeout)
+                trace.lap('auth')
+                for line in self.no_pager_list:
+                    self.send(line)
+                    before, _ = await self.read_until(prompt, timeout)
+            except asyncio.TimeoutError:
+                raise Exception('LoginException.LOGIN_TIMEOUT')
+            except EOFError:
+                raise Exception('LoginException.CONNECTION_CLOSED')
+            trace.lap('no_pager')
+            last_line = before.splitlines()[-1].decode()
+            self.prompt = last_line + self.prompt_list[0]
+            try:
+                hostname = self.hostname_pattern.findall(self.prompt)[0]
+            except:
+                hostname = self.device_info.get('hostname', '')
+            self.hostname = hostname
+            self.logger.info('asyncssh %s success. Got hostname: %s',
+                             ip, hostname)
+            self.expect_pattern = re.compile(b'|'.join(
+                re.escape(p.encode())
+                for p in (self.prompt,) + tuple(self.prompt_list[1:])))
+            return self.hostname
+        except Exception as e:
+            self.logger.warning('asyncssh %s failed: %s', ip, e)
+            self.close()
+            raise
+
+    async def execute(self, command):
+        ip = self.hostname or self.device_info['ip']
+        self.trace.begin()
+        self.logger.info('%s execute: %s', ip, command)
+        self.send(command)
+        try:
+            before, after = await self.read_until(self.expect_pattern,
+                                                  self.timeout)
+            data = before + after
+        except asyncio.TimeoutError:
+            self.at_prompt = False
+            msg = 'Timeout'
+            self.logger.error('Timeout execute: %s @ %s', command, ip)
+            self.trace.lap('command', command=command, status=msg)
+            raise Exception(msg)
+        except (EOFError, asyncssh.ConnectionLost):
+            self.at_prompt = False
+            msg = 'Closed'
+            self.logger.error('Closed execute: %s @ %s', command, ip)
+            self.trace.lap('command', command=command, status=msg)
+            raise Exception(msg)
+        output = data if self.raw else data.decode('utf-8', 'replace')
+        if self.error_sign and self.error_sign.encode() in data:
+            status = 'Error'
+        else:
+            status = 'Ok'
+        timestamp = strftime('%Y-%m-%d %H:%M:%S')
+        self.trace.lap('command', command=command, status=status)
+        return dict(command=command, status=status, output=output,
+                    timestamp=timestamp)
+
+    async def alive(self, timeout):
+        """Back at the prompt after a newline, for a pooled session"""
+        try:
+            self.send('')
+            await self.read_until(self.expect_pattern, timeout)
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        """From any thread, the connection is closed in its loop"""
+        if self.conn is None:
+            return
+        if not in_loop(self.loop):  # a pooled session evicted
+            self.loop.call_soon_threadsafe(self.close)
+            return
+        self.conn.close()
+        self.logger.info('Disconnected from %s', self.device_info['ip'])
+        self.conn = self.child = None
+
+
+def in_loop(loop):
+    """Called from the thread running loop"""
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class Engine(object):
+    """An event loop thread running coroutines for the worker threads"""
+
+    def __init__(self):
+        self.loop = None
+        self.lock = Lock()
+
+    def run(self, coro):
+        """Result of coro, run in the loop, waited for in this thread"""
+        if self.loop is None:
+            with self.lock:
+                if self.loop is None:
+                    loop = asyncio.new_event_loop()
+                    t = Thread(target=loop.run_forever)
+                    t.daemon = True
+                    t.start()
+                    self.loop = loop
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+engine = Engine()
+
+
+class EngineSSH(AsyncSSH):
+    """AsyncSSH with blocking methods, the interface of ssh_helper.SSH"""
+
+    def login(self):
+        return engine.run(AsyncSSH.login(self))
+
+    def execute(self, command):
+        return engine.run(AsyncSSH.execute(self, command))
+
+    def alive(self, timeout):
+        return engine.run(AsyncSSH.alive(self, timeout))
@@ -3,26 +3,77 @@
 __version__ = 0.5
 __author__ = 'zhutong <zhtong@cisco.com>'
 
+from tornado import options
+
 from .worker_base import BaseWorker, main, logging
+from .session_pool import (SESSION_CHECK_TIMEOUT, reusable, session_key,
+                           sessions)
 from .ssh_helper import SSH
 
+options.define("transport", default='pexpect', type=str,
+               help="SSH transport: pexpect (an ssh process per session) "
+                    "or asyncssh (in process; with -i, every session in "
+                    "the event loop of the worker)")
+
+
+def session_class():
+    if options.options.transport == 'asyncssh':
+        from .asyncssh_helper import EngineSSH  # asyncssh is optional
+        return EngineSSH
+    return SSH
+
+
+def in_loop():
+    """asyncssh sessions awaited by the handler in the loop of -i"""
+    return options.options.transport == 'asyncssh' and \
+        bool(options.options.i)
+
+
+async def acquire(key):
+    """sessions.acquire(), the alive() check awaited in the loop"""
+    while True:
+        session = sessions.take(key)
+        if session is None:
+            return None
+        if await session.alive(SESSION_CHECK_TIMEOUT):
+            return session
+        sessions.discard(key, session)
+
 
 class SSHWorker(BaseWorker):
 
+    @classmethod
+    def is_async(cls):
+        return in_loop()
+
     def handler(self, task_id, params):
+        if in_loop():
+            return self.async_handler(task_id, params)
         commands = params['commands']
         given_name = params.get('hostname', '')
         wait_seconds = params.get('wait', 0)
         output = []
 
-        worker = SSH(params,
-                     logging,
-                     self.prompt_list,
-                     self.hostname_pattern,
-                     self.no_pager_list,
-                     self.error_sign)
+        reuse = reusable(params)
+        key = session_key(params)
+        worker = sessions.acquire(key) if reuse else None
+        if worker is None:
+            worker = session_class()(params,
+                                     logging,
+                                     self.prompt_list,
+                                     self.hostname_pattern,
+                                     self.no_pager_list,
+                                     self.error_sign,
+                                     self.trace,
+                                     self.raw_output)
+        else:
+            worker.update(params, self.trace, self.raw_output)
         try:
-            hostname = worker.login()
+            if worker.child is None:
+                hostname = worker.login()
+            else:
+                hostname = worker.hostname
+            self.logged_in()
             if given_name and given_name != hostname:
                 message = 'Hostname not match. Given: %s, Got: %s' % (
                     given_name, hostname)
@@ -31,7 +82,7 @@ class SSHWorker(BaseWorker):
                 status = 'success'
                 message = ''
             for cmd in params['commands']:
-                output.append(worker.execute(cmd))
+                self.collect(output, worker.execute(cmd))
             status = 'success'
             message = ''
         except Exception as e:
@@ -39,7 +90,59 @@ class SSHWorker(BaseWorker):
             hostname = given_name
             message = str(e)
         finally:
-            worker.close()
+            if reuse and status == 'success' and worker.at_prompt:
+                sessions.release(key, worker)
+            else:
+                worker.close()
+
+        return dict(status=status,
+                    hostname=hostname,
+                    message=message,
+                    output=output)
+
+    async def async_handler(self, task_id, params):
+        """handler() on AsyncSSH sessions, in the loop of the runtime"""
+        from .asyncssh_helper import AsyncSSH
+        given_name = params.get('hostname', '')
+        output = []
+
+        reuse = reusable(params)
+        key = session_key(params)
+        worker = await acquire(key) if reuse else None
+        if worker is None:
+            worker = AsyncSSH(params,
+                              logging,
+                              self.prompt_list,
+                              self.hostname_pattern,
+                              self.no_pager_list,
+                              self.error_sign,
+                              self.trace,
+                              self.raw_output)
+        else:
+            worker.update(params, self.trace, self.raw_output)
+        try:
+            if worker.child is None:
+                hostname = await worker.login()
+            else:
+                hostname = worker.hostname
+            self.logged_in()
+            if given_name and given_name != hostname:
+                message = 'Hostname not match. Given: %s, Got: %s' % (
+                    given_name, hostname)
+                raise Exception(message)
+            for cmd in params['commands']:
+                self.collect(output, await worker.execute(cmd))
+            status = 'success'
+            message = ''
+        except Exception as e:
+            status = 'fail'
+            hostname = given_name
+            message = str(e)
+        finally:
+            if reuse and status == 'success' and worker.at_prompt:
+                sessions.release(key, worker)
+            else:
+                worker.close()
 
         return dict(status=status,
                     hostname=hostname,
@@ -10,6 +10,10 @@ from time import strftime
 
 import pexpect
 
+from .cli_mux import CLOSE, EXPECT, PROMPT, SEND, run
+from .prompt_reader import prompt_regex
+from .trace import NO_TRACE
+
 
 class LoginException(Exception):
     LOGIN_TIMEOUT = -1
@@ -34,41 +38,65 @@ class LoginException(Exception):
 
 
 class CiscoCLI(object):
+    """
+    login/execute/alive/close block the calling thread. Their *_steps
+    generators are the same, for cli_mux.drive() in an event loop.
+    Command outputs are bytes if raw, for a wire format carrying them.
+    """
     TELNET_STR = 'telnet %s %d'
     SSH_STR = 'ssh -p %d -o "UserKnownHostsFile /dev/null" -l %s %s'
     SSH_V1_STR = 'ssh -1 -p %d -o "UserKnownHostsFile /dev/null" -l %s %s'
 
-    def __init__(self, device_info, logger):
-        self.device_info = device_info
+    def __init__(self, device_info, logger, trace=NO_TRACE, raw=False):
+        self.update(device_info, trace, raw)
         self.ip = device_info['ip']
-        self.timeout = device_info.get('timeout', 30)
         self.username = device_info.get('username')
         self.password = device_info.get('password')
         self.enable_password = device_info.get('enable_password')
         self.method = device_info.get('method', 'ssh').lower()
         self.port = device_info.get('port')
         self.extra_prompts = device_info.get('extra_prompts')
-        self.error_sign = device_info.get('error_sign', " '^' ")
         self.logger = logger
         self.child = None
+        self.at_prompt = True  # every command output read up to the prompt
+
+    def update(self, device_info, trace=NO_TRACE, raw=False):
+        """Settings of the request, given again when the session is reused"""
+        self.device_info = device_info
+        self.timeout = device_info.get('timeout', 30)
+        self.error_sign = device_info.get('error_sign', " '^' ")
+        self.trace = trace
+        self.raw = raw
 
     def login(self):
+        return run(self.login_steps())
+
+    def execute(self, command):
+        return run(self.execute_steps(command))
+
+    def alive(self, timeout):
+        return run(self.alive_steps(timeout))
+
+    def close(self):
+        run(self.close_steps())
+
+    def login_steps(self):
         try:
-            return self.__login()
+            return (yield from self.__login_steps())
         except LoginException as e:
             if e.err_code == LoginException.CONNECTION_CLOSED:
                 if self.method == 'telnet':
                     self.method = 'ssh'
                 else:
                     self.method = 'telnet'
-                return self.__login()
+                return (yield from self.__login_steps())
             elif e.err_code == LoginException.SSH_VERSION_ERROR:
                 self.method = 'ssh_1'
-                return self.__login()
+                return (yield from self.__login_steps())
             else:
                 raise
 
-    def __login(self):
+    def __login_steps(self):
         ip = self.ip
         method = self.method
         username = self.username
@@ -79,6 +107,8 @@ class CiscoCLI(object):
         device_type = 'cisco'
 
         child = self.child
+        trace = self.trace
+        trace.begin()
         try:
             if method == 'telnet':
                 port = port or 23
@@ -101,26 +131,28 @@ class CiscoCLI(object):
                              '.*>',
                              pexpect.TIMEOUT,
                              pexpect.EOF]
-            i = child.expect(first_pattern, timeout=timeout)
+            i = yield child, EXPECT, first_pattern, timeout
+            trace.lap('connect', method=method)
             if i == 4:
                 raise LoginException(LoginException.LOGIN_TIMEOUT)
             if i == 5:
                 raise LoginException(LoginException.CONNECTION_CLOSED)
             if i < 3:
                 if i == 0:
-                    child.sendline(username)
-                    child.expect(['.*assword:'], timeout=timeout)
+                    yield child, SEND, username, None
+                    yield child, EXPECT, ['.*assword:'], timeout
                 elif i == 2:
-                    child.sendline('yes')
-                    child.expect(['.*assword:'], timeout=timeout)
-                child.sendline(password)
+                    yield child, SEND, 'yes', None
+                    yield child, EXPECT, ['.*assword:'], timeout
+                yield child, SEND, password, None
                 second_pattern = ['.*sername:',
                                   '.*assword:',
                                   '.*>',
                                   '.*#',
                                   pexpect.TIMEOUT,
                                   pexpect.EOF]
-                i = child.expect(second_pattern, timeout=timeout)
+                i = yield child, EXPECT, second_pattern, timeout
+                trace.lap('auth')
                 if i < 2:
                     raise LoginException(LoginException.LOGIN_FAILED)
                 if i == 4:
@@ -132,15 +164,15 @@ class CiscoCLI(object):
                 prompt = first_pattern[i][-1]
 
             if prompt == '>' and enable_password:  # user mode
-                child.sendline('enable')
-                i = child.expect(['.*assword:', '>'], timeout=5)
+                yield child, SEND, 'enable', None
+                i = yield child, EXPECT, ['.*assword:', '>'], 5
                 if i == 0:
-                    child.sendline(enable_password)
+                    yield child, SEND, enable_password, None
                     third_pattern = ['.*assword:',
                                      '.*#',
                                      pexpect.TIMEOUT,
                                      pexpect.EOF]
-                    i = child.expect(third_pattern, timeout=timeout)
+                    i = yield child, EXPECT, third_pattern, timeout
                     if i == 0:
                         raise LoginException(LoginException.ENABLE_FAILED)
                     if i == 2:
@@ -150,14 +182,16 @@ class CiscoCLI(object):
                     prompt = '#'
                 elif i == 1:
                     prompt = '>'
+                trace.lap('enable')
 
             if prompt == '#':
                 # child.sendline('terminal pager 0')
-                child.sendline('terminal length 0')
-                child.expect('terminal length 0', timeout=timeout)
+                yield child, SEND, 'terminal length 0', None
+                yield child, EXPECT, 'terminal length 0', timeout
             else:
-                child.sendline('')
-            child.expect(prompt, timeout=timeout)
+                yield child, SEND, '', None
+            yield child, EXPECT, prompt, timeout
+            trace.lap('terminal_length')
             self.prompt = last_line = ''.join(
                 (child.before.splitlines()[-1].decode('utf-8'), prompt))
             if ':' in last_line and 'RP' in last_line:  # IOX
@@ -199,12 +233,13 @@ class CiscoCLI(object):
             if self.extra_prompts:
                 extra_prompts = [re.escape(p) for p in self.extra_prompts]
                 self.expect_pattern.extend(extra_prompts)
+            self.prompt_re = prompt_regex(self.expect_pattern[3:])
             return self.prompt
         except LoginException as e:
             if (self.method == 'ssh') and (b'versions differ' in child.before):
                 raise LoginException(LoginException.SSH_VERSION_ERROR)
             else:
-                child.close()
+                yield child, CLOSE, None, None
                 self.logger.warning('%s %s failed: %s' %
                                     (method, ip, e.err_msg))
                 raise Exception(e.err_msg)
@@ -214,39 +249,49 @@ class CiscoCLI(object):
         except:
             raise
 
-    def execute(self, command):
-        expect_pattern = self.expect_pattern
+    def execute_steps(self, command):
         child = self.child
-        res = []
-        timeout = self.timeout
+        self.trace.begin()
         self.logger.info('%s execute: %s' % (self.ip, command))
-        child.sendline(command)
-        while True:
-            c = child.expect(expect_pattern, timeout=timeout)
-            res.append(child.before.decode('utf-8'))
-            try:
-                res.append(str(child.after.decode('utf-8')))
-            except:
-                break
-            if c > 0:
-                break
-        output = ''.join(res)
-        if c == 1:
+        yield child, SEND, command, None
+        data, end = yield child, PROMPT, self.prompt_re, self.timeout
+        output = bytes(data) if self.raw else data.decode('utf-8')
+        if end != 'prompt':
+            self.at_prompt = False
+        if end == 'timeout':
             status = 'Timeout'
             self.logger.error('Timeout execute: %s @ %s' % (command, self.ip))
-        elif self.error_sign in output:
+        elif end == 'eof':  # the device closed the session
+            status = 'Closed'
+            self.logger.error('Closed execute: %s @ %s' % (command, self.ip))
+        elif self.error_sign.encode() in data:
             status = 'Error'
         else:
             status = 'Ok'
         timestamp = strftime('%Y-%m-%d %H:%M:%S')
+        self.trace.lap('command', command=command, status=status)
         return dict(command=command, status=status, output=output, timestamp=timestamp)
 
-    def close(self):
+    def alive_steps(self, timeout):
+        """Back at the prompt after a newline, for a pooled session"""
+        child = self.child
+        try:
+            if not child.isalive():
+                return False
+            yield child, SEND, '', None
+            i = yield child, EXPECT, [re.escape(self.prompt),
+                                      pexpect.TIMEOUT,
+                                      pexpect.EOF], timeout
+            return i == 0
+        except Exception:
+            return False
+
+    def close_steps(self):
         try:
-            self.child.sendline('end')
-            self.child.sendline('exit')
-            self.child.expect([pexpect.EOF, pexpect.TIMEOUT])
-            self.child.close()
+            yield self.child, SEND, 'end', None
+            yield self.child, SEND, 'exit', None
+            yield self.child, EXPECT, [pexpect.EOF, pexpect.TIMEOUT], -1
+            yield self.child, CLOSE, None, None
             self.logger.info('Disconnected from %s' % self.ip)
         except:
             pass
@@ -0,0 +1,150 @@
+# encoding: utf-8
+"""
+Many pexpect CLI sessions driven by one thread
+
+The methods of CiscoCLI are generators yielding what they wait for, a
+step (child, kind, argument, timeout):
+
+    SEND    child.sendline() of the argument
+    EXPECT  child.expect() of the argument, patterns; sent the index
+    PROMPT  read_until_prompt() with the argument, a prompt regex;
+            sent (output, 'prompt'|'timeout'|'eof')
+    CLOSE   child.close(), which may block
+
+Exceptions of pexpect (TIMEOUT, EOF) are thrown into the generator, its
+return value is the result. run() drives it with the blocking calls, in
+the calling thread. drive() is a coroutine: the pty of every session is
+watched by the selector of the event loop and read once readable, so a
+session waiting for its device holds no thread; one loop runs hundreds
+of them (-i of the worker).
+"""
+
+import asyncio
+
+import pexpect
+from pexpect.expect import Expecter, searcher_re
+
+from .prompt_reader import READ_SIZE, PromptReader, read_until_prompt
+
+__author__ = 'zhutong'
+
+SEND, EXPECT, PROMPT, CLOSE = 'send', 'expect', 'prompt', 'close'
+
+
+def run(steps):
+    """Result of a step generator, waiting in this thread"""
+    value = error = None
+    while True:
+        try:
+            if error is None:
+                child, kind, arg, timeout = steps.send(value)
+            else:
+                child, kind, arg, timeout = steps.throw(error)
+        except StopIteration as e:
+            return e.value
+        value = error = None
+        try:
+            if kind == SEND:
+                child.sendline(arg)
+            elif kind == EXPECT:
+                value = child.expect(arg, timeout=timeout)
+            elif kind == PROMPT:
+                value = read_until_prompt(child, arg, timeout)
+            else:
+                child.close()
+        except Exception as e:
+            error = e
+
+
+async def drive(steps):
+    """Result of a step generator, waiting in the event loop"""
+    value = error = None
+    while True:
+        try:
+            if error is None:
+                child, kind, arg, timeout = steps.send(value)
+            else:
+                child, kind, arg, timeout = steps.throw(error)
+        except StopIteration as e:
+            return e.value
+        value = error = None
+        try:
+            if kind == SEND:
+                await sendline(child, arg)
+            elif kind == EXPECT:
+                value = await expect(child, arg, timeout)
+            elif kind == PROMPT:
+                value = await until_prompt(child, arg, timeout)
+            else:  # waits for the process to exit, out of the loop
+                await asyncio.get_event_loop().run_in_executor(
+                    None, child.close)
+        except Exception as e:
+            error = e
+
+
+async def sendline(child, line):
+    """child.sendline(line), its delaybeforesend slept in the loop"""
+    delay = child.delaybeforesend
+    if delay:
+        await asyncio.sleep(delay)
+    child.delaybeforesend = None
+    try:
+        child.sendline(line)
+    finally:
+        child.delaybeforesend = delay
+
+
+async def readable(fd, timeout):
+    """Wait for fd to be readable, asyncio.TimeoutError after timeout"""
+    loop = asyncio.get_event_loop()
+    ready = loop.create_future()
+    loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+    try:
+        await asyncio.wait_for(ready, timeout)
+    finally:
+        loop.remove_reader(fd)
+
+
+def read(child):
+    """What the pty of child has, once readable; EOF if closed"""
+    return child.read_nonblocking(READ_SIZE, 0)
+
+
+async def expect(child, patterns, timeout=-1):
+    """child.expect(patterns, timeout) without blocking the loop"""
+    if timeout == -1:
+        timeout = child.timeout
+    exp = Expecter(child, searcher_re(child.compile_pattern_list(patterns)))
+    loop = asyncio.get_event_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    try:
+        index = exp.existing_data()
+        while index is None:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - loop.time())
+            await readable(child.child_fd, remaining)
+            index = exp.new_data(read(child))
+        return index
+    except asyncio.TimeoutError as e:
+        return exp.timeout(e)
+    except pexpect.EOF as e:
+        return exp.eof(e)
+    except BaseException:
+        exp.errored()
+        raise
+
+
+async def until_prompt(child, prompt_re, timeout):
+    """read_until_prompt() without blocking the loop"""
+    reader = PromptReader(prompt_re)
+    end = reader.start(child)
+    try:
+        while end is None:
+            await readable(child.child_fd, timeout)
+            end = reader.feed(read(child))
+    except asyncio.TimeoutError:
+        return reader.buffer, 'timeout'
+    except pexpect.EOF:
+        return reader.buffer, 'eof'
+    return reader.finish(child, end), 'prompt'
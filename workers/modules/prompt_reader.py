@@ -0,0 +1,81 @@
+# encoding: utf-8
+"""
+Command outputs read up to the prompt in large chunks
+
+expect() with a '.*\\r\\n' pattern takes one line per call, scanning its
+buffer again against every pattern, and each line is decoded on its
+own. Here the output goes to a bytearray, a read at a time, and only
+its last line, not ended yet, is searched for a prompt: a prompt is
+what a device prints without a newline once a command is done.
+"""
+
+import re
+
+import pexpect
+
+__author__ = 'zhutong'
+
+READ_SIZE = 65536  # bytes asked per read, the pty gives what it has
+
+
+def prompt_regex(patterns):
+    """One bytes regex out of expect() patterns, str regexes"""
+    return re.compile('|'.join('(?:%s)' % p for p in patterns).encode())
+
+
+class PromptReader(object):
+    """The output of one command, fed as it comes"""
+
+    def __init__(self, prompt_re):
+        self.prompt_re = prompt_re
+        self.buffer = bytearray()
+        self.line_start = 0  # of the last line, not ended yet
+
+    def feed(self, data):
+        """Add output, return the end of the prompt once in, else None"""
+        buf = self.buffer
+        start = len(buf)
+        buf += data
+        nl = buf.rfind(b'\n', start)
+        if nl >= 0:
+            self.line_start = nl + 1
+        m = self.prompt_re.search(buf, self.line_start)
+        return m.end() if m else None
+
+    def start(self, child):
+        """Take what the child has read already, as feed()"""
+        end = self.feed(child.buffer)
+        give_back(child, b'')
+        return end
+
+    def finish(self, child, end):
+        """The output up to end, what follows given back to the child"""
+        give_back(child, bytes(self.buffer[end:]))
+        del self.buffer[end:]
+        return self.buffer
+
+
+def give_back(child, data):
+    """Bytes read past the prompt, for the next expect() of the child"""
+    child.buffer = data
+    # pexpect 4 searches what followed its last match from here too
+    child._before = child.buffer_type()
+    child._before.write(data)
+
+
+def read_until_prompt(child, prompt_re, timeout):
+    """
+    Output of a command off a pexpect child, its prompt included, and
+    'prompt'; or what was read and 'timeout' (nothing for timeout
+    seconds) or 'eof'. What follows the prompt is left to the child.
+    """
+    reader = PromptReader(prompt_re)
+    end = reader.start(child)
+    try:
+        while end is None:
+            end = reader.feed(child.read_nonblocking(READ_SIZE, timeout))
+    except pexpect.TIMEOUT:
+        return reader.buffer, 'timeout'
+    except pexpect.EOF:
+        return reader.buffer, 'eof'
+    return reader.finish(child, end), 'prompt'
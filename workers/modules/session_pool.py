@@ -0,0 +1,153 @@
+# encoding: utf-8
+
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+
+__author__ = 'zhutong'
+
+SESSION_POOL_SIZE = 100  # idle sessions kept by a worker process
+SESSION_IDLE_TTL = 300  # seconds, below the exec-timeout of the devices
+SESSION_CHECK_TIMEOUT = 5  # seconds to get the prompt back when reused
+
+
+def session_key(params):
+    """
+    A session is only reused by a request which would have logged in the
+    same way: same credentials (hashed) and extra prompts, which the
+    prompt regex of the session is made of at login. Other settings of
+    the request are applied to the session by its update().
+    """
+    secrets = [params.get(k) or '' for k in ('password', 'enable_password')]
+    credentials = hashlib.sha256(json.dumps(secrets).encode()).hexdigest()
+    return (params['ip'], params.get('port'), params.get('username'),
+            params.get('method', 'ssh').lower(), credentials,
+            tuple(params.get('extra_prompts') or ()))
+
+
+def reusable(params):
+    """A request may opt out with reuse_session=false"""
+    reuse = params.get('reuse_session', True)
+    if isinstance(reuse, str):
+        return reuse.lower() not in ('0', 'false', 'no', 'off')
+    return bool(reuse)
+
+
+def close_all(sessions):
+    """Log out in the background, a dead session may block until timeout"""
+    if not sessions:
+        return
+
+    def close():
+        for session in sessions:
+            session.close()
+
+    t = Thread(target=close)
+    t.daemon = True
+    t.start()
+
+
+class SessionPool(object):
+    """
+    Logged in CLI sessions (CiscoCLI or SSH) kept between tasks
+
+    A session is taken out of the pool by the thread using it and put
+    back once its task succeeded, so a session is never shared. Only a
+    session with every command output read up to the prompt (at_prompt)
+    is put back: after a timeout, the rest of an output would be read as
+    the one of the next command. Sessions idle for idle_ttl seconds are
+    closed, and the least recently used ones when there are more than
+    size. A session is only reused once its alive() check got the
+    prompt back.
+
+    At most one session per key is kept idle, the last one released: an
+    idle session still holds a vty line of the device, which the server
+    does not count against MAX_SESSIONS_PER_DEVICE (running tasks only).
+    A device may thus have up to that limit plus one line per worker
+    process open; size vty lines for it, or have requests to devices
+    short of lines set reuse_session=false.
+    """
+
+    def __init__(self, size=SESSION_POOL_SIZE, idle_ttl=SESSION_IDLE_TTL):
+        self.size = size
+        self.idle_ttl = idle_ttl
+        self.idle = OrderedDict()  # key -> [(session, released at)], LRU first
+        self.count = 0
+        self.lock = Lock()
+        self.sweeper = None
+
+    def acquire(self, key):
+        """An idle session for key still at its prompt, None if none"""
+        while True:
+            session = self.take(key)
+            if session is None:
+                return None
+            if session.alive(SESSION_CHECK_TIMEOUT):
+                return session
+            self.discard(key, session)
+
+    def take(self, key):
+        """The most recent idle session for key, not checked, or None"""
+        with self.lock:
+            expired = self.__expire(time.time())
+            sessions = self.idle.get(key)
+            session = None
+            if sessions:
+                session, _ = sessions.pop()
+                self.count -= 1
+                if not sessions:
+                    del self.idle[key]
+        close_all(expired)
+        return session
+
+    def discard(self, key, session):
+        """A taken session which failed its alive() check"""
+        logging.info('Pooled session to %s is gone', key[0])
+        close_all([session])
+
+    def release(self, key, session):
+        now = time.time()
+        with self.lock:
+            sessions = self.idle.setdefault(key, [])
+            evicted = [old for old, _ in sessions]  # one idle per key
+            self.count += 1 - len(sessions)
+            sessions[:] = [(session, now)]
+            self.idle.move_to_end(key)
+            evicted.extend(self.__expire(now))
+            while self.count > self.size:
+                oldest, sessions = next(iter(self.idle.items()))
+                evicted.append(sessions.pop(0)[0])
+                self.count -= 1
+                if not sessions:
+                    del self.idle[oldest]
+            if self.sweeper is None:
+                self.sweeper = Thread(target=self.__sweep)
+                self.sweeper.daemon = True
+                self.sweeper.start()
+        close_all(evicted)
+
+    def __expire(self, now):
+        """Take the sessions idle for too long out, lock held"""
+        expired = []
+        deadline = now - self.idle_ttl
+        for key in list(self.idle):
+            sessions = self.idle[key]
+            while sessions and sessions[0][1] < deadline:
+                expired.append(sessions.pop(0)[0])
+                self.count -= 1
+            if not sessions:
+                del self.idle[key]
+        return expired
+
+    def __sweep(self):
+        while True:
+            time.sleep(self.idle_ttl / 10.0)
+            with self.lock:
+                expired = self.__expire(time.time())
+            close_all(expired)
+
+
+sessions = SessionPool()
@@ -2,19 +2,29 @@
 
 from pysnmp.entity.rfc3413.oneliner import cmdgen
 
+from .trace import NO_TRACE
+
 
 class SNMP():
+    """
+    cmd_gen may be given to reuse a CommandGenerator: a new one loads its
+    MIBs on first use, which takes much longer than the request itself.
+    A CommandGenerator is not thread safe, keep one per thread.
+    """
+
     def __init__(self, ip, community, logger,
                  port, timeout, retries,
-                 non_repeaters, max_repetitions):
+                 non_repeaters, max_repetitions, trace=NO_TRACE,
+                 cmd_gen=None):
         self.logger = logger
+        self.trace = trace
         self.ip = ip
         self.port = port
         self.timeout = timeout
         self.retries = retries
         self.non_repeaters = non_repeaters
         self.max_repetitions = max_repetitions
-        self.cmd_gen = cmdgen.CommandGenerator()
+        self.cmd_gen = cmd_gen or cmdgen.CommandGenerator()
         self.community_data = cmdgen.CommunityData(community)
         self.transport_target = cmdgen.UdpTransportTarget((ip, port),
                                                           timeout=timeout,
@@ -22,11 +32,13 @@ class SNMP():
 
     def get(self, *oid_str):
         cmd_gen = self.cmd_gen
+        self.trace.begin()
         error_indication, error_status, error_index, var_binds = cmd_gen.getCmd(
             self.community_data,
             self.transport_target,
             *oid_str
         )
+        self.trace.lap('request', oids=len(oid_str))
         if error_indication:
             self.logger.error('%s: %s', error_indication, self.ip)
             return dict(status='error',
@@ -43,17 +55,20 @@ class SNMP():
                 for name, val in var_binds:
                     output.append(dict(oid=str(name),
                                        value=val.prettyPrint()))
+                self.trace.lap('format')
                 return dict(status='success',
                             message='',
                             output=output)
 
     def walk(self, *oid_str):
         cmd_gen = self.cmd_gen
+        self.trace.begin()
         error_indication, error_status, error_index, var_bind_table = cmd_gen.nextCmd(
             self.community_data,
             self.transport_target,
             *oid_str
         )
+        self.trace.lap('request', oids=len(oid_str))
         if error_indication:
             self.logger.error('%s: %s', error_indication, self.ip)
             return dict(status='error',
@@ -74,19 +89,21 @@ class SNMP():
                     if oid_str[0] not in row[0][0]:
                         break
                     output.append(row)
-
+                self.trace.lap('format')
                 return dict(status='success',
                             message='',
                             output=output)
 
     def bulk_walk(self, *oid_str):
         cmd_gen = self.cmd_gen
+        self.trace.begin()
         error_indication, error_status, error_index, var_bind_table = cmd_gen.bulkCmd(
             self.community_data,
             self.transport_target,
             self.non_repeaters, self.max_repetitions,
             *oid_str
         )
+        self.trace.lap('request', oids=len(oid_str))
         if error_indication:
             self.logger.error('%s: %s', error_indication, self.ip)
             return dict(status='error',
@@ -107,7 +124,7 @@ class SNMP():
                     if oid_str[0] not in row[0][0]:
                         break
                     output.append(row)
-
+                self.trace.lap('format')
                 return dict(status='success',
                             message='',
                             output=output)
@@ -12,37 +12,51 @@ from time import strftime
 
 import pexpect
 
-SSH_V1_STR = 'ssh -1 -o "UserKnownHostsFile /dev/null" -l %s %s'
-SSH_V2_STR = 'ssh -2 -o "UserKnownHostsFile /dev/null" -l %s %s'
+from .prompt_reader import prompt_regex, read_until_prompt
+from .trace import NO_TRACE
+
+SSH_V1_STR = 'ssh -1 -p %d -o "UserKnownHostsFile /dev/null" -l %s %s'
+SSH_V2_STR = 'ssh -2 -p %d -o "UserKnownHostsFile /dev/null" -l %s %s'
 
 
 class SSH():
 
-    def __init__(self, device_info, logger, prompt_list, hostname_pattern, no_pager_list, error_sign):
-        self.device_info = device_info
+    def __init__(self, device_info, logger, prompt_list, hostname_pattern, no_pager_list, error_sign,
+                 trace=NO_TRACE, raw=False):
+        self.update(device_info, trace, raw)
         self.method = device_info.get('method', 'ssh').lower() or 'ssh'
-        self.timeout = device_info.get('timeout', 10)
         self.logger = logger
         self.prompt_list = prompt_list
         self.hostname_pattern = hostname_pattern
         self.no_pager_list = no_pager_list
         self.error_sign = error_sign
         self.child = None
+        self.at_prompt = True  # every command output read up to the prompt
+
+    def update(self, device_info, trace=NO_TRACE, raw=False):
+        """Settings of the request, given again when the session is reused"""
+        self.device_info = device_info
+        self.timeout = device_info.get('timeout', 10)
+        self.trace = trace
+        self.raw = raw  # command outputs as bytes
 
     def login(self):
         ip = self.device_info['ip']
         username = self.device_info.get('username')
         password = self.device_info.get('password')
+        port = int(self.device_info.get('port') or 22)
         timeout = self.timeout
         prompt = self.prompt_list[0]
         child = self.child
+        trace = self.trace
+        trace.begin()
         try:
             if self.method != 'ssh':
                 self.logger.info('ssh(v1) %s as %s', ip, username)
-                cmd_str = SSH_V1_STR % (username, ip)
+                cmd_str = SSH_V1_STR % (port, username, ip)
             else:
                 self.logger.info('ssh(v2) %s as %s', ip, username)
-                cmd_str = SSH_V2_STR % (username, ip)
+                cmd_str = SSH_V2_STR % (port, username, ip)
             child = pexpect.spawn(cmd_str, maxread=8192, searchwindowsize=4096)
 
             first_pattern = ['.*assword:',
@@ -50,6 +64,7 @@ class SSH():
                              pexpect.TIMEOUT,
                              pexpect.EOF]
             i = child.expect(first_pattern, timeout=timeout)
+            trace.lap('connect', method=self.method)
             if i == 3:
                 raise Exception('LoginException.CONNECTION_CLOSED')
             if i == 2:
@@ -64,6 +79,7 @@ class SSH():
                               pexpect.TIMEOUT,
                               pexpect.EOF]
             i = child.expect(second_pattern, timeout=timeout)
+            trace.lap('auth')
             if i == 1:
                 raise Exception('LoginException.LOGIN_FAILED')
             if i == 2:
@@ -74,6 +90,7 @@ class SSH():
             for line in self.no_pager_list:
                 child.sendline(line)
                 child.expect(prompt, timeout=timeout)
+            trace.lap('no_pager')
             last_line = child.before.splitlines()[-1].decode()
             self.prompt = last_line + prompt
             try:
@@ -90,6 +107,7 @@ class SSH():
                 expect_pattern.append(re.escape(p))
             expect_pattern.append('.*\r\n')
             self.expect_pattern = expect_pattern
+            self.prompt_re = prompt_regex(expect_pattern[2:-1])
             return self.hostname
         except Exception as e:
             self.logger.warning('ssh %s failed: %s', ip, e)
@@ -97,32 +115,47 @@ class SSH():
 
     def execute(self, command):
         ip = self.hostname or self.device_info['ip']
-        expect_pattern = self.expect_pattern
-        new_line_pattern_id = len(expect_pattern) - 1
-        timeout = self.timeout
         child = self.child
-        res = []
+        self.trace.begin()
         self.logger.info('%s execute: %s', ip, command)
         child.sendline(command)
-        while True:
-            c = child.expect(expect_pattern, timeout=timeout)
-            res.append(child.before.decode())
-            res.append(child.after.decode())
-            if c < new_line_pattern_id:
-                break
-        if c == 0:
+        data, end = read_until_prompt(child, self.prompt_re, self.timeout)
+        if end != 'prompt':
+            self.at_prompt = False
+        if end == 'timeout':
             msg = 'Timeout'
             self.logger.error('Timeout execute: %s @ %s', command, ip)
+            self.trace.lap('command', command=command, status=msg)
+            raise Exception(msg)
+        if end == 'eof':
+            msg = 'Closed'
+            self.logger.error('Closed execute: %s @ %s', command, ip)
+            self.trace.lap('command', command=command, status=msg)
             raise Exception(msg)
 
-        output = ''.join(res)
-        if self.error_sign and self.error_sign in output:
+        output = bytes(data) if self.raw else data.decode()
+        if self.error_sign and self.error_sign.encode() in data:
             status = 'Error'
         else:
             status = 'Ok'
         timestamp = strftime('%Y-%m-%d %H:%M:%S')
+        self.trace.lap('command', command=command, status=status)
         return dict(command=command, status=status, output=output, timestamp=timestamp)
 
+    def alive(self, timeout):
+        """Back at the prompt after a newline, for a pooled session"""
+        child = self.child
+        try:
+            if not child.isalive():
+                return False
+            child.sendline('')
+            i = child.expect([re.escape(self.prompt),
+                              pexpect.TIMEOUT,
+                              pexpect.EOF], timeout=timeout)
+            return i == 0
+        except Exception:
+            return False
+
     def close(self):
         try:
             self.child.close()
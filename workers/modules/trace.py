@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+__author__ = 'zhutong'
+
+try:
+    now = time.monotonic_ns
+except AttributeError:  # Python < 3.7
+    def now():
+        return int(time.time() * 1e9)
+
+
+class Trace(object):
+    """
+    Monotonic nanosecond spans of one task, for requests with trace=true
+
+    start_ns is relative to the start of the task on the worker. Helpers
+    time consecutive phases with begin() and lap(): each lap is a span
+    from the previous lap, or from begin(), until now.
+    """
+
+    def __init__(self):
+        self.origin = self.last = now()
+        self.spans = []
+
+    def add(self, name, start, end, **attrs):
+        attrs.update(name=name,
+                     start_ns=start - self.origin,
+                     duration_ns=end - start)
+        self.spans.append(attrs)
+
+    def begin(self):
+        self.last = now()
+
+    def lap(self, name, **attrs):
+        t = now()
+        self.add(name, self.last, t, **attrs)
+        self.last = t
+
+
+class NoTrace(object):
+    """Stand-in when the task is not traced, does nothing"""
+    spans = None
+
+    def add(self, name, start, end, **attrs):
+        pass
+
+    def begin(self):
+        pass
+
+    def lap(self, name, **attrs):
+        pass
+
+
+NO_TRACE = NoTrace()
@@ -1,78 +1,571 @@
 # encoding: utf-8
 
+import asyncio
 import json
 import logging
 import os
+import re
+import signal
+import socket
 import sys
 import time
-from threading import Thread
+import zlib
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
 
 import zmq
 from tornado import ioloop, options
 from tornado.log import enable_pretty_logging
 
+from .trace import NO_TRACE, Trace, now
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 enable_pretty_logging()
 
 context = zmq.Context()
 
+# Worker -> server commands, keep in sync with dispatcher.py of the server
+W_HEARTBEAT = b'HEARTBEAT'
+W_REPLY = b'REPLY'
+W_PART = b'PART'
+
+# Keep in sync with config.py of the server
+HEARTBEAT_INTERVAL = 5  # seconds
+PORT_DAEMON_SOCKET_PORT = 16000
+
+# On SIGTERM a process takes no new task and exits once it ran none for
+# this many seconds, tasks sent before the server knew are done too
+DRAIN_QUIET = 2
+
+COMPRESS_LEVEL = 1  # replies are big, compress fast
+
+
+def deflate(payload):
+    """gzip a reply, the server passes it to the HTTP client as is"""
+    c = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(payload) + c.flush()
+
+
+# Upper bounds in seconds, keep in sync with metrics.py of the server
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+
+# 'LoginException.LOGIN_FAILED' (ssh_helper), or the bare message of a
+# cisco_cli_helper.LoginException, or its str()
+LOGIN_ERROR = re.compile(r'LoginException\.([^>]+)')
+LOGIN_MESSAGES = {'Timeout': 'LOGIN_TIMEOUT',
+                  'Connection_Closed': 'CONNECTION_CLOSED',
+                  'Wrong username or password': 'LOGIN_FAILED',
+                  'Wrong enable password': 'ENABLE_FAILED',
+                  'SSH version not supported': 'SSH_VERSION_ERROR'}
+
+
+def error_code(result):
+    """LoginException code of a failed task, OTHER for other failures"""
+    message = str(result.get('message', ''))
+    match = LOGIN_ERROR.search(message)
+    name = match.group(1) if match else message
+    if name in LOGIN_MESSAGES:
+        return LOGIN_MESSAGES[name]
+    if match is None:
+        return 'OTHER'
+    return re.sub(r'\W+', '_', name).strip('_').upper()
+
+
+class Stats(object):
+    """
+    Running totals of this process: login and execution time histograms
+    and failed tasks by error code, sent with every heartbeat
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.phases = dict(
+            (p, dict(counts=[0] * (len(LATENCY_BUCKETS) + 1), sum=0.0))
+            for p in ('login', 'execute'))
+        self.errors = {}
+
+    def observe(self, phase, seconds):
+        h = self.phases[phase]
+        with self.lock:
+            h['counts'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            h['sum'] += seconds
+
+    def error(self, code):
+        with self.lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+
+    def totals(self):
+        with self.lock:
+            totals = dict((p, dict(counts=list(h['counts']), sum=h['sum']))
+                          for p, h in self.phases.items())
+            totals['errors'] = dict(self.errors)
+        return totals
+
+
+stats = Stats()
+
+
+# Reply wire format, agreed with the server in get_port. Keep in sync with
+# wire.py of the server
+WIRE_VERSION = 1
+UNKNOWN_CHANNEL = 'ERROR unknown channel'  # port daemon reply
+
+
+def text(obj):
+    """Command output kept as raw bytes"""
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', 'replace')
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def wire_formats():
+    formats = [f for f, m in (('orjson', orjson), ('msgpack', msgpack)) if m]
+    return formats + ['json']
+
+
+def encoder(wire_format):
+    if wire_format == 'msgpack':
+        return lambda obj: msgpack.packb(obj, use_bin_type=True)
+    if wire_format == 'orjson':
+        return lambda obj: orjson.dumps(obj, default=text)
+    return lambda obj: json.dumps(obj, default=text).encode()
+
 
 def get_port(server, channel):
+    """Register on a server, return its worker port and the wire format"""
+    if ':' not in server:
+        server = '%s:%d' % (server, PORT_DAEMON_SOCKET_PORT)
     req = context.socket(zmq.REQ)
-    req.connect("tcp://%s:16000" % server)
-    req.send_string(channel)
-    port = req.recv_string()
-    logging.info('Connected server, got port: %s', port)
+    req.connect("tcp://%s" % server)
+    req.send_string('%s %d %s' % (channel, WIRE_VERSION,
+                                  ','.join(wire_formats())))
+    reply = req.recv_string()
+    if reply == 'None':  # a server before wire version 1, ask again
+        req.send_string(channel)
+        reply = req.recv_string()
+    if reply == 'None' or reply.startswith(UNKNOWN_CHANNEL):
+        req.close()
+        raise Exception('Server %s does not serve channel %s' % (
+            server, channel))
+    port, _, wire_format = reply.partition(' ')
+    wire_format = wire_format or 'json'
+    logging.info('Connected server %s, got port: %s, wire format: %s',
+                 server, port, wire_format)
     req.close()
-    return int(port)
+    return int(port), wire_format
 
 
 class BaseWorker(Thread):
+    """
+    One worker thread, connected to the server nodes given as a list of
+    ('tcp://host:port', wire format), one node per thread as started by
+    main(). Replies go back to the server the task came from, in the
+    format agreed with it.
+
+    Handlers may return command outputs as bytes, sent raw with msgpack:
+    raw_output tells whether the wire format of the task carries them.
+    Handlers logging in to a device call logged_in() once done, so the
+    login and execution times are told apart. self.trace is given to
+    the device helpers, which record spans when the task is traced.
+
+    handler may be a coroutine function, or return a coroutine if
+    is_async(): run in the event loop of an AsyncRuntime (-i), or to
+    completion by the thread otherwise.
+    """
 
-    def __init__(self, thread_name, server, port):
+    def __init__(self, thread_name, endpoints):
         Thread.__init__(self)
-        worker = context.socket(zmq.REP)
-        worker.connect("tcp://%s:%d" % (server, port))
+        self.poller = zmq.Poller()
+        self.encoders = {}  # socket -> reply encoder
+        for endpoint, wire_format in endpoints:
+            worker = context.socket(zmq.DEALER)
+            worker.setsockopt(zmq.IDENTITY, thread_name.encode())
+            worker.connect(endpoint)
+            self.poller.register(worker, zmq.POLLIN)
+            self.encoders[worker] = (encoder(wire_format),
+                                     wire_format != 'msgpack')
         logging.info('Worker thread %s started', thread_name)
-        self.worker = worker
+        self.worker = worker  # socket of the current task
         self.thread_name = thread_name
+        self.busy = False
+        self.trace = NO_TRACE
+        self.loop = None  # of async handlers run by this thread
 
     def run(self):
-        worker = self.worker
-        t_name = self.thread_name
         while True:
-            message = worker.recv_json()
-            start_at = time.strftime('%Y-%m-%d %H:%M:%S')
-            task_id = message['task_id']
-            logging.info('%s: task started %s', t_name, task_id)
-            result = self.handler(task_id, message)
-            result['task_id'] = task_id
-            result['ip'] = message['ip']
-            result['start@'] = start_at
-            result['finish@'] = time.strftime('%Y-%m-%d %H:%M:%S')
-            worker.send_json(result)
-            logging.info('%s: task finished %s', t_name, task_id)
+            # one task at a time, from whichever server sent one first
+            worker = self.worker = self.poller.poll()[0][0]
+            worker.send_multipart(self.process(worker.recv_multipart()))
+
+    def process(self, frames):
+        """Reply frames of a task given as envelope (ends with an empty
+        frame) + payload"""
+        message = self.begin(frames)
+        try:
+            result = self.handler(message['task_id'], message)
+            if asyncio.iscoroutine(result):  # async handler, in a thread
+                if self.loop is None:
+                    self.loop = asyncio.new_event_loop()
+                result = self.loop.run_until_complete(result)
+        except Exception as e:
+            logging.exception('%s: task failed %s', self.thread_name,
+                              message['task_id'])
+            result = dict(status='error', message=str(e))
+        return self.end(result)
+
+    def begin(self, frames):
+        envelope, message = frames[:-1], json.loads(frames[-1])
+        logging.info('%s: task started %s', self.thread_name,
+                     message['task_id'])
+        self.envelope = envelope
+        self.message = message
+        self.busy = True
+        self.logged_in_at = None
+        self.trace = Trace() if message.get('trace') else NO_TRACE
+        self.start_at = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.started = time.time()
+        return message
+
+    def end(self, result):
+        message = self.message
+        trace = self.trace
+        self.account(result, self.started, time.time())
+        if trace.spans is not None:
+            trace.add('handler', trace.origin, now())
+            result['trace'] = trace.spans
+        result['task_id'] = message['task_id']
+        result['ip'] = message['ip']
+        result['start@'] = self.start_at
+        result['finish@'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        encode, is_json = self.encoders[self.worker]
+        payload = encode(result)
+        # the server offers compression for replies from this size on,
+        # passed through as is, so JSON only
+        if is_json and message.get('compress') and \
+                len(payload) >= message['compress']:
+            payload = deflate(payload)
+        self.busy = False
+        logging.info('%s: task finished %s', self.thread_name,
+                     message['task_id'])
+        return [W_REPLY] + self.envelope + [payload]
 
     def handler(self, task_id, message):
         raise NotImplementedError()
 
+    @classmethod
+    def is_async(cls):
+        """Tasks are awaited in the loop of an AsyncRuntime, not threads"""
+        return asyncio.iscoroutinefunction(cls.handler)
+
+    @property
+    def raw_output(self):
+        """Command outputs are best kept as bytes for this task"""
+        return not self.encoders[self.worker][1]
+
+    def logged_in(self):
+        self.logged_in_at = time.time()
+
+    def account(self, result, started, finished):
+        code = None
+        if result.get('status') in ('fail', 'error'):
+            code = error_code(result)
+            stats.error(code)
+        logged_in_at = self.logged_in_at
+        if logged_in_at:
+            stats.observe('login', logged_in_at - started)
+            stats.observe('execute', finished - logged_in_at)
+        elif code and code != 'OTHER':  # failed to log in
+            stats.observe('login', finished - started)
+        else:
+            stats.observe('execute', finished - started)
+
+    def collect(self, output, cmd_out):
+        """Keep one command output for the reply, or stream it right away"""
+        message = self.message
+        if not message.get('stream'):
+            output.append(cmd_out)
+            return
+        part = dict(task_id=message['task_id'],
+                    ip=message['ip'],
+                    output=[cmd_out])
+        encode, _ = self.encoders[self.worker]
+        self.worker.send_multipart([W_PART] + self.envelope + [encode(part)])
+
+
+def heartbeat(sock, workers, stopping=False):
+    """Announce the process is alive and which threads are free"""
+    busy = sum(1 for w in workers if w.busy)
+    state = dict(threads=len(workers),
+                 busy=busy,
+                 workers=dict((w.thread_name, 0 if w.busy else 1)
+                              for w in workers),
+                 metrics=stats.totals())
+    if stopping:
+        state['stopping'] = True
+    try:
+        sock.send_multipart([W_HEARTBEAT, json.dumps(state).encode()],
+                            zmq.NOBLOCK)
+    except zmq.Again:
+        logging.warning('Server not reachable, heartbeat skipped')
+
+
+class Channel(object):
+    """
+    A DEALER socket to one server, owned by the event loop of an
+    AsyncRuntime. send_multipart may be called from any thread: sent at
+    once from the loop, so the partial output of a coroutine handler
+    goes before its reply, queued to the loop from others.
+
+    The zmq file descriptor is edge triggered and shared by both ways:
+    messages are read until none is left, again after every send.
+    """
+
+    def __init__(self, runtime, endpoint, wire_format):
+        self.runtime = runtime
+        self.loop = runtime.loop
+        self.sock = context.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.IDENTITY, runtime.name.encode())
+        self.sock.setsockopt(zmq.SNDHWM, 0)  # replies, bounded by in flight
+        self.sock.connect(endpoint)
+        self.slots = 0  # tasks in flight from this server, at most
+        self.running = 0
+        self.encoders = {self: (encoder(wire_format),
+                                wire_format != 'msgpack')}
+        self.loop.add_reader(self.sock.getsockopt(zmq.FD), self.read)
+
+    def read(self):
+        sock = self.sock
+        while sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            self.runtime.start(self, sock.recv_multipart(zmq.NOBLOCK))
+
+    def send(self, frames):
+        try:
+            self.sock.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            logging.warning('Server not reachable, %s dropped', frames[0])
+        self.read()
+
+    def send_multipart(self, frames):
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:  # a thread of sync handlers
+            in_loop = False
+        if in_loop:
+            self.send(frames)
+        else:
+            self.loop.call_soon_threadsafe(self.send, frames)
+
+
+class AsyncRuntime(object):
+    """
+    Up to in_flight tasks at a time in one event loop, over one DEALER
+    socket per server, used for the heartbeats too: the dispatcher holds
+    a credit per free slot of the process, all under its identity. The
+    slots are shared out between the servers, as the threads of main().
+
+    Handlers written as coroutines run in the loop. The others run in a
+    pool of threads threads, so existing workers run unchanged; then
+    there are no more slots than threads, the tasks left wait in the
+    queues of the server rather than for a thread here. Every
+    task gets its own worker object, its attributes (message, trace...)
+    are not shared between tasks; the worker thread is never started.
+    """
+
+    def __init__(self, worker, process_name, endpoints, in_flight, threads):
+        self.worker = worker
+        self.name = process_name
+        self.running = 0
+        self.stopping = False
+        self.idle = 0  # seconds without a task while stopping
+        self.is_async = worker.is_async()
+        if not self.is_async:
+            in_flight = min(in_flight, threads)
+        in_flight = max(in_flight, len(endpoints))
+        self.in_flight = in_flight
+        self.executor = ThreadPoolExecutor(max(threads, in_flight))
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.channels = [Channel(self, endpoint, wire_format)
+                         for endpoint, wire_format in endpoints]
+        for i, channel in enumerate(self.channels):
+            channel.slots = len(range(i, in_flight, len(self.channels)))
+        logging.info('Worker %s started, %d tasks in flight, %s handler',
+                     process_name, in_flight,
+                     'async' if self.is_async else '%d threads of' % threads)
+
+    def task(self, channel):
+        """A worker object for one task, Thread.__init__ left out"""
+        work = self.worker.__new__(self.worker)
+        work.thread_name = self.name
+        work.worker = channel
+        work.encoders = channel.encoders
+        work.busy = False
+        work.trace = NO_TRACE
+        work.loop = None
+        return work
+
+    def start(self, channel, frames):
+        self.running += 1
+        channel.running += 1
+        self.loop.create_task(self.run_task(self.task(channel), frames))
+
+    async def run_task(self, work, frames):
+        try:
+            if self.is_async:
+                message = work.begin(frames)
+                try:
+                    result = await work.handler(message['task_id'], message)
+                except Exception as e:
+                    logging.exception('%s: task failed %s', self.name,
+                                      message['task_id'])
+                    result = dict(status='error', message=str(e))
+                reply = work.end(result)
+            else:
+                reply = await self.loop.run_in_executor(
+                    self.executor, work.process, frames)
+            work.worker.send(reply)
+        except Exception:  # bad frames, the task is lost, not the slot
+            logging.exception('%s: task not replied', self.name)
+        finally:
+            self.running -= 1
+            work.worker.running -= 1
+
+    def heartbeat(self):
+        metrics = stats.totals()
+        for channel in self.channels:
+            busy = min(channel.running, channel.slots)
+            state = dict(threads=channel.slots,
+                         busy=busy,
+                         workers={self.name: channel.slots - busy},
+                         metrics=metrics)
+            if self.stopping:
+                state['stopping'] = True
+            channel.send([W_HEARTBEAT, json.dumps(state).encode()])
+
+    def beat(self):
+        self.heartbeat()
+        self.loop.call_later(HEARTBEAT_INTERVAL, self.beat)
+
+    def stop(self):
+        """SIGTERM: no new task, exit once the running ones are done"""
+        if self.stopping:
+            return
+        logging.info('Stopping, %d tasks running', self.running)
+        self.stopping = True
+        self.heartbeat()
+        self.drain()
+
+    def drain(self):
+        self.idle = 0 if self.running else self.idle + 1
+        if self.idle > DRAIN_QUIET:
+            self.loop.stop()
+        else:
+            self.loop.call_later(1, self.drain)
+
+    def run(self):
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+        self.beat()
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            logging.info('Works exited')
+            return
+        stopped()
+
 
 def main(worker):
-    options.define("s", default='127.0.0.1', help="zmq server", type=str)
-    options.define("t", default=10, help="threads", type=int)
+    options.define("s", default='127.0.0.1', type=str,
+                   help="zmq server, or comma separated server nodes, "
+                        "as host[:port of the port daemon]")
+    options.define("t", default=10, type=int,
+                   help="threads, shared out between the servers")
+    options.define("i", default=0, type=int,
+                   help="tasks in flight in an event loop, sync handlers "
+                        "in -t threads (at most -t tasks then); 0 for a "
+                        "task per thread")
     options.parse_command_line()
-    server = options.options.s
+    servers = options.options.s.split(',')
     threads = options.options.t
 
-    port = get_port(server, worker.channel)
+    endpoints = []
+    for s in servers:
+        port, wire_format = get_port(s, worker.channel)
+        endpoints.append(("tcp://%s:%d" % (s.split(':')[0], port),
+                          wire_format))
 
-    pid = os.getpid()
+    process_name = '%s-%s-%05d' % (worker.name, socket.gethostname(),
+                                   os.getpid())
+    if options.options.i:
+        AsyncRuntime(worker, process_name, endpoints, options.options.i,
+                     threads).run()
+        return
+
+    # every server gets threads of its own: a thread holding a credit on
+    # each one would get a second task queued behind the one it runs,
+    # while other threads may be idle
+    threads = max(threads, len(endpoints))
+    workers = []
     for tid in range(threads):
-        worker_name = '%s-%05d-%03d' % (worker.name, pid, tid)
-        work = worker(worker_name, server, port)
+        worker_name = '%s-%03d' % (process_name, tid)
+        work = worker(worker_name, [endpoints[tid % len(endpoints)]])
         work.daemon = True
         work.start()
+        workers.append(work)
+    groups = [workers[i::len(endpoints)] for i in range(len(endpoints))]
+
+    sockets = []
+    for endpoint, _ in endpoints:
+        hb = context.socket(zmq.DEALER)
+        hb.setsockopt(zmq.IDENTITY, process_name.encode())
+        hb.setsockopt(zmq.SNDHWM, 1)  # no stale heartbeats after reconnect
+        hb.connect(endpoint)
+        sockets.append(hb)
+
+    drain = dict(stopping=False, idle=0)
+
+    def heartbeat_all():
+        for hb, group in zip(sockets, groups):
+            heartbeat(hb, group, drain['stopping'])
+
+    def check_idle():
+        drain['idle'] = 0 if any(w.busy for w in workers) else \
+            drain['idle'] + 1
+        if drain['idle'] > DRAIN_QUIET:
+            ioloop.IOLoop.current().stop()
+
+    def stop():
+        """SIGTERM: no new task, exit once the running ones are done"""
+        if drain['stopping']:
+            return
+        logging.info('Stopping, %d tasks running',
+                     sum(1 for w in workers if w.busy))
+        drain['stopping'] = True
+        heartbeat_all()
+        ioloop.PeriodicCallback(check_idle, 1000).start()
+
+    signal.signal(signal.SIGTERM, lambda *_: ioloop.IOLoop.current()
+                  .add_callback_from_signal(stop))
+    heartbeat_all()
+    ioloop.PeriodicCallback(heartbeat_all, HEARTBEAT_INTERVAL * 1000).start()
 
     try:
         ioloop.IOLoop.instance().start()
     except KeyboardInterrupt:
         logging.info('Works exited')
+        return
+    stopped()
+
+
+def stopped():
+    """Exit once drained, without waiting for the worker threads"""
+    logging.info('Worker stopped, no task left')
+    os._exit(0)
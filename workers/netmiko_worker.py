@@ -28,6 +28,7 @@ class Worker(BaseWorker):
                                  username=u,
                                  password=p,
                                  secret=s)
+            self.logged_in()
             hostname = cli.base_prompt
             logging.info('%s connected', host)
             if given_name and given_name != hostname:
@@ -49,7 +50,7 @@ class Worker(BaseWorker):
                                status=status,
                                output=text,
                                timestamp=timestamp)
-                output.append(cmd_out)
+                self.collect(output, cmd_out)
                 sleep(wait_seconds)
         except Exception as e:
             status = 'fail'
@@ -1,7 +1,10 @@
 # __author__ = 'zhutong'
 
+import threading
 import time
 
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+
 from modules.worker_base import BaseWorker, main, logging
 from modules.snmp_helper import SNMP
 
@@ -9,6 +12,7 @@ from modules.snmp_helper import SNMP
 class Worker(BaseWorker):
     channel = 'snmp'
     name = 'SNMP'
+    local = threading.local()  # CommandGenerator of the thread, reused
 
     def handler(self, task_id, params):
         ip = params['ip']
@@ -18,6 +22,9 @@ class Worker(BaseWorker):
         oids = [str(o).strip('.') for o in commands['oids']]
 
         logging.info('%s for %s started', operate.upper(), ip)
+        cmd_gen = getattr(self.local, 'cmd_gen', None)
+        if cmd_gen is None:
+            cmd_gen = self.local.cmd_gen = cmdgen.CommandGenerator()
         worker = SNMP(ip,
                       community,
                       logger=logging,
@@ -25,7 +32,9 @@ class Worker(BaseWorker):
                       timeout=commands.get('timeout', 5),
                       retries=commands.get('retries', 1),
                       non_repeaters=commands.get('non_repeaters', 0),
-                      max_repetitions=commands.get('max_repetitions', 25))
+                      max_repetitions=commands.get('max_repetitions', 25),
+                      trace=self.trace,
+                      cmd_gen=cmd_gen)
         try:
             if operate == 'get':
                 snmp_fun = worker.get
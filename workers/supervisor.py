@@ -0,0 +1,324 @@
+# encoding: utf-8
+"""
+Runs the worker processes of a host and sizes them to the load
+
+    python supervisor.py --workers=cisco,snmp -s=10.0.0.1 \\
+        --metrics=http://10.0.0.1:8080/metrics
+
+Starts --processes processes (one per core by default) of every worker
+script given, <name>_worker.py, with -t threads each, and starts again
+the ones which exit, waiting longer for those crashing at start.
+
+Every --interval seconds each worker is sized to the queue depth and the
+busy threads of its channel, read from /metrics of the servers. This
+host takes its share of them, in proportion of its threads:
+
+    needed = (busy threads + queued tasks) / TARGET_UTILIZATION
+
+More processes are started first, up to --max_processes, then every
+process gets more threads, up to --max_threads: such processes are
+replaced, the thread count of a process is fixed. Capacity shrinks the
+other way round, down to --min_processes and --min_threads, once it was
+in excess for SCALE_DOWN_CHECKS checks in a row. Processes are stopped
+with SIGTERM, they finish their tasks first (killed after
+--stop_timeout).
+"""
+
+import logging
+import math
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+from tornado import gen, ioloop, options
+from tornado.httpclient import AsyncHTTPClient
+from tornado.log import enable_pretty_logging
+
+__author__ = 'zhutong'
+
+enable_pretty_logging()
+
+WORKERS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Channel of the Worker class of each script: scripts are not imported
+# here, some run main() at import, others need optional packages. Other
+# scripts are given as --workers=name:channel::channel
+CHANNELS = dict(cisco='cisco::brocade', snmp='snmp', hw_h3c='huawei',
+                f5='f5', netmiko='netmiko', test='test', echo='test')
+
+TARGET_UTILIZATION = 0.7  # of the threads, once sized
+GROWTH = 1.5  # capacity grown at least this much at once
+SCALE_DOWN_SHARE = 0.5  # needed under this share of capacity is excess
+SCALE_DOWN_CHECKS = 6  # in a row before shrinking, halving at most
+RESTART_DELAY = 1  # seconds, doubled for every crash at start
+RESTART_DELAY_MAX = 60
+CRASH_AT_START = 10  # seconds, a process exiting sooner crashed at start
+
+SERIES = re.compile(r'^(cc_queue_depth|cc_worker_threads|'
+                    r'cc_worker_threads_busy)\{channels="([^"]*)"\} (\S+)$',
+                    re.M)
+
+
+def clamp(n, low, high):
+    return max(low, min(n, high))
+
+
+def parse(text):
+    """channels -> {queued, threads, busy} of a /metrics page"""
+    names = dict(cc_queue_depth='queued', cc_worker_threads='threads',
+                 cc_worker_threads_busy='busy')
+    backends = {}
+    for name, channels, value in SERIES.findall(text):
+        backend = backends.setdefault(frozenset(channels.split(',')), {})
+        backend[names[name]] = float(value)
+    return backends
+
+
+class Process(object):
+
+    def __init__(self, name, threads, args):
+        self.threads = threads
+        self.started = time.time()
+        self.stop_at = None
+        self.popen = subprocess.Popen(
+            [sys.executable, '%s_worker.py' % name,
+             '-t=%d' % threads] + args, cwd=WORKERS_DIR)
+        self.pid = self.popen.pid
+
+    def stop(self):
+        if self.stop_at is None:
+            self.stop_at = time.time()
+            self.popen.terminate()
+
+
+class Pool(object):
+    """The processes of one worker script"""
+
+    def __init__(self, name, channel, opts):
+        self.name = name
+        self.channels = set(channel.split('::'))
+        self.args = ['-s=%s' % opts.s] + opts.args.split()
+        self.min_processes = opts.min_processes
+        self.max_processes = opts.max_processes or os.cpu_count()
+        self.min_threads = opts.min_threads
+        self.max_threads = opts.max_threads
+        self.base_threads = opts.t
+        self.stop_timeout = opts.stop_timeout
+        self.processes = clamp(opts.processes or os.cpu_count(),
+                               self.min_processes, self.max_processes)
+        self.threads = self.base_threads
+        self.running = []
+        self.stopping = []
+        self.delay = RESTART_DELAY
+        self.restart_at = 0
+        self.excess = 0  # checks in a row with capacity in excess
+
+    def start(self):
+        p = Process(self.name, self.threads, self.args)
+        logging.info('%s: started process %d, %d threads',
+                     self.name, p.pid, p.threads)
+        self.running.append(p)
+
+    def stop(self, p):
+        p.stop()
+        self.running.remove(p)
+        self.stopping.append(p)
+
+    def reap(self, now):
+        for p in list(self.running):
+            code = p.popen.poll()
+            if code is None:
+                continue
+            self.running.remove(p)
+            if now - p.started < CRASH_AT_START:
+                logging.error('%s: process %d crashed at start (%s), '
+                              'restart in %ds', self.name, p.pid, code,
+                              self.delay)
+                self.restart_at = now + self.delay
+                self.delay = min(self.delay * 2, RESTART_DELAY_MAX)
+            else:
+                logging.warning('%s: process %d exited (%s), restarted',
+                                self.name, p.pid, code)
+                self.delay = RESTART_DELAY
+        for p in list(self.stopping):
+            if p.popen.poll() is not None:
+                logging.info('%s: process %d stopped', self.name, p.pid)
+                self.stopping.remove(p)
+            elif now > p.stop_at + self.stop_timeout:
+                logging.warning('%s: process %d still busy after %ds, '
+                                'killed', self.name, p.pid, self.stop_timeout)
+                p.popen.kill()
+                p.popen.wait()
+                self.stopping.remove(p)
+
+    def reconcile(self, now):
+        """As many processes as sized, those of another size replaced"""
+        if now >= self.restart_at:
+            # stopping ones end their tasks while the new ones start
+            for p in [p for p in self.running if p.threads != self.threads]:
+                self.stop(p)
+            while len(self.running) < self.processes:
+                self.start()
+        while len(self.running) > self.processes:
+            self.stop(self.running[-1])
+
+    def plan(self, slots):
+        """(processes, threads) for that many threads, processes first"""
+        processes = int(math.ceil(slots / float(self.base_threads)))
+        if processes > self.max_processes:
+            return self.max_processes, clamp(
+                int(math.ceil(slots / float(self.max_processes))),
+                self.base_threads, self.max_threads)
+        if processes < self.min_processes:
+            return self.min_processes, clamp(
+                int(math.ceil(slots / float(self.min_processes))),
+                self.min_threads, self.base_threads)
+        return processes, self.base_threads
+
+    def size(self, backends):
+        """Processes and threads for the load of the channel"""
+        load = [b for channels, b in backends.items()
+                if channels & self.channels]
+        if not load:
+            return
+        queued = sum(b.get('queued', 0) for b in load)
+        busy = sum(b.get('busy', 0) for b in load)
+        total = sum(b.get('threads', 0) for b in load)
+        capacity = self.processes * self.threads
+        share = min(1.0, capacity / total) if total else 1.0
+        needed = (busy + queued) / TARGET_UTILIZATION * share
+        if needed > capacity:
+            self.excess = 0
+            target = max(needed, capacity * GROWTH)
+        elif needed < capacity * SCALE_DOWN_SHARE:
+            self.excess += 1
+            if self.excess < SCALE_DOWN_CHECKS:
+                return
+            self.excess = 0
+            target = max(needed, capacity / 2.0, 1)
+        else:
+            self.excess = 0
+            return
+        processes, threads = self.plan(target)
+        if (processes, threads) != (self.processes, self.threads):
+            logging.info('%s: %d processes x %d threads -> %d x %d '
+                         '(queued %d, busy %d of %d threads)', self.name,
+                         self.processes, self.threads, processes, threads,
+                         queued, busy, total)
+            self.processes, self.threads = processes, threads
+
+    def stop_all(self):
+        for p in list(self.running):
+            self.stop(p)
+
+
+@gen.coroutine
+def scrape(urls):
+    """Backends of every server summed up, {} if none answered"""
+    client = AsyncHTTPClient()
+    backends = {}
+    for url in urls:
+        try:
+            response = yield client.fetch(url, request_timeout=5)
+        except Exception as e:
+            logging.warning('Metrics of %s not read: %s', url, e)
+            continue
+        for channels, b in parse(response.body.decode()).items():
+            total = backends.setdefault(channels, {})
+            for k, v in b.items():
+                total[k] = total.get(k, 0) + v
+    raise gen.Return(backends)
+
+
+def main():
+    options.define("workers", default='', type=str,
+                   help="worker scripts, comma separated: cisco,snmp runs "
+                        "cisco_worker.py and snmp_worker.py; name:channel "
+                        "for a script not in CHANNELS")
+    options.define("s", default='127.0.0.1', type=str,
+                   help="zmq servers, given to the workers as is")
+    options.define("metrics", default='', type=str,
+                   help="/metrics URLs of the servers, comma separated, by "
+                        "default port 8080 of every server in -s")
+    options.define("processes", default=0, type=int,
+                   help="processes per worker at start, 0 for one per core")
+    options.define("min_processes", default=1, type=int)
+    options.define("max_processes", default=0, type=int,
+                   help="0 for one per core")
+    options.define("t", default=10, type=int, help="threads per process")
+    options.define("min_threads", default=2, type=int)
+    options.define("max_threads", default=100, type=int)
+    options.define("interval", default=10, type=int,
+                   help="seconds between two sizings, 0 for a fixed size")
+    options.define("stop_timeout", default=600, type=int,
+                   help="seconds for a process to finish its tasks")
+    options.define("args", default='', type=str,
+                   help="more arguments for the workers, e.g. -i=1000")
+    options.parse_command_line()
+    opts = options.options
+
+    pools = []
+    for spec in opts.workers.split(','):
+        name, _, channel = spec.partition(':')
+        if not name:
+            continue
+        channel = channel or CHANNELS.get(name)
+        if not channel:
+            logging.error('Channel of %s unknown, give --workers=%s:channel',
+                          name, name)
+            return
+        pools.append(Pool(name, channel, opts))
+    if not pools:
+        logging.error('No worker given, see --workers')
+        return
+    urls = opts.metrics.split(',') if opts.metrics else [
+        'http://%s:8080/metrics' % s.split(':')[0] for s in opts.s.split(',')]
+    loop = ioloop.IOLoop.current()
+
+    def tick():
+        now = time.time()
+        for pool in pools:
+            pool.reap(now)
+            pool.reconcile(now)
+
+    @gen.coroutine
+    def check():
+        backends = yield scrape(urls)
+        for pool in pools:
+            pool.size(backends)
+        tick()
+
+    def shutdown():
+        logging.info('Stopping the workers')
+        for callback in callbacks:
+            callback.stop()
+        for pool in pools:
+            pool.stop_all()
+        exit_when_stopped()
+
+    def exit_when_stopped():
+        now = time.time()
+        for pool in pools:
+            pool.reap(now)
+        if any(pool.stopping for pool in pools):
+            loop.call_later(1, exit_when_stopped)
+        else:
+            loop.stop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: loop.add_callback_from_signal(shutdown))
+    tick()
+    callbacks = [ioloop.PeriodicCallback(tick, 1000)]
+    if opts.interval:
+        callbacks.append(ioloop.PeriodicCallback(check, opts.interval * 1000))
+    for callback in callbacks:
+        callback.start()
+    loop.start()
+    logging.info('Supervisor exited')
+
+
+if __name__ == '__main__':
+    main()
@@ -14,10 +14,12 @@ class Worker(BaseWorker):
         logging.info('Doing %s', task_id)
         sleep(random.randrange(1, 6))
         size = random.randrange(1, 1000) * 10000
+        output = []
+        self.collect(output, 'A'*size)
         return dict(status='success',
                     message='',
                     hostname=params['hostname'],
-                    output=['A'*size])
+                    output=output)
 
 
 if __name__ == '__main__':